@@ -29,6 +29,15 @@ class Config:
         _C.SYSTEM.SEED = 0
         # Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.
         _C.SYSTEM.PIN_MEM = True
+        # DataLoader to use in training and validation. Options: ['default', 'multi_epochs']
+        #   * 'default': torch DataLoader. Its workers are created again each epoch unless 'SYSTEM.PERSISTENT_WORKERS' is set
+        #   * 'multi_epochs': the same workers and sampler iterator are reused across all the epochs, so the first batches 
+        #     of the next epoch are loaded while the current one ends
+        _C.SYSTEM.DATALOADER = 'default'
+        # Whether to keep the workers of the 'default' DataLoader alive between epochs
+        _C.SYSTEM.PERSISTENT_WORKERS = False
+        # Number of batches loaded in advance by each worker. Only used when 'SYSTEM.NUM_WORKERS' > 0
+        _C.SYSTEM.PREFETCH_FACTOR = 2
 
         #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # Problem specification
@@ -205,6 +214,21 @@ class Config:
         # If 'DATA.PATCH_SIZE' selected has 3 channels, e.g. RGB images are expected, so will force grayscale images to be
         # converted into RGB (e.g. in ImageNet some of the images are grayscale)
         _C.DATA.FORCE_RGB = False
+        # Options used when training with Zarr/H5 files that are not loaded into memory (i.e. 'DATA.TRAIN.IN_MEMORY' or 
+        # 'DATA.VAL.IN_MEMORY' are False)
+        _C.DATA.CHUNKED_DATA = CN()
+        # Maximum number of Zarr/H5 files kept opened by each data loader worker. The least recently used one is closed when exceeded
+        _C.DATA.CHUNKED_DATA.MAX_OPEN_FILES = 16
+        # Size, in MB, of the chunk cache of each opened file. Useful when the patches are smaller than the chunks of the files,
+        # as the same chunks are not decoded again and again. Set it to 0 to use h5py/zarr defaults
+        _C.DATA.CHUNKED_DATA.CACHE_MB = 0
+        # Where to place the training and validation data loaded into memory (i.e. 'DATA.TRAIN.IN_MEMORY' or 'DATA.VAL.IN_MEMORY'
+        # are True). Options: ['numpy', 'shared_memory', 'memmap']
+        #   * 'numpy': ordinary arrays. Data loader workers may end up duplicating their pages
+        #   * 'shared_memory': a shared memory block read by all the data loader workers without copying it
+        #   * 'memmap': a '.npy' file, stored in 'PATHS.SHARED_ARRAYS_DIR', opened as a memory map. It is shared by the data
+        #      loader workers and also by the processes of the same node when training with several GPUs
+        _C.DATA.IN_MEMORY_BACKEND = 'numpy'
 
         # Train
         _C.DATA.TRAIN = CN()
@@ -313,6 +337,9 @@ class Config:
         # Whether to check if the data mask contains correct values, e.g. same classes as defined
         _C.DATA.TEST.CHECK_DATA = True
         _C.DATA.TEST.IN_MEMORY = False
+        # Number of test samples to load in background threads while the current one is being processed. Set it to 0 to 
+        # load each sample only when it is going to be processed. Notice that each prefetched sample is kept in memory
+        _C.DATA.TEST.PREFETCH_DEPTH = 0
         # Whether to load ground truth (GT)
         _C.DATA.TEST.LOAD_GT = False
         # Whether to use validation data as test instead of trying to load test from _C.DATA.TEST.PATH and
@@ -402,6 +429,13 @@ class Config:
         _C.AUGMENTOR.ENABLE = False
         # Probability of each transformation
         _C.AUGMENTOR.DA_PROB = 0.5
+        # Library used to apply the transformations. Options: ['imgaug', 'torch']. With 'torch' the flips, rotations, shear,
+        # zoom, shift, elastic, gaussian blur, gamma contrast, brightness, contrast, dropout and noise transformations are
+        # applied to the whole batch, as torch tensors in the training device, after collating the samples. The rest of
+        # transformations are still applied sample by sample. Only available for SEMANTIC_SEG, INSTANCE_SEG, DETECTION,
+        # IMAGE_TO_IMAGE and SELF_SUPERVISED (with 'crappify' pretext task) workflows. Notice that the samples created with
+        # 'AUGMENTOR.AUG_SAMPLES' will only contain the transformations applied sample by sample
+        _C.AUGMENTOR.BACKEND = 'imgaug'
         # Create samples of the DA made. Useful to check the output images made.
         _C.AUGMENTOR.AUG_SAMPLES = True
         # Draw a grid in the augenation samples generated. Used when _C.AUGMENTOR.AUG_SAMPLES=True
@@ -755,6 +789,11 @@ class Config:
         # If memory or # gpus is limited, use this variable to maintain the effective batch size, which is 
         # batch_size (per gpu) * nodes * (gpus per node) * accum_iter.
         _C.TRAIN.ACCUM_ITER = 1
+        # Precision used in the forward pass during training and validation. Options: ['fp32', 'fp16', 'bf16']
+        #   * 'fp32': no mixed precision
+        #   * 'fp16': mixed precision with float16. The loss is scaled to avoid underflows in the gradients. Only for GPU
+        #   * 'bf16': mixed precision with bfloat16. It can be used in GPU and CPU
+        _C.TRAIN.PRECISION = 'fp32'
         # Number of epochs to train the model
         _C.TRAIN.EPOCHS = 360
         # Epochs to wait with no validation data improvement until the training is stopped
@@ -798,6 +837,18 @@ class Config:
         # It is slower and not as precise as the "normal" inference process but saves memory. In 'TEST.BY_CHUNKS' it will
         # only save memory with the datatype change.
         _C.TEST.REDUCE_MEMORY = False
+        # Whether to merge each predicted patch into the final image as soon as it is predicted, instead of storing all the 
+        # predicted patches and merging them at the end. Only the merged image and a weight map are kept in memory 
+        _C.TEST.STREAMING_MERGE = False
+        # How to weight the overlapping areas when merging the predicted patches. Options: ['uniform', 'spline']
+        #   * 'uniform': all the patches contribute the same
+        #   * 'spline': each patch is weighted with a spline window, so the pixels close to the patch borders contribute less. 
+        #     It reduces the artifacts in the patch borders
+        _C.TEST.MERGE_BLENDING = 'uniform'
+        # Whether to extract the patches of 3D images only when they are going to be predicted instead of creating all of them 
+        # at once. Only the padded image is kept in memory, so the memory needed does not grow with 'DATA.TEST.OVERLAP'. Only 
+        # available for 3D problems ('PROBLEM.NDIM' == '3D')
+        _C.TEST.LAZY_PATCHES = False
         # In the processing of 3D images, the primary image is segmented into smaller patches. These patches are subsequently 
         # passed through a computational network. The outcome is a new image, typically saved as a TIF file, that retains the 
         # dimensions of the original input. Notably, if the input image is sizable, this process can be memory-intensive. This 
@@ -818,8 +869,30 @@ class Config:
         _C.TEST.BY_CHUNKS.SAVE_OUT_TIF = False
         # In how many iterations the H5 writer needs to flush the data. No need to do so with Zarr files.
         _C.TEST.BY_CHUNKS.FLUSH_EACH = 100
+        # How the overlapping predictions of the patches are accumulated. Options: ['mask', 'buffer']. With 'mask' the patches are 
+        # added into the H5/Zarr file together with another file of the same size that counts the overlaps, used to divide the
+        # data at the end. With 'buffer' the patches are added into an in-memory slab of the image (whole Y and X axes) that is 
+        # divided by the overlap count, computed from the patch grid, and written chunk aligned once all the patches that 
+        # contribute to it have been predicted. No count file is created and no division is needed at the end. 
+        _C.TEST.BY_CHUNKS.ACCUMULATION = "mask"
+        # Compressor of the H5/Zarr files created. Options: ['default', 'gzip', 'blosc', 'lz4', 'zstd']. 'default' uses 'gzip' in H5
+        # files and the default compressor of Zarr ('blosc') in Zarr files. In H5 files 'blosc', 'lz4' and 'zstd' need 'hdf5plugin'
+        # to be installed. 
+        _C.TEST.BY_CHUNKS.COMPRESSION = "default"
         # Input Numpy/Zarr/H5 image's axes order. Options: ['TZCYX', 'TZYXC', 'ZCYX', 'ZYXC']
         _C.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER = 'TZCYX'
+        # Number of patches that are gathered and passed through the model at once. Set it to -1 to use 'TRAIN.BATCH_SIZE'.
+        _C.TEST.BY_CHUNKS.BATCH_SIZE = -1
+        # Maximum size, in MB, of the region of the input image read at once. All the patches of the same Z position are cut from
+        # a slab of the image read at once (split along Y if it is larger than this value) while the next slab is read in background. 
+        # Set it to -1 to always read entire slabs. 
+        _C.TEST.BY_CHUNKS.MAX_SLAB_MB = 2048
+        # How the patches are distributed across the GPUs. Options: ['static', 'dynamic']. With 'static' each GPU processes a
+        # fixed range of Z slabs and writes its own H5/Zarr part, merged by the main rank at the end. With 'dynamic' the GPUs
+        # claim the next block of patches from a shared counter as soon as they finish the previous one and write directly,
+        # without overlapping, into the final Zarr file (so 'TEST.BY_CHUNKS.FORMAT' must be 'zarr'). In this mode each patch
+        # only writes the region it owns, so the overlapping predictions are not averaged.
+        _C.TEST.BY_CHUNKS.SCHEDULER = "static"
         # Whether if after reconstructing the prediction the pipeline will continue each workflow specific steps. For this process
         # the prediction image needs to be loaded into memory so be sure that it can fit in you memory. E.g. in instance 
         # segmentation the instances will be created from the prediction.
@@ -830,10 +903,25 @@ class Config:
         #      memory to process the entire prediction image with 'entire_pred'.
         #    * 'entire_pred': the predicted image will be loaded in memory and processed entirely (be aware of your  memory budget)     
         _C.TEST.BY_CHUNKS.WORKFLOW_PROCESS.TYPE = "chunk_by_chunk"
+        # Format of the file with all the points found in the image in the detection workflow. Options: ['csv', 'parquet']. 'parquet' 
+        # needs 'pyarrow' installed and is faster to write and read when there are millions of points.
+        _C.TEST.BY_CHUNKS.WORKFLOW_PROCESS.POINTS_FILE_FORMAT = "csv"
+        # Halo, in (z,y,x) voxels, added to each side of the blocks of 'DATA.PATCH_SIZE' shape in which the instances are created
+        # with 'chunk_by_chunk' in the instance segmentation workflow. The watershed of each block sees the instances that cross 
+        # its faces in the halo and they are used to stitch the instances of neighbouring blocks. The instances are only created 
+        # this way when 'PROBLEM.INSTANCE_SEG.DATA_MW_TH_TYPE' is 'manual', as the thresholds can not be calculated by blocks.
+        _C.TEST.BY_CHUNKS.WORKFLOW_PROCESS.INSTANCE_HALO = (8,32,32)
+        # Minimum fraction of the voxels of an instance in the halo that need to overlap an instance of the neighbouring block
+        # to consider them the same instance
+        _C.TEST.BY_CHUNKS.WORKFLOW_PROCESS.INSTANCE_STITCH_TH = 0.5
         # Enable verbosity
         _C.TEST.VERBOSE = True
         # Make test-time augmentation. Infer over 8 possible rotations for 2D img and 16 when 3D
         _C.TEST.AUGMENTATION = False
+        # How to make the test-time augmentation. Options: ['torch', 'numpy']
+        #   * 'torch': exact rotations and flips made in the device, predicting the transformed images in batches of 'TRAIN.BATCH_SIZE'
+        #   * 'numpy': rotations and flips made in CPU (interpolated in 3D) with the images padded to be square
+        _C.TEST.AUGMENTATION_BACKEND = 'numpy'
         # Whether to evaluate or not
         _C.TEST.EVALUATE = True
         # Stack 2D images into a 3D image and then process it entirely instead of going image per image
@@ -844,6 +932,17 @@ class Config:
         # If PROBLEM.NDIM = '2D' this can be activated to process each image entirely instead of patch by patch. Only can be done 
         # if the neural network is fully convolutional
         _C.TEST.FULL_IMG = False 
+        # How each image is predicted when 'TEST.FULL_IMG' is enabled. Options: ['entire', 'smooth_windowing']
+        #   * 'entire': the whole image is passed through the model at once
+        #   * 'smooth_windowing': the image is predicted by overlapping windows of 'DATA.PATCH_SIZE', cut only when they are 
+        #     going to be predicted and passed through the model in batches of 'TRAIN.BATCH_SIZE'. Their predictions are 
+        #     weighted with a spline window and accumulated into the output image, so only the output image is kept in memory. 
+        #     Useful to predict very large images (e.g. whole-slide images). 'TEST.AUGMENTATION' is applied to each window. The 
+        #     test loss is not calculated in this mode
+        _C.TEST.FULL_IMG_INFERENCE = 'entire'
+        # Number of windows that overlap in each axis when 'TEST.FULL_IMG_INFERENCE' is 'smooth_windowing', i.e. the step 
+        # between windows is 'DATA.PATCH_SIZE' divided by this value
+        _C.TEST.SMOOTH_WINDOWING_SUBDIVISIONS = 2
 
         ### Instance segmentation
         # Whether to calculate matching statistics (average overlap, accuracy, recall, precision, etc.)
@@ -853,6 +952,18 @@ class Config:
         _C.TEST.MATCHING_STATS_THS = [0.3, 0.5, 0.75]
         # Decide in which thresholds to create a colored image of the TPs, FNs and FPs
         _C.TEST.MATCHING_STATS_THS_COLORED_IMG = [0.3]
+        # Engine used to build the overlap table between ground truth and predicted instances. Options: ['bincount', 'loop']
+        #   * 'bincount': vectorized counting of the label pairs with numpy. 
+        #   * 'loop': voxel by voxel counting (slow, kept only for reference)
+        _C.TEST.MATCHING_STATS_OVERLAP_ENGINE = 'bincount'
+        # Number of slices (first axis) processed at once to build the overlap table. Use it to bound the memory needed 
+        # with very large volumes. Set it to -1 to process the whole volume at once.
+        _C.TEST.MATCHING_STATS_OVERLAP_CHUNK_SIZE = -1
+        # How the instances are matched. Options: ['dense', 'sparse']. 'dense' builds a (num. of gt instances x num. of 
+        # predicted instances) score matrix, which does not fit in memory with ~10^5 instances. 'sparse' only keeps the 
+        # overlapping pairs and solves the same assignment as 'dense' with them, so both give the same results (they can only 
+        # differ when several matchings are equally good). With 'sparse' MATCHING_STATS_OVERLAP_ENGINE is not used
+        _C.TEST.MATCHING_STATS_MODE = 'dense'
 
         ### Detection
         # To decide which function is going to be used to create point from probabilities. Options: ['peak_local_max', 'blob_log']
@@ -880,6 +991,13 @@ class Config:
         _C.TEST.DET_BLOB_LOG_NUM_SIGMA = 2
         # Maximum distance far away from a GT point to consider a point as a true positive
         _C.TEST.DET_TOLERANCE = [10]
+        # How predicted and GT points are matched to calculate the detection metrics. Options: 
+        #    * 'dense': the assignment is solved over the distance matrix between all the points. Its memory and time grow 
+        #      quadratically (or worse) with the number of points. 
+        #    * 'sparse': only the pairs closer than TEST.DET_TOLERANCE are considered, found with a KD-tree, so it can evaluate
+        #      hundreds of thousands of points. The metrics are the same unless far points compete for the same match, and GT 
+        #      points without a match are associated to -1 instead of to their closest remaining prediction.
+        _C.TEST.DET_POINT_MATCHING = 'dense'
 
         #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # Post-processing
@@ -983,6 +1101,10 @@ class Config:
         # Distance between points to be considered the same. Only applies when TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS = True
         # This can also be set when using 'BP' channels for instance segmentation.
         _C.TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS_RADIUS = [-1.0]
+        # Order in which the points are visited to remove the close ones. Each visited point is kept, if it was not removed before, and its 
+        # neighbours are removed. Options: 'position', to visit them in the order they were found, and 'probability', to visit first the 
+        # points with higher predicted probability. Only applies to the detection workflow.
+        _C.TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS_ORDER = 'position'
         # Whether to apply a watershed to grow the points detected 
         _C.TEST.POST_PROCESSING.DET_WATERSHED = False
         # Structure per each class to dilate the initial seeds before watershed
@@ -1041,6 +1163,10 @@ class Config:
         # Name of the folder to store the probability map to avoid recalculating it on every run
         _C.PATHS.PROB_MAP_DIR = os.path.join(job_dir, 'prob_map')
         _C.PATHS.PROB_MAP_FILENAME = 'prob_map.npy'
+        # Name of the folder to store the patch coordinates of Zarr/H5 training data to avoid recalculating them on every run
+        _C.PATHS.PATCH_INDEX_CACHE_DIR = os.path.join(job_dir, 'patch_index')
+        # Name of the folder to store the training and validation data when 'DATA.IN_MEMORY_BACKEND' is 'memmap'
+        _C.PATHS.SHARED_ARRAYS_DIR = os.path.join(job_dir, 'shared_arrays')
         # Watershed debugging folder
         _C.PATHS.WATERSHED_DIR = os.path.join(_C.PATHS.RESULT_DIR.PATH, 'watershed')
         # Custom mean normalization paths
@@ -541,7 +541,7 @@ def crop_data_with_overlap(data, crop_shape, data_mask=None, overlap=(0,0), padd
 
 
 def merge_data_with_overlap(data, original_shape, data_mask=None, overlap=(0,0), padding=(0,0), verbose=True,
-    out_dir=None, prefix=""):
+    out_dir=None, prefix="", blending="uniform"):
     """Merge data with an amount of overlap.
 
        The opposite function is :func:`~crop_data_with_overlap`.
@@ -576,6 +576,10 @@ def merge_data_with_overlap(data, original_shape, data_mask=None, overlap=(0,0),
        prefix : str, optional
            Prefix to save overlap map with.
 
+       blending : str, optional
+           How to weight the overlapping areas. ``'uniform'`` averages all the patches equally whereas ``'spline'`` 
+           weights each patch with a spline window, so the pixels close to the patch borders contribute less.
+
        Returns
        -------
        merged_data : 4D Numpy array
@@ -681,6 +685,8 @@ def merge_data_with_overlap(data, original_shape, data_mask=None, overlap=(0,0),
 
     if (overlap[0] >= 1 or overlap[0] < 0) and (overlap[1] >= 1 or overlap[1] < 0):
         raise ValueError("'overlap' values must be floats between range [0, 1)")
+    if blending not in ["uniform", "spline"]:
+        raise ValueError("'blending' must be one between ['uniform', 'spline']")
 
     padding = tuple(padding[i] for i in [1, 0])
 
@@ -694,6 +700,13 @@ def merge_data_with_overlap(data, original_shape, data_mask=None, overlap=(0,0),
         data_mask = data_mask[:, padding[0]:data_mask.shape[1]-padding[0], padding[1]:data_mask.shape[2]-padding[1]]
 
     ov_map_counter = np.zeros(original_shape[:-1]+(1,), dtype=np.int32)
+    if blending == "spline":
+        from biapy.data.post_processing.smooth_tiled_predictions import _window_3D
+        window = _window_3D((1,)+data.shape[1:3])[0]
+        weight_map = np.zeros(original_shape[:-1]+(1,), dtype=np.float32)
+    else:
+        window = 1
+        weight_map = ov_map_counter
     if out_dir is not None:
         crop_grid = np.zeros(original_shape[1:], dtype=np.int32)
 
@@ -735,12 +748,14 @@ def merge_data_with_overlap(data, original_shape, data_mask=None, overlap=(0,0),
                 d_y = 0 if (y*step_y+data.shape[1]) < original_shape[1] else last_y
                 d_x = 0 if (x*step_x+data.shape[2]) < original_shape[2] else last_x
 
-                merged_data[z,y*step_y-d_y:y*step_y+data.shape[1]-d_y, x*step_x-d_x:x*step_x+data.shape[2]-d_x] += data[c]
+                merged_data[z,y*step_y-d_y:y*step_y+data.shape[1]-d_y, x*step_x-d_x:x*step_x+data.shape[2]-d_x] += data[c]*window
 
                 if data_mask is not None:
-                    merged_data_mask[z, y*step_y-d_y:y*step_y+data.shape[1]-d_y, x*step_x-d_x:x*step_x+data.shape[2]-d_x] += data_mask[c]
+                    merged_data_mask[z, y*step_y-d_y:y*step_y+data.shape[1]-d_y, x*step_x-d_x:x*step_x+data.shape[2]-d_x] += data_mask[c]*window
 
                 ov_map_counter[z, y*step_y-d_y:y*step_y+data.shape[1]-d_y, x*step_x-d_x:x*step_x+data.shape[2]-d_x] += 1
+                if blending == "spline":
+                    weight_map[z, y*step_y-d_y:y*step_y+data.shape[1]-d_y, x*step_x-d_x:x*step_x+data.shape[2]-d_x] += window
 
                 if z == 0 and out_dir is not None:
                     crop_grid[y*step_y-d_y:y*step_y+data.shape[1]-d_y, x*step_x-d_x] = 1
@@ -750,9 +765,9 @@ def merge_data_with_overlap(data, original_shape, data_mask=None, overlap=(0,0),
 
                 c += 1
 
-    merged_data = np.true_divide(merged_data, ov_map_counter).astype(data.dtype)
+    merged_data = np.true_divide(merged_data, weight_map).astype(data.dtype)
     if data_mask is not None:
-        merged_data_mask = np.true_divide(merged_data_mask, ov_map_counter).astype(data_mask.dtype)
+        merged_data_mask = np.true_divide(merged_data_mask, weight_map).astype(data_mask.dtype)
 
     # Save a copy of the merged data with the overlapped regions colored as: green when 2 crops overlap, yellow when
     # (2 < x < 6) and red when more than 6 overlaps are merged
@@ -798,6 +813,40 @@ def merge_data_with_overlap(data, original_shape, data_mask=None, overlap=(0,0),
     else:
         return merged_data
 
+def merge_data_with_overlap_coords(original_shape, patch_shape, overlap=(0,0), padding=(0,0)):
+    """
+    Calculate where each patch is placed by :func:`~merge_data_with_overlap`, so the patches can be merged one by 
+    one with :class:`~biapy.data.data_3D_manipulation.StreamingPatchMerger`.
+
+    Parameters
+    ----------
+    original_shape : 4D int tuple
+        Shape of the original data. E.g. ``(num_of_images, y, x, channels)``
+
+    patch_shape : 3D int tuple
+        Shape of the patches, with padding. E.g. ``(y, x, channels)``.
+
+    overlap : Tuple of 2 floats, optional
+        Amount of minimum overlap on x and y dimensions. Should be the same as used in :func:`~crop_data_with_overlap`. 
+
+    padding : tuple of ints, optional
+        Size of padding added on each axis ``(y, x)``. E.g. ``(24, 24)``.
+
+    Returns
+    -------
+    patch_coords : 3D Numpy array
+        ``[start, end]`` pair of the image, ``y`` and ``x`` axes for each patch, in the same order as the patches 
+        created by :func:`~crop_data_with_overlap`. E.g. ``(num_patches, 3, 2)``.
+    """
+    from biapy.data.data_3D_manipulation import extract_3D_patch_coords_with_overlap
+
+    # Same axes correspondence as in merge_data_with_overlap
+    coords = extract_3D_patch_coords_with_overlap((1,)+tuple(original_shape[1:]), (1,)+tuple(patch_shape), "ZYXC", 
+        overlap=(0, overlap[1], overlap[0]), padding=(0, padding[1], padding[0]))[:, :3]
+    patch_coords = np.tile(coords, (original_shape[0], 1, 1))
+    patch_coords[:, 0] += np.repeat(np.arange(original_shape[0]), len(coords))[:, None]
+    return patch_coords
+
 
 def load_data_classification(data_dir, patch_shape, convert_to_rgb=True, expected_classes=None, cross_val=False, cross_val_nsplits=5, cross_val_fold=1, 
     val_split=0.1, seed=0, shuffle_val=True):
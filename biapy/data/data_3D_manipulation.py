@@ -1,7 +1,9 @@
 import math
 import os
+import hashlib
 import h5py
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from skimage.io import imread
 from tqdm import tqdm
 from sklearn.model_selection import train_test_split, StratifiedKFold
@@ -339,7 +341,7 @@ def load_and_prepare_3D_data(train_path, train_mask_path, cross_val=False, cross
 
 def load_and_prepare_3D_efficient_format_data(train_path, train_mask_path, input_img_axes, input_mask_axes=None, cross_val=False, 
     cross_val_nsplits=5, cross_val_fold=1, val_split=0.1, seed=0, shuffle_val=True, crop_shape=(80, 80, 80, 1), y_upscaling=(1,1,1), 
-    ov=(0,0,0), padding=(0,0,0), minimum_foreground_perc=-1):
+    ov=(0,0,0), padding=(0,0,0), minimum_foreground_perc=-1, cache_dir=None):
     """
     Load train and validation images from the given paths to create 3D data.
 
@@ -391,6 +393,9 @@ def load_and_prepare_3D_efficient_format_data(train_path, train_mask_path, input
     minimum_foreground_perc : float, optional
         Minimum percetnage of foreground that a sample need to have no not be discarded. 
 
+    cache_dir : str, optional
+        Directory to cache the patch coordinates of each Zarr/H5 sample. See :func:`~load_3D_efficient_files`.
+
     Returns
     -------
     X_train : 5D Numpy array
@@ -415,7 +420,8 @@ def load_and_prepare_3D_efficient_format_data(train_path, train_mask_path, input
         create_val = False
 
     print("0) Loading train image information . . .")
-    X_train, X_train_total_patches = load_3D_efficient_files(train_path, input_img_axes, crop_shape, ov, padding)
+    X_train, X_train_total_patches = load_3D_efficient_files(train_path, input_img_axes, crop_shape, ov, padding, 
+        cache_dir=cache_dir)
 
     if train_mask_path is not None:
         if input_mask_axes is None:
@@ -424,7 +430,7 @@ def load_and_prepare_3D_efficient_format_data(train_path, train_mask_path, input
         print("0) Loading train GT information . . .")
         scrop = (crop_shape[0]*y_upscaling[0], crop_shape[1]*y_upscaling[1], crop_shape[2]*y_upscaling[2], crop_shape[3])
         Y_train, Y_train_total_patches = load_3D_efficient_files(train_mask_path, input_mask_axes, scrop, ov, padding, 
-            check_channel=False)
+            check_channel=False, cache_dir=cache_dir)
 
         for i in range(len(Y_train_total_patches)):
             if Y_train_total_patches[i] != X_train_total_patches[i]:
@@ -437,27 +443,21 @@ def load_and_prepare_3D_efficient_format_data(train_path, train_mask_path, input
 
         X_train_remove = []
         samples_discarded = 0
-        last_data_file = {}
+        last_data_file = None
 
         for i in tqdm(range(len(Y_train)), leave=False, disable=not is_main_process()):
             data_info = Y_train[i]
 
-            if 'filepath' not in last_data_file or last_data_file['filepath'] != data_info['filepath']:
-                if 'filepath' in last_data_file and isinstance(file, h5py.File):
+            if last_data_file != data_info['filepath']:
+                if last_data_file is not None and isinstance(file, h5py.File):
                     file.close()
                 file, data = read_chunked_data(data_info['filepath'])
-                last_data_file = data_info.copy()
+                last_data_file = data_info['filepath']
 
             # Prepare slices to extract the patch
-            slices = []
-            for j in range(len(data_info['patch_coords'])):
-                if isinstance(data_info['patch_coords'][j], int):
-                    # +1 to prevent 0 length axes that can not be removed with np.squeeze later
-                    slices.append(slice(data_info['patch_coords'][j]+1)) 
-                else:
-                    slices.append(slice(data_info['patch_coords'][j][0],data_info['patch_coords'][j][1]))
+            slices = tuple(slice(start, end) for start, end in data_info['patch_coords'])
 
-            img = np.array(data[tuple(slices)])
+            img = np.array(data[slices])
             labels, npixels = np.unique((img>0).astype(np.uint8), return_counts=True)
 
             discard = False
@@ -480,12 +480,8 @@ def load_and_prepare_3D_efficient_format_data(train_path, train_mask_path, input
                 "reduce its value.")
 
         # Remove samples 
-        for i in X_train_remove:
-            del X_train[i], Y_train[i]
-
-        # Rearrange ids 
-        X_train = {c:v[1] for c,v in enumerate(X_train.items())}
-        Y_train = {c:v[1] for c,v in enumerate(Y_train.items())}
+        X_train = np.delete(X_train, X_train_remove)
+        Y_train = np.delete(Y_train, X_train_remove)
 
         print("{} samples discarded!".format(samples_discarded)) 
         print("*** Remaining data samples: {}".format(len(X_train)))   
@@ -573,9 +569,10 @@ def load_and_prepare_3D_efficient_format_data(train_path, train_mask_path, input
             print("*** Loaded train GT shape is: {}".format(yshape))
         return X_train, Y_train
 
-def load_3D_efficient_files(data_path, input_axes, crop_shape, overlap, padding, check_channel=True):
+def load_3D_efficient_files(data_path, input_axes, crop_shape, overlap, padding, check_channel=True, cache_dir=None):
     """
-    Load information of all patches that can be extracted from all the Zarr/H5 samples in ``data_path``.
+    Load information of all patches that can be extracted from all the Zarr/H5 samples in ``data_path``. Only the 
+    shape of each sample is read, as the patch grid is calculated with :func:`~extract_3D_patch_coords_with_overlap`.
 
     Parameters
     ----------
@@ -597,69 +594,149 @@ def load_3D_efficient_files(data_path, input_axes, crop_shape, overlap, padding,
 
     check_channel : bool, optional
         Whether to check if the crop_shape channel matches with the loaded images' one. 
+
+    cache_dir : str, optional
+        Directory where the patch coordinates of each sample are cached. The cache of a sample is reused only if its path, 
+        modification time, shape, ``crop_shape``, ``overlap`` and ``padding`` do not change. Set it to ``None`` to 
+        disable the cache.
         
     Returns
     -------
-    data_info : dict
-        All patch info that can be extracted from all the Zarr/H5 samples in ``data_path``.
+    data_info : Numpy structured array
+        All patch info that can be extracted from all the Zarr/H5 samples in ``data_path``. Each element has a 
+        ``filepath`` and a ``patch_coords`` field. The latter contains a ``[start, end]`` pair for each axis 
+        in ``input_axes`` order. E.g. ``data_info[0]['patch_coords'] = [[0, 20], [0, 128], [0, 128], [0, 1]]``.
 
     data_info_total_patches : List of ints
         Amount of patches extracted from each sample in ``data_path``.
     """
-    data_info = {}
+    data_info = []
     data_total_patches = []
-    c = 0
     assert len(crop_shape) == 4, f"Provided crop_shape is not a 4D tuple: {crop_shape}"
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
 
     for i, filename in enumerate(data_path):
         print(f"Reading Zarr/H5 file: {filename}")
         file, data = read_chunked_data(filename)
+        data_shape = data.shape
+        if isinstance(file, h5py.File):
+            file.close()
 
         # Modify crop_shape with the channel
-        c_index = -1
-        try:
-            c_index = input_axes.index("C")
-            crop_shape = crop_shape[:-1]+(data.shape[c_index],)
-        except:
-            pass 
-
-        # Get the total patches so we can use tqdm so the user can see the time
-        obj = extract_3D_patch_with_overlap_yield(data, crop_shape, input_axes, overlap=overlap, padding=padding, 
-            total_ranks=1, rank=0, return_only_stats=True, verbose=True)
-        __unnamed_iterator = iter(obj)
-        while True:
-            try:
-                obj = next(__unnamed_iterator)
-            except StopIteration:  # StopIteration caught here without inspecting it
-                break 
-        del __unnamed_iterator                          
-        total_patches, z_vol_info, list_of_vols_in_z = obj
-
-        for obj in tqdm(extract_3D_patch_with_overlap_yield(data, crop_shape, input_axes, overlap=overlap, 
-            padding=padding, total_ranks=1, rank=0, verbose=False), total=total_patches, disable=not is_main_process()):
-            
-            img, patch_coords, _, _, _ = obj
-            
-            data_info[c] = {}
-            data_info[c]['filepath'] = filename
-            data_info[c]['patch_coords'] = order_dimensions(patch_coords, input_order="ZYX", output_order=input_axes, 
-                default_value=img.shape[c_index])
+        channels = data_shape[input_axes.index("C")] if "C" in input_axes else 1
+        if check_channel and crop_shape[-1] != channels:
+            raise ValueError("Channel of the patch size given {} does not correspond with the loaded image {}. "
+                "Please, check the channels of the images!".format(crop_shape[-1], channels))
+        crop_shape = crop_shape[:-1]+(channels,)
+
+        cache_file = None
+        if cache_dir is not None:
+            key = "{}-{}-{}-{}-{}-{}-{}".format(os.path.abspath(filename), os.path.getmtime(filename), data_shape, 
+                input_axes, tuple(crop_shape), tuple(overlap), tuple(padding))
+            cache_file = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest()+".npy")
+
+        if cache_file is not None and os.path.exists(cache_file):
+            print(f"Loading patch coordinates from cache: {cache_file}")
+            patch_coords = np.load(cache_file)
+        else:
+            patch_coords = extract_3D_patch_coords_with_overlap(data_shape, crop_shape, input_axes, overlap=overlap, 
+                padding=padding)
+            if cache_file is not None:
+                # Write to a temporal file first so an interrupted run never leaves a partial cache 
+                with open(cache_file+".tmp", 'wb') as f:
+                    np.save(f, patch_coords)
+                os.replace(cache_file+".tmp", cache_file)
+
+        info = np.zeros(len(patch_coords), dtype=[('filepath', object), ('patch_coords', np.int64, patch_coords.shape[1:])])
+        info['filepath'] = filename
+        info['patch_coords'] = patch_coords
+        data_info.append(info)
+        data_total_patches.append(len(patch_coords))
+    
+    return np.concatenate(data_info), data_total_patches
+
+def _patch_axis_coords(dim, vol, overlap, padding):
+    """Calculate the ``[start, end]`` pair of each patch position along an axis of size ``dim``, in the same way as 
+    :func:`~extract_3D_patch_with_overlap_yield` (some positions can be repeated)."""
+    ov = 1 if overlap == 0 else 1-overlap
+    padded_dim = dim+padding*2
+    step = int((vol-padding*2)*ov)
+    vols = math.ceil(dim/step)
+    last = 0 if vols == 1 else (((vols-1)*step)+vol)-padded_dim
+    ov_per_block = last//(vols-1) if vols > 1 else 0
+    step -= ov_per_block
+    last -= ov_per_block*(vols-1)
+
+    starts = np.arange(vols, dtype=np.int64)*step
+    starts[starts+vol >= padded_dim] -= last
+    return np.stack([starts, starts+vol-(padding*2)], axis=-1)
+
+def extract_3D_patch_coords_with_overlap(data_shape, vol_shape, axis_order, overlap=(0,0,0), padding=(0,0,0)):
+    """
+    Calculate the coordinates of all the patches that :func:`~extract_3D_patch_with_overlap_yield` would extract 
+    from data of shape ``data_shape``. No data is read so it is useful to index huge Zarr/H5 files.
 
-            c += 1 
+    Parameters
+    ----------
+    data_shape : Tuple of ints
+        Shape of the data to extract patches from, in ``axis_order``. E.g. ``(z, y, x, channels)``.
 
-            if check_channel and crop_shape[-1] != img.shape[-1]:
-                raise ValueError("Channel of the patch size given {} does not correspond with the loaded image {}. "
-                    "Please, check the channels of the images!".format(crop_shape[-1], img.shape[-1]))
+    vol_shape : 4D int tuple
+        Shape of the patches to create. E.g. ``(z, y, x, channels)``.
 
-        if isinstance(file, h5py.File):
-            file.close()
-            
-        data_total_patches.append(total_patches)
+    axis_order : str
+        Order of axes of ``data_shape``. One between ['TZCYX', 'TZYXC', 'ZCYX', 'ZYXC'].
+
+    overlap : Tuple of 3 floats, optional
+        Amount of minimum overlap on x, y and z dimensions. The values must be on range ``[0, 1)``, that is, ``0%``
+        or ``99%`` of overlap. E.g. ``(z, y, x)``.
+        
+    padding : tuple of ints, optional
+        Size of padding to be added on each axis ``(z, y, x)``. E.g. ``(24, 24, 24)``.
+
+    Returns
+    -------
+    patch_coords : 3D Numpy array
+        ``[start, end]`` pair of each axis in ``axis_order`` for each patch. E.g. ``(num_patches, 4, 2)`` for ``'ZYXC'``. 
+        Spatial axes follow the ``real_patch_in_data`` of :func:`~extract_3D_patch_with_overlap_yield`, time axis is 
+        set to ``[0, 1]`` and channel axis to ``[0, channels]``.
+    """
+    if len(vol_shape) != 4:
+        raise ValueError("vol_shape expected to be of length 4, given {}".format(vol_shape))
+    if (overlap[0] >= 1 or overlap[0] < 0) or (overlap[1] >= 1 or overlap[1] < 0) or (overlap[2] >= 1 or overlap[2] < 0):
+        raise ValueError("'overlap' values must be floats between range [0, 1)")
+
+    t_dim, z_dim, c_dim, y_dim, x_dim = order_dimensions(data_shape, axis_order)
     
-    return data_info, data_total_patches
+    axis_coords = []
+    for i, dim in enumerate([z_dim, y_dim, x_dim]):
+        if vol_shape[i] > dim:
+            raise ValueError("'vol_shape[{}]' {} greater than {} (you can reduce 'DATA.PATCH_SIZE')"
+                .format(i, vol_shape[i], dim))
+        if padding[i] > 0 and padding[i] >= vol_shape[i]//2:
+            raise ValueError("'Padding' can not be greater than the half of 'vol_shape'. Max value for this {} input shape is {}"
+                .format(data_shape, [(vol_shape[0]//2)-1,(vol_shape[1]//2)-1,(vol_shape[2]//2)-1]))
+
+        axis_coords.append(_patch_axis_coords(dim, vol_shape[i], overlap[i], padding[i]))
+
+    # Patches are ordered as in extract_3D_patch_with_overlap_yield, i.e. x changes first, then y and then z
+    z, y, x = np.meshgrid(*[np.arange(len(a)) for a in axis_coords], indexing='ij')
+    zyx_coords = [axis_coords[0][z.ravel()], axis_coords[1][y.ravel()], axis_coords[2][x.ravel()]]
+    n_patches = len(zyx_coords[0])
+
+    patch_coords = np.zeros((n_patches, len(axis_order), 2), dtype=np.int64)
+    for i, axis in enumerate(axis_order):
+        if axis in "ZYX":
+            patch_coords[:,i] = zyx_coords["ZYX".index(axis)]
+        elif axis == "C":
+            patch_coords[:,i] = [0, c_dim]
+        else:
+            patch_coords[:,i] = [0, 1]
+    return patch_coords
 
 def crop_3D_data_with_overlap(data, vol_shape, data_mask=None, overlap=(0,0,0), padding=(0,0,0), verbose=True,
-    median_padding=False):
+    median_padding=False, lazy=False):
     """Crop 3D data into smaller volumes with a defined overlap. The opposite function is :func:`~merge_3D_data_with_overlap`.
 
        Parameters
@@ -686,12 +763,16 @@ def crop_3D_data_with_overlap(data, vol_shape, data_mask=None, overlap=(0,0,0),
        median_padding : bool, optional
            If ``True`` the padding value is the median value. If ``False``, the added values are zeroes.
 
+       lazy : bool, optional
+           Instead of copying all the patches into a new array return a :class:`~PatchSequence` that extracts 
+           them from the padded data only when they are requested. 
+
        Returns
        -------
-       cropped_data : 5D Numpy array
+       cropped_data : 5D Numpy array or PatchSequence
            Cropped image data. E.g. ``(vol_number, z, y, x, channels)``.
 
-       cropped_data_mask : 5D Numpy array, optional
+       cropped_data_mask : 5D Numpy array or PatchSequence, optional
            Cropped image data masks. E.g. ``(vol_number, z, y, x, channels)``.
 
        Examples
@@ -816,9 +897,12 @@ def crop_3D_data_with_overlap(data, vol_shape, data_mask=None, overlap=(0,0,0),
         print("{} patches per (z,y,x) axis".format((vols_per_z,vols_per_x,vols_per_y)))
     
     total_vol = vols_per_z*vols_per_y*vols_per_x
-    cropped_data = np.zeros((total_vol,) + padded_vol_shape, dtype=data.dtype)
-    if data_mask is not None:
-        cropped_data_mask = np.zeros((total_vol,) + padded_vol_shape[:3]+(data_mask.shape[-1],), dtype=data_mask.dtype)
+    if lazy:
+        starts = np.zeros((total_vol, 3), dtype=np.int64)
+    else:
+        cropped_data = np.zeros((total_vol,) + padded_vol_shape, dtype=data.dtype)
+        if data_mask is not None:
+            cropped_data_mask = np.zeros((total_vol,) + padded_vol_shape[:3]+(data_mask.shape[-1],), dtype=data_mask.dtype)
 
     c = 0
     for z in range(vols_per_z):
@@ -828,6 +912,11 @@ def crop_3D_data_with_overlap(data, vol_shape, data_mask=None, overlap=(0,0,0),
                 d_y = 0 if (y*step_y+vol_shape[1]) < padded_data.shape[1] else last_y
                 d_x = 0 if (x*step_x+vol_shape[2]) < padded_data.shape[2] else last_x
 
+                if lazy:
+                    starts[c] = [z*step_z-d_z, y*step_y-d_y, x*step_x-d_x]
+                    c += 1
+                    continue
+
                 cropped_data[c] = padded_data[z*step_z-d_z:z*step_z+vol_shape[0]-d_z,
                                               y*step_y-d_y:y*step_y+vol_shape[1]-d_y,
                                               x*step_x-d_x:x*step_x+vol_shape[2]-d_x]
@@ -837,6 +926,11 @@ def crop_3D_data_with_overlap(data, vol_shape, data_mask=None, overlap=(0,0,0),
                                                             x*step_x-d_x:x*step_x+vol_shape[2]-d_x]
                 c += 1
 
+    if lazy:
+        cropped_data = PatchSequence(padded_data, starts, vol_shape[:3])
+        if data_mask is not None:
+            cropped_data_mask = PatchSequence(padded_data_mask, starts, vol_shape[:3])
+
     if verbose:
         print("**** New data shape is: {}".format(cropped_data.shape))
         print("### END 3D-OV-CROP ###")
@@ -847,7 +941,61 @@ def crop_3D_data_with_overlap(data, vol_shape, data_mask=None, overlap=(0,0,0),
         return cropped_data
 
 
-def merge_3D_data_with_overlap(data, orig_vol_shape, data_mask=None, overlap=(0,0,0), padding=(0,0,0), verbose=True):
+class PatchSequence:
+    """
+    Patches of a volume extracted on demand. It is returned by :func:`~crop_3D_data_with_overlap` when ``lazy=True``
+    so only the padded volume is kept in memory instead of all the (overlapping) patches. It can be indexed as 
+    the 5D array that would have been created otherwise: an integer returns a view of the patch, ``(z, y, x, channels)``,
+    while a slice or a list of indexes returns a new array with those patches stacked, ``(num_patches, z, y, x, channels)``.
+
+    Parameters
+    ----------
+    data : 4D Numpy array
+        Padded data to extract the patches from. E.g. ``(z, y, x, channels)``.
+
+    starts : 2D Numpy array
+        Start coordinate of each patch in ``data``. E.g. ``(num_patches, 3)``.
+
+    patch_shape : 3 int tuple
+        Shape of the patches. E.g. ``(z, y, x)``.
+    """
+    def __init__(self, data, starts, patch_shape):
+        self.data = data
+        self.starts = starts
+        self.patch_shape = tuple(patch_shape)
+
+    @property
+    def shape(self):
+        return (len(self.starts),) + self.patch_shape + (self.data.shape[-1],)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            z, y, x = self.starts[idx]
+            return self.data[z:z+self.patch_shape[0], y:y+self.patch_shape[1], x:x+self.patch_shape[2]]
+        if isinstance(idx, slice):
+            idx = range(*idx.indices(len(self)))
+        out = np.empty((len(idx),) + self.shape[1:], dtype=self.data.dtype)
+        for i, j in enumerate(idx):
+            out[i] = self[int(j)]
+        return out
+
+    def __array__(self, dtype=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
+
+def merge_3D_data_with_overlap(data, orig_vol_shape, data_mask=None, overlap=(0,0,0), padding=(0,0,0), verbose=True,
+    blending="uniform"):
     """Merge 3D subvolumes in a 3D volume with a defined overlap.
 
        The opposite function is :func:`~crop_3D_data_with_overlap`.
@@ -874,6 +1022,11 @@ def merge_3D_data_with_overlap(data, orig_vol_shape, data_mask=None, overlap=(0,
        verbose : bool, optional
             To print information about the crop to be made.
 
+       blending : str, optional
+           How to weight the overlapping areas. ``'uniform'`` averages all the patches equally whereas ``'spline'`` 
+           weights each patch with a spline window (see :func:`~biapy.data.post_processing.smooth_tiled_predictions._window_3D`),
+           so the pixels close to the patch borders contribute less.
+
        Returns
        -------
        merged_data : 4D Numpy array
@@ -924,6 +1077,8 @@ def merge_3D_data_with_overlap(data, orig_vol_shape, data_mask=None, overlap=(0,
 
     if (overlap[0] >= 1 or overlap[0] < 0) or (overlap[1] >= 1 or overlap[1] < 0) or (overlap[2] >= 1 or overlap[2] < 0):
         raise ValueError("'overlap' values must be floats between range [0, 1)")
+    if blending not in ["uniform", "spline"]:
+        raise ValueError("'blending' must be one between ['uniform', 'spline']")
 
     if verbose:
         print("### MERGE-3D-OV-CROP ###")
@@ -943,7 +1098,13 @@ def merge_3D_data_with_overlap(data, orig_vol_shape, data_mask=None, overlap=(0,
                               padding[1]:data_mask.shape[2]-padding[1],
                               padding[2]:data_mask.shape[3]-padding[2], :]
         merged_data_mask = np.zeros(orig_vol_shape[:3]+(data_mask.shape[-1],), dtype=np.float32)
-    ov_map_counter = np.zeros((orig_vol_shape[:-1]+(1,)), dtype=np.uint16)
+    if blending == "spline":
+        from biapy.data.post_processing.smooth_tiled_predictions import _window_3D
+        window = _window_3D(data.shape[1:4])
+        ov_map_counter = np.zeros((orig_vol_shape[:-1]+(1,)), dtype=np.float32)
+    else:
+        window = 1
+        ov_map_counter = np.zeros((orig_vol_shape[:-1]+(1,)), dtype=np.uint16)
 
     # Calculate overlapping variables
     overlap_z = 1 if overlap[0] == 0 else 1-overlap[0]
@@ -997,16 +1158,16 @@ def merge_3D_data_with_overlap(data, orig_vol_shape, data_mask=None, overlap=(0,
 
                 merged_data[z*step_z-d_z:(z*step_z)+data.shape[1]-d_z,
                             y*step_y-d_y:y*step_y+data.shape[2]-d_y,
-                            x*step_x-d_x:x*step_x+data.shape[3]-d_x] += data[c]
+                            x*step_x-d_x:x*step_x+data.shape[3]-d_x] += data[c]*window
 
                 if data_mask is not None:
                     merged_data_mask[z*step_z-d_z:(z*step_z)+data.shape[1]-d_z,
                                      y*step_y-d_y:y*step_y+data.shape[2]-d_y,
-                                     x*step_x-d_x:x*step_x+data.shape[3]-d_x] += data_mask[c]
+                                     x*step_x-d_x:x*step_x+data.shape[3]-d_x] += data_mask[c]*window
 
                 ov_map_counter[z*step_z-d_z:(z*step_z)+data.shape[1]-d_z,
                                y*step_y-d_y:y*step_y+data.shape[2]-d_y,
-                               x*step_x-d_x:x*step_x+data.shape[3]-d_x] += 1
+                               x*step_x-d_x:x*step_x+data.shape[3]-d_x] += window
                 c += 1
 
     merged_data = np.true_divide(merged_data, ov_map_counter).astype(data.dtype)
@@ -1021,8 +1182,201 @@ def merge_3D_data_with_overlap(data, orig_vol_shape, data_mask=None, overlap=(0,
     else:
         return merged_data
 
+class StreamingPatchMerger:
+    """
+    Merge patches into a volume as soon as they are available, instead of stacking all of them first as 
+    :func:`~merge_3D_data_with_overlap` and :func:`~biapy.data.data_2D_manipulation.merge_data_with_overlap` do. 
+    Only the merged volume and one weight volume are kept in memory.
+
+    Parameters
+    ----------
+    out_shape : 4D int tuple
+        Shape of the merged volume. E.g. ``(z, y, x, channels)``. For 2D images the first axis is the number of 
+        images, e.g. ``(num_of_images, y, x, channels)``.
+
+    patch_shape : 3D int tuple
+        Shape of the patches, without padding nor channels. E.g. ``(z, y, x)``. For 2D images use ``(1, y, x)``.
+
+    padding : tuple of 3 ints, optional
+        Padding of each patch ``(z, y, x)`` that is removed before merging it. E.g. ``(24, 24, 24)``.
+
+    blending : str, optional
+        How to weight the overlapping areas. ``'uniform'`` averages all the patches equally whereas ``'spline'`` 
+        weights each patch with a spline window.
+
+    Examples
+    --------
+    ::
+
+        coords = extract_3D_patch_coords_with_overlap(orig_vol_shape, patch_shape, "ZYXC", overlap=overlap, padding=padding)
+        merger = StreamingPatchMerger(orig_vol_shape, patch_shape[:-1], padding=padding, blending="spline")
+        for i in range(len(coords)):
+            merger.add(model(patches[i]), coords[i,:3])
+        merged_data = merger.result()
+    """
+    def __init__(self, out_shape, patch_shape, padding=(0,0,0), blending="uniform"):
+        if blending not in ["uniform", "spline"]:
+            raise ValueError("'blending' must be one between ['uniform', 'spline']")
+        self.padding = padding
+        self.merged_data = np.zeros(out_shape, dtype=np.float32)
+        if blending == "spline":
+            from biapy.data.post_processing.smooth_tiled_predictions import _window_3D
+            self.window = _window_3D(patch_shape)
+            self.weights = np.zeros(out_shape[:-1]+(1,), dtype=np.float32)
+        else:
+            self.window = None
+            self.weights = np.zeros(out_shape[:-1]+(1,), dtype=np.uint16)
+
+    def add(self, patch, coords):
+        """
+        Merge a patch. 
+
+        Parameters
+        ----------
+        patch : 4D Numpy array
+            Patch to merge, with padding. E.g. ``(z, y, x, channels)``. For 2D images ``(y, x, channels)`` is also valid.
+
+        coords : List of 3 lists of ints
+            Coordinates of the patch in the merged volume without padding. E.g. ``[[0, 20], [0, 8], [16, 24]]`` 
+            means that the patch is placed in ``[0:20,0:8,16:24]``.
+        """
+        if patch.ndim == 3:
+            patch = np.expand_dims(patch, 0)
+        patch = patch[self.padding[0]:patch.shape[0]-self.padding[0],
+                      self.padding[1]:patch.shape[1]-self.padding[1],
+                      self.padding[2]:patch.shape[2]-self.padding[2]]
+        slices = tuple(slice(start, end) for start, end in coords)
+        if self.window is None:
+            self.merged_data[slices] += patch
+            self.weights[slices] += 1
+        else:
+            self.merged_data[slices] += patch*self.window
+            self.weights[slices] += self.window
+
+    def result(self, dtype=np.float32):
+        """
+        Finish the merge. The object can not be used anymore after calling this method.
+
+        Parameters
+        ----------
+        dtype : Numpy dtype, optional
+            Data type of the merged data.
+
+        Returns
+        -------
+        merged_data : 4D Numpy array
+            Merged data. E.g. ``(z, y, x, channels)``.
+        """
+        np.true_divide(self.merged_data, self.weights, out=self.merged_data)
+        merged_data = self.merged_data.astype(dtype, copy=False)
+        del self.merged_data, self.weights
+        return merged_data
+
+class SlabPatchAccumulator:
+    """
+    Accumulate the patches, as :func:`~extract_3D_patch_with_overlap_yield` yields them, into an in-memory slab of 
+    the volume (whole ``Y`` and ``X`` axes) and write each part of the slab into a H5/Zarr dataset, already divided by 
+    the overlap count, as soon as no more patches can contribute to it. 
+
+    The patches are placed in a grid, so the overlap count of each voxel is the product of the number of patch 
+    positions (repeated ones included) that cover its coordinate in each axis and no count volume is needed. The slab 
+    is written in regions aligned to the ``Z`` chunks of the dataset (except the first and the last ones), so each 
+    chunk is written once and never read back. 
+
+    Parameters
+    ----------
+    data : H5 dataset or Zarr array
+        Dataset to write into.
+
+    data_order : str
+        Order of the axes of ``data``. E.g. ``'ZYXC'`` or ``'TZCYX'``. The data is written in ``T`` position ``0``.
+
+    chunk_z : int
+        Size of the chunks of ``data`` in ``Z``.
+
+    axis_coords : List of 3 2D Numpy arrays
+        ``[start, end]`` pair of each patch position that will be added in ``Z``, ``Y`` and ``X`` axes, repeated 
+        positions included. E.g. ``[array([[0, 20], [10, 30]]), array([[0, 8]]), array([[0, 8], [8, 16]])]``.
+    """
+    def __init__(self, data, data_order, chunk_z, axis_coords):
+        self.data = data
+        self.data_order = data_order
+        self.chunk_z = chunk_z
+        self.data_shape = tuple(order_dimensions(data.shape, input_order=data_order, output_order="ZYXC"))
+        self.counts = [np.zeros(dim, dtype=np.float32) for dim in self.data_shape[:3]]
+        for i, coords in enumerate(axis_coords):
+            for start, end in coords:
+                self.counts[i][start:end] += 1
+
+        # Patches left to be added of each row in Z (rows placed in the same position are merged)
+        self.remaining = {}
+        for start, end in axis_coords[0]:
+            self.remaining[(int(start), int(end))] = self.remaining.get((int(start), int(end)), 0) \
+                + len(axis_coords[1])*len(axis_coords[2])
+        self.slab_start = int(min(axis_coords[0][:,0]))
+        self.slab = np.zeros((0,)+self.data_shape[1:], dtype=np.float32)
+
+        current_order = np.array(range(4))
+        transpose_order = order_dimensions(current_order, input_order="ZYXC", output_order=data_order,
+            default_value=np.nan)
+        self.transpose_order = [x for x in transpose_order if not np.isnan(x)]
+
+    def add(self, patch, coords):
+        """
+        Add a patch. 
+
+        Parameters
+        ----------
+        patch : 4D Numpy array
+            Patch to add, without padding. E.g. ``(z, y, x, channels)``.
+
+        coords : List of 3 lists of ints
+            Coordinates of the patch in the volume. E.g. ``[[0, 20], [0, 8], [16, 24]]`` means that the patch is 
+            placed in ``[0:20,0:8,16:24]``.
+        """
+        (z_start, z_end), (y_start, y_end), (x_start, x_end) = coords
+        z_row = (int(z_start), int(z_end))
+        if self.remaining.get(z_row, 0) == 0:
+            raise ValueError("Patch placed in {} not expected or already added".format(coords))
+
+        if self.slab_start+len(self.slab) < z_end:
+            self.slab = np.concatenate([self.slab, 
+                np.zeros((z_end-self.slab_start-len(self.slab),)+self.slab.shape[1:], dtype=np.float32)])
+        self.slab[z_start-self.slab_start:z_end-self.slab_start, y_start:y_end, x_start:x_end] += patch
+
+        # The planes before the first row with patches left are complete
+        self.remaining[z_row] -= 1
+        if self.remaining[z_row] == 0:
+            del self.remaining[z_row]
+            if len(self.remaining) > 0:
+                z_start = min([start for start, _ in self.remaining])
+                self._write(max(self.slab_start, (z_start//self.chunk_z)*self.chunk_z))
+
+    def _write(self, z_end):
+        """Divide by the overlap count and write the slab planes until ``z_end``."""
+        n = z_end-self.slab_start
+        if n <= 0:
+            return
+        count = self.counts[0][self.slab_start:z_end,None,None,None]*self.counts[1][None,:,None,None] \
+            *self.counts[2][None,None,:,None]
+        slab = self.slab[:n]/np.maximum(count, 1)
+
+        slices = (slice(self.slab_start, z_end), slice(None), slice(None), slice(None))
+        data_ordered_slices = tuple(order_dimensions(slices, input_order="ZYXC", output_order=self.data_order,
+            default_value=0))
+        self.data[data_ordered_slices] = slab.transpose(self.transpose_order)
+        self.slab = self.slab[n:]
+        self.slab_start = z_end
+
+    def finish(self):
+        """
+        Write the remaining part of the slab. The object can not be used anymore after calling this method.
+        """
+        self._write(self.slab_start+len(self.slab))
+        del self.slab
+
 def extract_3D_patch_with_overlap_yield(data, vol_shape, axis_order, overlap=(0,0,0), padding=(0,0,0), total_ranks=1, 
-    rank=0, return_only_stats=False, verbose=False):
+    rank=0, return_only_stats=False, max_slab_mb=2048, work_queue=None, verbose=False):
     """
     Extract 3D patches into smaller patches with a defined overlap. Is supports multi-GPU inference
     by setting ``total_ranks`` and ``rank`` variables. Each GPU will process a evenly number of 
@@ -1058,6 +1412,18 @@ def extract_3D_patch_with_overlap_yield(data, vol_shape, axis_order, overlap=(0,
         To just return the crop statistics without yielding any patch. Useful to precalculate how many patches
         are going to be created before doing it. 
 
+    max_slab_mb : int, optional
+        Maximum size, in MB, of the region of ``data`` read at once. The patches are cut from slabs of ``data`` 
+        that contain all the patches of the same ``Z`` position, and the slab is divided along ``Y`` if it exceeds this
+        size. The next slab is read in background while the patches of the current one are yielded. Set it to ``-1``
+        to always read entire slabs. 
+
+    work_queue : callable, optional
+        Function that returns the id of the next slab (see ``max_slab_mb``) to extract, shared between all the ranks 
+        so each slab is extracted by the first rank that asks for it. The extraction finishes when the id returned is 
+        greater or equal to the number of slabs. When used, ``total_ranks`` and ``rank`` are not used to split the 
+        volumes in ``Z`` and ``owned_in_data`` is yielded instead of the stats of the crop. 
+
     verbose : bool, optional
         To print useful information for debugging. 
 
@@ -1085,6 +1451,16 @@ def extract_3D_patch_with_overlap_yield(data, vol_shape, axis_order, overlap=(0,
         Volumes in ``Z`` axis that each GPU will process. E.g. ``[[0, 1, 2], [3, 4]]`` means that
         the first GPU will process volumes ``0``, ``1`` and ``2`` (``3`` in total) whereas the second 
         GPU will process volumes ``3`` and ``4``. 
+
+    chunk_shape : Tuple of 3 ints, optional
+        Shape, in ``(z, y, x)``, of the chunks that ``owned_in_data`` regions are aligned to. Only yielded with 
+        ``return_only_stats``.
+
+    owned_in_data : Tuple of tuples of ints, optional
+        Part of ``real_patch_in_data`` that only this patch fills. The data is divided in chunks of ``chunk_shape``
+        (as large as possible up to the distance between patches) and each chunk is assigned to the last patch 
+        that contains it, so the regions of all the patches are disjoint and chunk aligned. The patches without 
+        any chunk assigned are not yielded. Only yielded with ``work_queue``. 
     """
     if rank == 0:
         print("### 3D-OV-CROP ###")
@@ -1179,81 +1555,127 @@ def extract_3D_patch_with_overlap_yield(data, vol_shape, axis_order, overlap=(0,
         print("Rank {}: Total number of patches: {} - {} patches per (z,y,x) axis (per GPU)"
             .format(rank, total_vol, (vols_per_z_per_rank,vols_per_x,vols_per_y)))
 
+    # Start of each patch in the padded data
+    def _patch_start(i, step, last, vol, padded_dim):
+        return i*step - (0 if (i*step+vol) < padded_dim else last)
+    def _z_start(z): return _patch_start(z, step_z, last_z, vol_shape[0], padded_data_shape[0])
+    def _y_start(y): return _patch_start(y, step_y, last_y, vol_shape[1], padded_data_shape[1])
+    def _x_start(x): return _patch_start(x, step_x, last_x, vol_shape[2], padded_data_shape[2])
+
+    def _ownership(n, patch_start, core, dim):
+        """Divide the axis into chunks, as large as possible up to the step, that are entirely inside the real part 
+        of a patch and assign each chunk to the last patch that contains it."""
+        starts = np.array([patch_start(i) for i in range(n)])
+        for chunk in range(max(1, starts[1]-starts[0] if n > 1 else dim), 0, -1):
+            chunk_starts = np.arange(0, dim, chunk)
+            owner = np.searchsorted(starts, chunk_starts, side='right')-1
+            if np.all(starts[owner]+core >= np.minimum(dim, chunk_starts+chunk)):
+                break
+        owned = []
+        for i in range(n):
+            own = chunk_starts[owner == i]
+            owned.append([int(own[0]), int(min(dim, own[-1]+chunk))] if len(own) > 0 else None)
+        return chunk, owned
+
+    if return_only_stats or work_queue is not None:
+        ownership = [_ownership(n, f, v-2*p, dim) for n, f, v, p, dim in zip((vols_per_z, vols_per_y, vols_per_x), 
+            (_z_start, _y_start, _x_start), vol_shape, padding, (z_dim, y_dim, x_dim))]
+        chunk_shape = tuple(x[0] for x in ownership)
+
     if return_only_stats:
-        yield total_vol, z_vol_info, list_of_vols_in_z
+        yield total_vol, z_vol_info, list_of_vols_in_z, chunk_shape
         return
 
-    for _z in range(vols_per_z_per_rank):
-        z = list_of_vols_in_z[rank][0]+_z
-        for y in range(vols_per_y):
-            for x in range(vols_per_x):
-                d_z = 0 if (z*step_z+vol_shape[0]) < padded_data_shape[0] else last_z
-                d_y = 0 if (y*step_y+vol_shape[1]) < padded_data_shape[1] else last_y
-                d_x = 0 if (x*step_x+vol_shape[2]) < padded_data_shape[2] else last_x
-
-                start_z = max(0, z*step_z-d_z-padding[0])
-                finish_z = min(z*step_z+vol_shape[0]-d_z-padding[0], z_dim)
-                start_y = max(0, y*step_y-d_y-padding[1])
-                finish_y = min(y*step_y+vol_shape[1]-d_y-padding[1], y_dim)
-                start_x = max(0, x*step_x-d_x-padding[2])
-                finish_x = min(x*step_x+vol_shape[2]-d_x-padding[2], x_dim)
-
-                slices = [
-                    slice(start_z, finish_z),
-                    slice(start_y, finish_y),
-                    slice(start_x, finish_x),
-                    slice(None), # Channel
-                ]
-
-                data_ordered_slices = order_dimensions(
-                    slices,
-                    input_order="ZYXC",
-                    output_order=axis_order,
-                    default_value=0)
-
-                img = data[tuple(data_ordered_slices)]
-
-                # The image should have the channel dimension at the end
-                current_order = np.array(range(len(img.shape)))
-                transpose_order = order_dimensions(
-                    current_order, #
-                    input_order="ZYXC",
-                    output_order=axis_order,
-                    default_value=np.nan)
-
-                # determine the transpose order
-                transpose_order = [x for x in transpose_order if not np.isnan(x)]
-                transpose_order = np.argsort(transpose_order)
-                transpose_order = current_order[transpose_order]
-
-                img = np.transpose(img, transpose_order)
-
-                pad_z_left = padding[0]-z*step_z-d_z if start_z <= 0 else 0
-                pad_z_right = (start_z+vol_shape[0])-z_dim if start_z+vol_shape[0] > z_dim else 0
-                pad_y_left = padding[1]-y*step_y-d_y if start_y <= 0 else 0
-                pad_y_right = (start_y+vol_shape[1])-y_dim if start_y+vol_shape[1] > y_dim else 0
-                pad_x_left = padding[2]-x*step_x-d_x if start_x <= 0 else 0
-                pad_x_right = (start_x+vol_shape[2])-x_dim if start_x+vol_shape[2] > x_dim else 0
-
-                if img.ndim == 3:
-                    img = np.pad(img,((pad_z_left,pad_z_right),(pad_y_left,pad_y_right),(pad_x_left,pad_x_right)), 'reflect')
-                    img = np.expand_dims(img, -1)
-                else:
-                    img = np.pad(img,((pad_z_left,pad_z_right),(pad_y_left,pad_y_right),(pad_x_left,pad_x_right),(0,0)), 'reflect')
-
-                assert img.shape[:-1] == vol_shape[:-1], f"Image shape and expected shape differ: {img.shape} vs {vol_shape}"
-                
-                real_patch_in_data = [
-                    [z*step_z-d_z,(z*step_z)+vol_shape[0]-d_z-(padding[0]*2)],
-                    [y*step_y-d_y,(y*step_y)+vol_shape[1]-d_y-(padding[1]*2)],
-                    [x*step_x-d_x,(x*step_x)+vol_shape[2]-d_x-(padding[2]*2)]
-                ]
-
-                if rank == 0:
-                    yield img, real_patch_in_data, total_vol, z_vol_info, list_of_vols_in_z
-                else:
-                    yield img, real_patch_in_data, total_vol
-
+    # Axes to move the channel to the end
+    current_order = np.array(range(len(data.shape) - (1 if "T" in axis_order else 0)))
+    transpose_order = order_dimensions(current_order, input_order="ZYXC", output_order=axis_order.replace("T", ""), 
+        default_value=np.nan)
+    transpose_order = [x for x in transpose_order if not np.isnan(x)]
+    transpose_order = current_order[np.argsort(transpose_order)]
+
+    def _read_block(z, y0, y1):
+        """Read the region that contains all the patches of row ``z`` between rows ``y0`` and ``y1`` and pad it."""
+        # The last patch of each axis is shifted back, so the starts are not always increasing
+        y_starts = [_y_start(y) for y in range(y0, y1)]
+        x_starts = [_x_start(x) for x in range(vols_per_x)]
+        starts = [_z_start(z), min(y_starts), min(x_starts)]
+        ends = [starts[0]+vol_shape[0], max(y_starts)+vol_shape[1], max(x_starts)+vol_shape[2]]
+        slices, pads = [], []
+        for s, e, p, dim in zip(starts, ends, padding, (z_dim, y_dim, x_dim)):
+            slices.append(slice(max(0, s-p), min(dim, e-p)))
+            pads.append((max(0, p-s), max(0, e-p-dim)))
+        data_ordered_slices = order_dimensions(slices+[slice(None)], input_order="ZYXC", output_order=axis_order, 
+            default_value=0)
+        block = np.transpose(np.asarray(data[tuple(data_ordered_slices)]), transpose_order)
+        nbytes = block.nbytes
+        if block.ndim == 3:
+            block = np.expand_dims(block, -1)
+        if any([p != (0,0) for p in pads]):
+            block = np.pad(block, pads+[(0,0)], 'reflect')
+        return block, starts, nbytes
+
+    # The data is read once per slab of patches in Z (divided in bands of rows in Y if it is larger than 
+    # 'max_slab_mb'), so the overlapping patches are cut from memory and each H5/Zarr chunk is only decompressed 
+    # once per slab. The next slab is read in background while the patches of the current one are yielded
+    row_bytes = vol_shape[0]*max(1, step_y)*x_dim*c_dim*np.dtype(data.dtype).itemsize
+    rows_per_block = vols_per_y if max_slab_mb <= 0 else int(min(vols_per_y, max(1, max_slab_mb*1024*1024//row_bytes)))
+    if work_queue is None:
+        blocks = iter([(list_of_vols_in_z[rank][0]+_z, y0, min(vols_per_y, y0+rows_per_block)) 
+            for _z in range(vols_per_z_per_rank) for y0 in range(0, vols_per_y, rows_per_block)])
+    else:
+        all_blocks = [(z, y0, min(vols_per_y, y0+rows_per_block)) for z in range(vols_per_z) 
+            for y0 in range(0, vols_per_y, rows_per_block)]
+        def _claim_blocks():
+            while True:
+                block_id = work_queue()
+                if block_id >= len(all_blocks):
+                    return
+                yield all_blocks[block_id]
+        blocks = _claim_blocks()
+
+    bytes_read, bytes_yielded, reads = 0, 0, 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_block = next(blocks, None)
+        future = executor.submit(_read_block, *next_block) if next_block is not None else None
+        while next_block is not None:
+            z, y0, y1 = next_block
+            block, block_start, nbytes = future.result()
+            bytes_read += nbytes
+            reads += 1
+            next_block = next(blocks, None)
+            if next_block is not None:
+                future = executor.submit(_read_block, *next_block)
+            for y in range(y0, y1):
+                for x in range(vols_per_x):
+                    if work_queue is not None:
+                        owned_in_data = [ownership[0][1][z], ownership[1][1][y], ownership[2][1][x]]
+                        if any([o is None for o in owned_in_data]):
+                            continue
+                    start_z, start_y, start_x = _z_start(z), _y_start(y), _x_start(x)
+                    img = block[start_z-block_start[0]:start_z-block_start[0]+vol_shape[0],
+                                start_y-block_start[1]:start_y-block_start[1]+vol_shape[1],
+                                start_x-block_start[2]:start_x-block_start[2]+vol_shape[2]].copy()
+
+                    assert img.shape[:-1] == vol_shape[:-1], f"Image shape and expected shape differ: {img.shape} vs {vol_shape}"
+                    bytes_yielded += img.nbytes
+
+                    real_patch_in_data = [
+                        [start_z,start_z+vol_shape[0]-(padding[0]*2)],
+                        [start_y,start_y+vol_shape[1]-(padding[1]*2)],
+                        [start_x,start_x+vol_shape[2]-(padding[2]*2)]
+                    ]
+
+                    if work_queue is not None:
+                        yield img, real_patch_in_data, owned_in_data
+                    elif rank == 0:
+                        yield img, real_patch_in_data, total_vol, z_vol_info, list_of_vols_in_z
+                    else:
+                        yield img, real_patch_in_data, total_vol
+            del block
+
+    if verbose or rank == 0:
+        print("Rank {}: {:.2f} MB read from the data in {} reads to yield {:.2f} MB of patches".format(rank, 
+            bytes_read/(1024*1024), reads, bytes_yielded/(1024*1024)))
 
 def load_3d_data_classification(data_dir, patch_shape, convert_to_rgb=False, expected_classes=None, cross_val=False, cross_val_nsplits=5, 
     cross_val_fold=1, val_split=0.1, seed=0, shuffle_val=True):
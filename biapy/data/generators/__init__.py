@@ -2,6 +2,8 @@ import os
 import torch
 import numpy as np
 from tqdm import tqdm
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from biapy.utils.util import save_tif
 from biapy.data.pre_processing import calculate_2D_volume_prob_map, calculate_3D_volume_prob_map, save_tif
@@ -11,6 +13,7 @@ from biapy.data.generators.single_data_2D_generator import Single2DImageDataGene
 from biapy.data.generators.single_data_3D_generator import Single3DImageDataGenerator
 from biapy.data.generators.test_pair_data_generators import test_pair_data_generator
 from biapy.data.generators.test_single_data_generator import test_single_data_generator
+from biapy.data.generators.torch_augmentors import TorchBatchAugmentor, BATCH_DA_OPTIONS
 
 
 def create_train_val_augmentors(cfg, X_train, Y_train, X_val, Y_val, world_size, global_rank, dist=False):
@@ -43,6 +46,15 @@ def create_train_val_augmentors(cfg, X_train, Y_train, X_val, Y_val, world_size,
 
     val_generator : Pair2DImageDataGenerator/Single2DImageDataGenerator (2D) or Pair3DImageDataGenerator/Single3DImageDataGenerator (3D)
         Validation data generator.
+
+    data_norm : dict
+        Normalization of the data.
+
+    num_training_steps_per_epoch : int
+        Number of training steps per epoch.
+
+    batch_augmentor : TorchBatchAugmentor
+        Data augmentation to apply to each training batch. ``None`` unless ``AUGMENTOR.BACKEND`` is ``'torch'``.
     """
 
     # Calculate the probability map per image
@@ -141,8 +153,8 @@ def create_train_val_augmentors(cfg, X_train, Y_train, X_val, Y_val, world_size,
     if cfg.DATA.TRAIN.IN_MEMORY:
         data_mode = "in_memory"
     else:
-        if cfg.PROBLEM.NDIM == '3D' and X_train is not None and isinstance(X_train, list) and isinstance(X_train[0], dict) and \
-            'filepath' in X_train[0] and ('.zarr' in X_train[0]['filepath'] or '.h5' in X_train[0]['filepath']):
+        if cfg.PROBLEM.NDIM == '3D' and X_train is not None and isinstance(X_train, np.ndarray) and X_train.dtype.names is not None and \
+            'filepath' in X_train.dtype.names and ('.zarr' in X_train[0]['filepath'] or '.h5' in X_train[0]['filepath']):
             data_mode = "chunked_data"
         else:
             data_mode = "not_in_memory"
@@ -209,6 +221,9 @@ def create_train_val_augmentors(cfg, X_train, Y_train, X_val, Y_val, world_size,
 
         if cfg.PROBLEM.NDIM == '3D':
             dic['zflip'] = cfg.AUGMENTOR.ZFLIP
+        if data_mode == "chunked_data":
+            dic['chunked_data_max_open_files'] = cfg.DATA.CHUNKED_DATA.MAX_OPEN_FILES
+            dic['chunked_data_cache_mb'] = cfg.DATA.CHUNKED_DATA.CACHE_MB
         if cfg.PROBLEM.TYPE == 'INSTANCE_SEG':
             dic['instance_problem'] = True
         elif cfg.PROBLEM.TYPE in ['SELF_SUPERVISED', 'SUPER_RESOLUTION']:
@@ -224,7 +239,17 @@ def create_train_val_augmentors(cfg, X_train, Y_train, X_val, Y_val, world_size,
             dic['n2v_neighborhood_radius'] = cfg.PROBLEM.DENOISING.N2V_NEIGHBORHOOD_RADIUS
             dic['n2v_structMask'] = np.array([[0,1,1,1,1,1,1,1,1,1,0]]) if cfg.PROBLEM.DENOISING.N2V_STRUCTMASK else None
 
+    # Leave to the batch augmentor the transformations it can apply to the whole batch
+    batch_da = cfg.AUGMENTOR.ENABLE and cfg.AUGMENTOR.BACKEND == 'torch'
+    if batch_da:
+        for k in BATCH_DA_OPTIONS:
+            if k in dic:
+                dic[k] = False
+        dic['da'] = any(dic[k] for k in ['median_blur', 'motion_blur', 'cutout', 'cutblur', 'cutmix', 'cutnoise',
+            'misalignment', 'missing_sections', 'grayscale', 'channel_shuffle', 'gridmask'])
+
     print("Initializing train data generator . . .")
+    train_da = dic['da']
     train_generator = f_name(**dic)
     data_norm = train_generator.get_data_normalization()
 
@@ -238,8 +263,8 @@ def create_train_val_augmentors(cfg, X_train, Y_train, X_val, Y_val, world_size,
         if cfg.DATA.VAL.IN_MEMORY:
             val_data_mode = "in_memory"
         else:
-            if cfg.PROBLEM.NDIM == '3D' and X_val is not None and isinstance(X_val, list) and isinstance(X_val[0], dict) and \
-                'filepath' in X_val[0] and ('.zarr' in X_val[0]['filepath'] or '.h5' in X_val[0]['filepath']):
+            if cfg.PROBLEM.NDIM == '3D' and X_val is not None and isinstance(X_val, np.ndarray) and X_val.dtype.names is not None and \
+                'filepath' in X_val.dtype.names and ('.zarr' in X_val[0]['filepath'] or '.h5' in X_val[0]['filepath']):
                 val_data_mode = "chunked_data"
             else:
                 val_data_mode = "not_in_memory"
@@ -258,6 +283,9 @@ def create_train_val_augmentors(cfg, X_train, Y_train, X_val, Y_val, world_size,
             random_crops_in_DA=cfg.DATA.EXTRACT_RANDOM_PATCH, val=True, n_classes=cfg.MODEL.N_CLASSES, 
             seed=cfg.SYSTEM.SEED, norm_dict=norm_dict, resolution=cfg.DATA.VAL.RESOLUTION, 
             random_crop_scale=cfg.PROBLEM.SUPER_RESOLUTION.UPSCALING)
+        if val_data_mode == "chunked_data":
+            dic['chunked_data_max_open_files'] = cfg.DATA.CHUNKED_DATA.MAX_OPEN_FILES
+            dic['chunked_data_cache_mb'] = cfg.DATA.CHUNKED_DATA.CACHE_MB
         if cfg.PROBLEM.TYPE == 'INSTANCE_SEG': 
             dic['instance_problem'] = True
         elif cfg.PROBLEM.TYPE in ['SELF_SUPERVISED', 'SUPER_RESOLUTION']:
@@ -275,7 +303,7 @@ def create_train_val_augmentors(cfg, X_train, Y_train, X_val, Y_val, world_size,
         val_generator = f_name(**dic)
 
     # Generate examples of data augmentation
-    if cfg.AUGMENTOR.AUG_SAMPLES and cfg.AUGMENTOR.ENABLE:
+    if cfg.AUGMENTOR.AUG_SAMPLES and cfg.AUGMENTOR.ENABLE and train_da:
         print("Creating generator samples . . .")
         train_generator.get_transformed_samples(
             cfg.AUGMENTOR.AUG_NUM_SAMPLES, save_to_dir=True, train=False, out_dir=cfg.PATHS.DA_SAMPLES,
@@ -297,8 +325,9 @@ def create_train_val_augmentors(cfg, X_train, Y_train, X_val, Y_val, world_size,
         train_generator, num_replicas=world_size, rank=global_rank, shuffle=True
     )    
     print("Sampler_train = %s" % str(sampler_train))
-    train_dataset = torch.utils.data.DataLoader(train_generator, sampler=sampler_train, batch_size=cfg.TRAIN.BATCH_SIZE,
-        num_workers=num_workers, pin_memory=cfg.SYSTEM.PIN_MEM, drop_last=False)
+    train_dataset = build_dataloader(train_generator, sampler_train, cfg.TRAIN.BATCH_SIZE, num_workers, pin_memory=cfg.SYSTEM.PIN_MEM, 
+        loader_type=cfg.SYSTEM.DATALOADER, persistent_workers=cfg.SYSTEM.PERSISTENT_WORKERS, 
+        prefetch_factor=cfg.SYSTEM.PREFETCH_FACTOR, worker_init_fn=chunked_data_worker_init_fn)
 
     # Validation dataset
     sampler_val = None
@@ -312,10 +341,36 @@ def create_train_val_augmentors(cfg, X_train, Y_train, X_val, Y_val, world_size,
     else:
         sampler_val = torch.utils.data.SequentialSampler(val_generator)
     
-    val_dataset = torch.utils.data.DataLoader(val_generator, sampler=sampler_val, batch_size=cfg.TRAIN.BATCH_SIZE, 
-        num_workers=num_workers, pin_memory=cfg.SYSTEM.PIN_MEM, drop_last=False)
+    val_dataset = build_dataloader(val_generator, sampler_val, cfg.TRAIN.BATCH_SIZE, num_workers, pin_memory=cfg.SYSTEM.PIN_MEM, 
+        loader_type=cfg.SYSTEM.DATALOADER, persistent_workers=cfg.SYSTEM.PERSISTENT_WORKERS, 
+        prefetch_factor=cfg.SYSTEM.PREFETCH_FACTOR, worker_init_fn=chunked_data_worker_init_fn)
+
+    batch_augmentor = None
+    if batch_da:
+        batch_augmentor = TorchBatchAugmentor(ndim=ndim, da_prob=cfg.AUGMENTOR.DA_PROB, rotation90=cfg.AUGMENTOR.ROT90,
+            rand_rot=cfg.AUGMENTOR.RANDOM_ROT, rnd_rot_range=cfg.AUGMENTOR.RANDOM_ROT_RANGE, shear=cfg.AUGMENTOR.SHEAR,
+            shear_range=cfg.AUGMENTOR.SHEAR_RANGE, zoom=cfg.AUGMENTOR.ZOOM, zoom_range=cfg.AUGMENTOR.ZOOM_RANGE,
+            shift=cfg.AUGMENTOR.SHIFT, shift_range=cfg.AUGMENTOR.SHIFT_RANGE, affine_mode=cfg.AUGMENTOR.AFFINE_MODE,
+            vflip=cfg.AUGMENTOR.VFLIP, hflip=cfg.AUGMENTOR.HFLIP, zflip=cfg.AUGMENTOR.ZFLIP, elastic=cfg.AUGMENTOR.ELASTIC,
+            e_alpha=cfg.AUGMENTOR.E_ALPHA, e_sigma=cfg.AUGMENTOR.E_SIGMA, e_mode=cfg.AUGMENTOR.E_MODE,
+            g_blur=cfg.AUGMENTOR.G_BLUR, g_sigma=cfg.AUGMENTOR.G_SIGMA, gamma_contrast=cfg.AUGMENTOR.GAMMA_CONTRAST,
+            gc_gamma=cfg.AUGMENTOR.GC_GAMMA, brightness=cfg.AUGMENTOR.BRIGHTNESS,
+            brightness_factor=cfg.AUGMENTOR.BRIGHTNESS_FACTOR, brightness_mode=cfg.AUGMENTOR.BRIGHTNESS_MODE,
+            contrast=cfg.AUGMENTOR.CONTRAST, contrast_factor=cfg.AUGMENTOR.CONTRAST_FACTOR,
+            contrast_mode=cfg.AUGMENTOR.CONTRAST_MODE, brightness_em=cfg.AUGMENTOR.BRIGHTNESS_EM,
+            brightness_em_factor=cfg.AUGMENTOR.BRIGHTNESS_EM_FACTOR, brightness_em_mode=cfg.AUGMENTOR.BRIGHTNESS_EM_MODE,
+            contrast_em=cfg.AUGMENTOR.CONTRAST_EM, contrast_em_factor=cfg.AUGMENTOR.CONTRAST_EM_FACTOR,
+            contrast_em_mode=cfg.AUGMENTOR.CONTRAST_EM_MODE, dropout=cfg.AUGMENTOR.DROPOUT,
+            drop_range=cfg.AUGMENTOR.DROP_RANGE, gaussian_noise=cfg.AUGMENTOR.GAUSSIAN_NOISE,
+            gaussian_noise_mean=cfg.AUGMENTOR.GAUSSIAN_NOISE_MEAN, gaussian_noise_var=cfg.AUGMENTOR.GAUSSIAN_NOISE_VAR,
+            gaussian_noise_use_input_img_mean_and_var=cfg.AUGMENTOR.GAUSSIAN_NOISE_USE_INPUT_IMG_MEAN_AND_VAR,
+            poisson_noise=cfg.AUGMENTOR.POISSON_NOISE, salt=cfg.AUGMENTOR.SALT, salt_amount=cfg.AUGMENTOR.SALT_AMOUNT,
+            pepper=cfg.AUGMENTOR.PEPPER, pepper_amount=cfg.AUGMENTOR.PEPPER_AMOUNT,
+            salt_and_pepper=cfg.AUGMENTOR.SALT_AND_PEPPER, salt_pep_amount=cfg.AUGMENTOR.SALT_AND_PEPPER_AMOUNT,
+            salt_pep_proportion=cfg.AUGMENTOR.SALT_AND_PEPPER_PROP, mask_type=norm_dict['mask_norm'],
+            channel_info=train_generator.channel_info, seed=cfg.SYSTEM.SEED+global_rank)
 
-    return train_dataset, val_dataset, data_norm, num_training_steps_per_epoch
+    return train_dataset, val_dataset, data_norm, num_training_steps_per_epoch, batch_augmentor
 
 def create_test_augmentor(cfg, X_test, Y_test, cross_val_samples_ids):
     """
@@ -464,6 +519,109 @@ def check_generator_consistence(gen, data_out_dir, mask_out_dir, filenames=None)
             save_tif(np.expand_dims(Y_test[k],0), mask_out_dir, fil, verbose=False)
             c += 1
 
+class PrefetchGenerator(object):
+    """
+    Iterate over a test generator loading the next samples in background threads, so the reading and normalization
+    of the next images is done while the current one is being processed. Threads are used instead of processes as the 
+    image reading (I/O) and the numpy operations release the GIL and the samples do not need to be pickled.
+
+    Parameters
+    ----------
+    generator : test_pair_data_generator or test_single_data_generator
+        Generator to load the samples from. 
+
+    depth : int, optional
+        Number of samples to load in advance. With ``0`` each sample is loaded only when it is requested. 
+    """
+    def __init__(self, generator, depth=1):
+        self.generator = generator
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.generator)
+
+    def __iter__(self):
+        if self.depth == 0:
+            for i in range(len(self.generator)):
+                yield self.generator[i]
+            return
+
+        with ThreadPoolExecutor(max_workers=self.depth) as pool:
+            queue = deque(pool.submit(self.generator.__getitem__, i) for i in range(min(self.depth, len(self.generator))))
+            next_sample = len(queue)
+            while len(queue) > 0:
+                sample = queue.popleft().result()
+                if next_sample < len(self.generator):
+                    queue.append(pool.submit(self.generator.__getitem__, next_sample))
+                    next_sample += 1
+                yield sample
+
+def chunked_data_worker_init_fn(worker_id):
+    """
+    Initialize each ``DataLoader`` worker so the Zarr/H5 files opened by the main process are not reused in it, as 
+    those handles are not safe to be shared across processes. Each worker will open its own files on demand. 
+
+    Parameters
+    ----------
+    worker_id : int
+        Id of the worker. 
+    """
+    dataset = torch.utils.data.get_worker_info().dataset
+    if getattr(dataset, 'chunked_data_pool', None) is not None:
+        dataset.chunked_data_pool.reset()
+
+def build_dataloader(dataset, sampler, batch_size, num_workers, pin_memory=True, loader_type="default", 
+    persistent_workers=False, prefetch_factor=2, worker_init_fn=None):
+    """
+    Create the ``DataLoader`` used in training and validation.
+
+    Parameters
+    ----------
+    dataset : torch Dataset
+        Dataset to load the samples from.
+
+    sampler : torch Sampler
+        Sampler to select the samples of each epoch. 
+
+    batch_size : int
+        Batch size.
+
+    num_workers : int
+        Number of worker processes. 
+
+    pin_memory : bool, optional
+        Whether to pin the memory of the loaded batches.
+
+    loader_type : str, optional
+        Type of ``DataLoader``. Options: ``'default'`` and ``'multi_epochs'`` (:class:`~MultiEpochsDataLoader`).
+
+    persistent_workers : bool, optional
+        Whether to keep the workers alive between epochs. Only used in the ``'default'`` loader, as the 
+        ``'multi_epochs'`` one never stops its workers.
+
+    prefetch_factor : int, optional
+        Number of batches loaded in advance by each worker.
+
+    worker_init_fn : callable, optional
+        Function to initialize each worker.
+
+    Returns
+    -------
+    loader : DataLoader or MultiEpochsDataLoader
+        Data loader.
+    """
+    kwargs = dict(sampler=sampler, batch_size=batch_size, num_workers=num_workers, pin_memory=pin_memory, drop_last=False, 
+        worker_init_fn=worker_init_fn)
+    # These options can only be set when there are worker processes
+    if num_workers > 0:
+        kwargs['prefetch_factor'] = prefetch_factor
+        if loader_type == "default":
+            kwargs['persistent_workers'] = persistent_workers
+    if loader_type == "multi_epochs":
+        return MultiEpochsDataLoader(dataset, **kwargs)
+    else:
+        return torch.utils.data.DataLoader(dataset, **kwargs)
+
 # To accelerate each first batch in epoch without need to.
 # Sources: https://discuss.pytorch.org/t/enumerate-dataloader-slow/87778/4
 #          https://github.com/huggingface/pytorch-image-models/pull/140/files
@@ -481,12 +639,23 @@ class MultiEpochsDataLoader(torch.utils.data.DataLoader):
         self._DataLoader__initialized = False
         self.batch_sampler = _RepeatSampler(self.batch_sampler)
         self._DataLoader__initialized = True
-        self.iterator = super().__iter__()
+        # Created on the first iteration so the epoch of the sampler can be set before
+        self.iterator = None
 
     def __len__(self):
         return len(self.batch_sampler.sampler)
 
+    def set_epoch(self, epoch):
+        """
+        Set the epoch of the sampler (e.g. ``DistributedSampler``) for the first pass over the data. The next 
+        passes increase it on their own, as their first batches are prepared before the current epoch ends.
+        """
+        if self.iterator is None:
+            self.batch_sampler.epoch = epoch
+
     def __iter__(self):
+        if self.iterator is None:
+            self.iterator = super().__iter__()
         for i in range(len(self)):
             yield next(self.iterator)
 
@@ -499,7 +668,13 @@ class _RepeatSampler(object):
 
     def __init__(self, sampler):
         self.sampler = sampler
+        self.epoch = 0
 
     def __iter__(self):
         while True:
+            # Shuffle each pass differently, as DistributedSampler only does it when its epoch changes
+            sampler = getattr(self.sampler, 'sampler', self.sampler)
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(self.epoch)
+            self.epoch += 1
             yield from iter(self.sampler)
\ No newline at end of file
@@ -14,7 +14,8 @@ from imgaug.augmentables.segmaps import SegmentationMapsOnImage
 from abc import ABCMeta, abstractmethod
 from torch.utils.data import Dataset                 
 
-from biapy.utils.util import img_to_onehot_encoding, pad_and_reflect, read_chunked_data
+from biapy.utils.util import (img_to_onehot_encoding, pad_and_reflect, read_chunked_data, ChunkedDataPool, SharedArrayReference,
+    shared_array_reference, attach_shared_array)
 from biapy.data.generators.augmentors import *
 from biapy.data.pre_processing import normalize, norm_range01, percentile_norm
 from biapy.utils.misc import is_main_process
@@ -361,6 +362,13 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
         Whether to consider more than one raw images or not. In this case, a folder per each sample is expected. Visit
         `LightMyCells challenge approach <https://biapy.readthedocs.io/en/latest/tutorials/image-to-image/lightmycells.html>`_ 
         for a real use case.  
+
+    chunked_data_max_open_files : int, optional
+        Maximum number of Zarr/H5 files kept opened by each process when ``data_mode`` is ``chunked_data``. 
+
+    chunked_data_cache_mb : int, optional
+        Size, in MB, of the chunk cache of each opened Zarr/H5 file when ``data_mode`` is ``chunked_data``. ``0`` to 
+        use the libraries' default.
     """
     def __init__(self, ndim, X, Y, seed=0, data_mode="", data_paths=None, da=True, da_prob=0.5, rotation90=False, 
                  rand_rot=False, rnd_rot_range=(-180,180), shear=False, shear_range=(-20,20), zoom=False, zoom_range=(0.8,1.2), 
@@ -381,7 +389,8 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
                  random_crops_in_DA=False, shape=(256,256,1), resolution=(-1,), prob_map=None, val=False, n_classes=1, 
                  extra_data_factor=1, n2v=False, n2v_perc_pix=0.198, n2v_manipulator='uniform_withCP', 
                  n2v_neighborhood_radius=5, n2v_structMask=np.array([[0,1,1,1,1,1,1,1,1,1,0]]), norm_dict=None, 
-                 instance_problem=False, random_crop_scale=(1,1), convert_to_rgb=False, multiple_raw_images=False):
+                 instance_problem=False, random_crop_scale=(1,1), convert_to_rgb=False, multiple_raw_images=False,
+                 chunked_data_max_open_files=16, chunked_data_cache_mb=0):
         
         assert norm_dict != None, "Normalization instructions must be provided with 'norm_dict'"
         assert norm_dict['mask_norm'] in ['as_mask', 'as_image', 'none']
@@ -425,6 +434,8 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
                 raise ValueError("'data_paths' must contain one or two paths: 1) data path ; 2) data masks path (optional)")
         elif data_mode == "chunked_data":
             self.Y_provided = Y is not None 
+            self.chunked_data_pool = ChunkedDataPool(max_open_files=chunked_data_max_open_files, 
+                chunk_cache_mb=chunked_data_cache_mb)
 
         if shape is None:
             raise ValueError("'shape' must be provided")   
@@ -791,6 +802,22 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
         """Defines the number of samples per epoch."""
         return self.length
 
+    def __getstate__(self):
+        # Arrays placed in shared memory are attached again in the worker instead of being copied (e.g. when 
+        # DataLoader workers are spawned)
+        state = self.__dict__.copy()
+        for k in ['X', 'Y']:
+            ref = shared_array_reference(state.get(k))
+            if ref is not None:
+                state[k] = ref
+        return state
+
+    def __setstate__(self, state):
+        for k in ['X', 'Y']:
+            if isinstance(state.get(k), SharedArrayReference):
+                state[k] = attach_shared_array(state[k])
+        self.__dict__.update(state)
+
     def load_sample(self, _idx):
         """
         Load one data sample given its corresponding index.
@@ -811,9 +838,10 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
         # Choose the data source
         idx = _idx % self.real_length
         if self.data_mode == "in_memory": 
-            img = np.squeeze(self.X[idx].copy())
+            # Views of the data. They are copied after the normalization only if it did not create new arrays
+            img = np.squeeze(self.X[idx])
             if self.Y_provided:
-                mask = np.squeeze(self.Y[idx].copy())
+                mask = np.squeeze(self.Y[idx])
         elif self.data_mode == "not_in_memory": 
             if self.multiple_raw_images:
                 if not self.val:
@@ -841,38 +869,20 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
                 if self.Y_provided:
                     mask = np.squeeze(mask)
         else: # self.data_mode == "chunked_data"
-            imgfile, img = read_chunked_data(self.X[idx]['filepath'])
+            img = self.chunked_data_pool.get(self.X[idx]['filepath'])
 
             # Prepare slices to extract the patch
-            slices = []
-            for j in range(len(self.X[idx]['patch_coords'])):
-                if isinstance(self.X[idx]['patch_coords'][j], int):
-                    # +1 to prevent 0 length axes that can not be removed with np.squeeze later
-                    slices.append(slice(0,self.X[idx]['patch_coords'][j]+1)) 
-                else:
-                    slices.append(slice(self.X[idx]['patch_coords'][j][0],self.X[idx]['patch_coords'][j][1]))
+            slices = tuple(slice(start, end) for start, end in self.X[idx]['patch_coords'])
 
-            img = np.squeeze(np.array(img[tuple(slices)]))
-            
-            if isinstance(imgfile, h5py.File):
-                imgfile.close()
+            img = np.squeeze(np.array(img[slices]))
 
             if self.Y_provided:
-                maskfile, mask = read_chunked_data(self.Y[idx]['filepath'])
+                mask = self.chunked_data_pool.get(self.Y[idx]['filepath'])
 
                 # Prepare slices to extract the patch
-                slices = []
-                for j in range(len(self.Y[idx]['patch_coords'])):
-                    if isinstance(self.Y[idx]['patch_coords'][j], int):
-                        # +1 to prevent 0 length axes that can not be removed with np.squeeze later
-                        slices.append(slice(0,self.Y[idx]['patch_coords'][j]+1)) 
-                    else:
-                        slices.append(slice(self.Y[idx]['patch_coords'][j][0],self.Y[idx]['patch_coords'][j][1]))
-
-                mask = np.squeeze(np.array(mask[tuple(slices)]))
+                slices = tuple(slice(start, end) for start, end in self.Y[idx]['patch_coords'])
 
-                if isinstance(maskfile, h5py.File):
-                    maskfile.close()
+                mask = np.squeeze(np.array(mask[slices]))
                 
         if self.Y_provided:
             img, mask = self.ensure_shape(img, mask)
@@ -880,8 +890,12 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
             img = self.ensure_shape(img, None)
 
         img = self.norm_X(img)
+        if self.data_mode == "in_memory" and not img.flags.owndata:
+            img = img.copy()
         if self.Y_provided:
             mask = self.norm_Y(mask)
+            if self.data_mode == "in_memory" and not mask.flags.owndata:
+                mask = mask.copy()
             return img, mask
         else:
             return img, np.zeros(img.shape, dtype=np.float32)
@@ -936,6 +950,9 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
         # Y normalization
         if self.X_norm['type'] != "none":
             if self.norm_dict['mask_norm'] == 'as_mask' and self.Y_provided: 
+                # Do not modify the in-memory data 
+                if self.data_mode == "in_memory" and not mask.flags.owndata:
+                    mask = mask.copy()
                 for j in range(self.channels_to_analize):
                     if self.channel_info[j]['div']:
                         mask[...,j] = mask[...,j]/255
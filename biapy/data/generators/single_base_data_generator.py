@@ -13,6 +13,7 @@ from imgaug import augmenters as iaa
 from biapy.data.pre_processing import normalize, norm_range01, percentile_norm
 from biapy.data.generators.augmentors import random_crop_single, random_3D_crop_single, resize_img, rotation
 from biapy.utils.misc import is_main_process
+from biapy.utils.util import SharedArrayReference, shared_array_reference, attach_shared_array
 
 class SingleBaseDataGenerator(Dataset, metaclass=ABCMeta):
     """
@@ -339,6 +340,22 @@ class SingleBaseDataGenerator(Dataset, metaclass=ABCMeta):
         """Defines the number of samples per epoch."""
         return self.length
 
+    def __getstate__(self):
+        # Arrays placed in shared memory are attached again in the worker instead of being copied (e.g. when 
+        # DataLoader workers are spawned)
+        state = self.__dict__.copy()
+        for k in ['X', 'Y']:
+            ref = shared_array_reference(state.get(k))
+            if ref is not None:
+                state[k] = ref
+        return state
+
+    def __setstate__(self, state):
+        for k in ['X', 'Y']:
+            if isinstance(state.get(k), SharedArrayReference):
+                state[k] = attach_shared_array(state[k])
+        self.__dict__.update(state)
+
     def load_sample(self, idx):
         """
         Load one data sample given its corresponding index.
@@ -358,7 +375,8 @@ class SingleBaseDataGenerator(Dataset, metaclass=ABCMeta):
         """
         # Choose the data source
         if self.data_mode == "in_memory":
-            img = np.squeeze(self.X[idx].copy())
+            # View of the data. It is copied after the normalization only if it did not create a new array
+            img = np.squeeze(self.X[idx])
             img_class = self.Y[idx] if self.ptype == "classification" else 0
         else:
             sample_id = self.all_samples[idx]
@@ -388,6 +406,8 @@ class SingleBaseDataGenerator(Dataset, metaclass=ABCMeta):
                 else:                                                                                                   
                     img, _ = percentile_norm(img, lwr_perc_val=self.X_norm['lower_value'],                                     
                         uppr_perc_val=self.X_norm['upper_value']) 
+        if self.data_mode == "in_memory" and not img.flags.owndata:
+            img = img.copy()
         img = self.ensure_shape(img)
 
         return img, img_class
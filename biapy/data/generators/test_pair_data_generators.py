@@ -416,16 +416,15 @@ class test_pair_data_generator(Dataset):
                 Y element normalization steps.
         """
         img, mask, xnorm, ynorm, filename = self.load_sample(index)
-        
-        if xnorm is not None:
-            self.X_norm.update(xnorm)
-        if ynorm is not None:
-            self.Y_norm.update(ynorm)
 
+        # Return the normalization info of this sample instead of updating the shared one, as the samples can be 
+        # loaded concurrently (see PrefetchGenerator)
+        X_norm = dict(self.X_norm, **xnorm) if xnorm is not None else self.X_norm.copy()
         if self.provide_Y:
-            return {"X": img, "X_norm": self.X_norm, "Y": mask, "Y_norm": self.Y_norm, "file": filename}
+            Y_norm = dict(self.Y_norm, **ynorm) if ynorm is not None else self.Y_norm.copy()
+            return {"X": img, "X_norm": X_norm, "Y": mask, "Y_norm": Y_norm, "file": filename}
         else:
-            return {"X": img, "X_norm": self.X_norm, "file": filename}
+            return {"X": img, "X_norm": X_norm, "file": filename}
 
     def get_data_normalization(self):
         return self.X_norm
@@ -256,16 +256,16 @@ class test_single_data_generator(Dataset):
             img = resize_img(img, self.resize_shape[:-1])
             img = np.expand_dims(img,0)
 
-        if norm is not None:
-            self.X_norm.update(norm)           
-
+        # Return the normalization info of this sample instead of updating the shared one, as the samples can be 
+        # loaded concurrently (see PrefetchGenerator)
+        X_norm = dict(self.X_norm, **norm) if norm is not None else self.X_norm.copy()
         if self.ptype == "classification":
             if self.provide_Y:
-                return {"X": img, "X_norm": self.X_norm, "Y": img_class, "file": filename}
+                return {"X": img, "X_norm": X_norm, "Y": img_class, "file": filename}
             else:
-                return {"X": img, "X_norm": self.X_norm, "file": filename}
+                return {"X": img, "X_norm": X_norm, "file": filename}
         else: # SSL - MAE
-            return {"X": img, "X_norm": self.X_norm, "file": filename}
+            return {"X": img, "X_norm": X_norm, "file": filename}
 
     def get_data_normalization(self):
         return self.X_norm
\ No newline at end of file
@@ -0,0 +1,553 @@
+import math
+import torch
+import torch.nn.functional as F
+
+
+# Generator arguments whose transformations are applied by TorchBatchAugmentor instead of per sample
+BATCH_DA_OPTIONS = ['rotation90', 'rand_rot', 'shear', 'zoom', 'shift', 'vflip', 'hflip', 'zflip', 'elastic', 'g_blur',
+    'gamma_contrast', 'brightness', 'contrast', 'brightness_em', 'contrast_em', 'dropout', 'gaussian_noise', 'poisson_noise',
+    'salt', 'pepper', 'salt_and_pepper']
+
+# Equivalence between the padding modes of 'AUGMENTOR.AFFINE_MODE'/'AUGMENTOR.E_MODE' and 'torch.nn.functional.grid_sample' ones
+PADDING_MODES = {'constant': 'zeros', 'nearest': 'border', 'edge': 'border', 'reflect': 'reflection',
+    'symmetric': 'reflection', 'mirror': 'reflection'}
+
+
+class TorchBatchAugmentor:
+    """
+    Data augmentation applied to whole batches as torch tensors, after collation, so it can run in the same device as
+    the model. Each transformation is applied to each sample with ``da_prob`` probability and with its own random
+    parameters. All geometric transformations (90/random rotations, shear, zoom, shift and elastic deformations) are
+    merged into one sampling grid so the batch is only interpolated once. ``3D`` volumes are processed natively, as
+    ``5D`` tensors, applying the same ``yx`` transformation to all their ``z`` slices as the imgaug based generators do.
+
+    Parameters
+    ----------
+    ndim : int
+        Dimensions of the data (``2`` for ``2D`` and ``3`` for 3D).
+
+    da_prob : float, optional
+        Probability of doing each transformation.
+
+    rotation90 : bool, optional
+        To make square (90, 180,270) degree rotations.
+
+    rand_rot : bool, optional
+        To make random degree range rotations.
+
+    rnd_rot_range : tuple of float, optional
+        Range of random rotations. E. g. ``(-180, 180)``.
+
+    shear : bool, optional
+        To make shear transformations.
+
+    shear_range : tuple of int, optional
+        Degree range to make shear. E. g. ``(-20, 20)``.
+
+    zoom : bool, optional
+        To make zoom on images.
+
+    zoom_range : tuple of floats, optional
+        Zoom range to apply. E. g. ``(0.8, 1.2)``.
+
+    shift : float, optional
+        To make shifts.
+
+    shift_range : tuple of float, optional
+        Range to make a shift. E. g. ``(0.1, 0.2)``.
+
+    affine_mode: str, optional
+        Method to use when filling in newly created pixels. Same meaning as in `skimage` (and `numpy.pad()`).
+        E.g. ``constant``, ``reflect`` etc.
+
+    vflip : bool, optional
+        To activate vertical flips.
+
+    hflip : bool, optional
+        To activate horizontal flips.
+
+    zflip : bool, optional
+        To activate flips in z dimension. Only used in ``3D``.
+
+    elastic : bool, optional
+        To make elastic deformations.
+
+    e_alpha : tuple of ints, optional
+         Strength of the distortion field. E. g. ``(12, 16)``.
+
+    e_sigma : int, optional
+        Standard deviation of the gaussian kernel used to smooth the distortion fields.
+
+    e_mode : str, optional
+        Parameter that defines the handling of newly created pixels with the elastic transformation. Only used when
+        no affine transformation is selected, as ``affine_mode`` is used otherwise.
+
+    g_blur : bool, optional
+        To insert gaussian blur on the images.
+
+    g_sigma : tuple of floats, optional
+        Standard deviation of the gaussian kernel. E. g. ``(1.0, 2.0)``.
+
+    gamma_contrast : bool, optional
+        To insert gamma constrast changes on images.
+
+    gc_gamma : tuple of floats, optional
+        Exponent for the contrast adjustment. Higher values darken the image. E. g. ``(1.25, 1.75)``.
+
+    brightness : bool, optional
+        To aply brightness to the images as `PyTorch Connectomics
+        <https://github.com/zudi-lin/pytorch_connectomics/blob/master/connectomics/data/augmentation/grayscale.py>`_.
+
+    brightness_factor : tuple of 2 floats, optional
+        Strength of the brightness range, with valid values being ``0 <= brightness_factor <= 1``. E.g. ``(0.1, 0.3)``.
+
+    brightness_mode : str, optional
+        Apply same brightness change to the whole image or diffent to slice by slice.
+
+    contrast : boolen, optional
+        To apply contrast changes to the images as `PyTorch Connectomics
+        <https://github.com/zudi-lin/pytorch_connectomics/blob/master/connectomics/data/augmentation/grayscale.py>`_.
+
+    contrast_factor : tuple of 2 floats, optional
+        Strength of the contrast change range, with valid values being ``0 <= contrast_factor <= 1``.
+        E.g. ``(0.1, 0.3)``.
+
+    contrast_mode : str, optional
+        Apply same contrast change to the whole image or diffent to slice by slice.
+
+    brightness_em : bool, optional
+        To aply brightness to the images as `PyTorch Connectomics
+        <https://github.com/zudi-lin/pytorch_connectomics/blob/master/connectomics/data/augmentation/grayscale.py>`_.
+
+    brightness_em_factor : tuple of 2 floats, optional
+        Strength of the brightness range, with valid values being ``0 <= brightness_em_factor <= 1``. E.g. ``(0.1, 0.3)``.
+
+    brightness_em_mode : str, optional
+        Apply same brightness change to the whole image or diffent to slice by slice.
+
+    contrast_em : boolen, optional
+        To apply contrast changes to the images as `PyTorch Connectomics
+        <https://github.com/zudi-lin/pytorch_connectomics/blob/master/connectomics/data/augmentation/grayscale.py>`_.
+
+    contrast_em_factor : tuple of 2 floats, optional
+        Strength of the contrast change range, with valid values being ``0 <= contrast_em_factor <= 1``.
+        E.g. ``(0.1, 0.3)``.
+
+    contrast_em_mode : str, optional
+        Apply same contrast change to the whole image or diffent to slice by slice.
+
+    dropout : bool, optional
+        To set a certain fraction of pixels in images to zero.
+
+    drop_range : tuple of floats, optional
+        Range to take a probability ``p`` to drop pixels. E.g. ``(0, 0.2)`` will take a ``p`` folowing ``0<=p<=0.2``
+        and then drop ``p`` percent of all pixels in the image (i.e. convert them to black pixels).
+
+    gaussian_noise : bool, optional
+        To add Gaussian noise to the images.
+
+    gaussian_noise_mean : float, optional
+        Mean of the Gaussian noise.
+
+    gaussian_noise_var : float, optional
+        Variance of the Gaussian noise.
+
+    gaussian_noise_use_input_img_mean_and_var : bool, optional
+        Whether to use the mean and variance of each input image instead of ``gaussian_noise_mean`` and
+        ``gaussian_noise_var``.
+
+    poisson_noise : bool, optional
+        To add Poisson noise to the images.
+
+    salt : bool, optional
+        To replace random pixels with 1.
+
+    salt_amount : float, optional
+        Proportion of image pixels to replace with salt.
+
+    pepper : bool, optional
+        To replace random pixels with 0 (or -1 in images with negative values).
+
+    pepper_amount : float, optional
+        Proportion of image pixels to replace with pepper.
+
+    salt_and_pepper : bool, optional
+        To replace random pixels with either 1 or low_val, where low_val is 0 for unsigned images or -1 for signed
+        images.
+
+    salt_pep_amount : float, optional
+        Proportion of image pixels to replace with salt and pepper.
+
+    salt_pep_proportion : float, optional
+        Proportion of salt vs. pepper noise. Higher values represent more salt.
+
+    mask_type : str, optional
+        How the masks are treated. Options: ``as_mask``, ``as_image`` and ``none``. With ``as_mask`` the mask channels
+        are interpolated with nearest neighbour, but the ones marked as ``no_bin`` in ``channel_info``.
+
+    channel_info : dict, optional
+        Information of each mask channel, as the ``channel_info`` attribute of the pair data generators.
+
+    seed : int, optional
+        Seed for random functions.
+    """
+    def __init__(self, ndim, da_prob=0.5, rotation90=False, rand_rot=False, rnd_rot_range=(-180,180), shear=False,
+        shear_range=(-20,20), zoom=False, zoom_range=(0.8,1.2), shift=False, shift_range=(0.1,0.2), affine_mode='constant',
+        vflip=False, hflip=False, zflip=False, elastic=False, e_alpha=(240,250), e_sigma=25, e_mode='constant',
+        g_blur=False, g_sigma=(1.0,2.0), gamma_contrast=False, gc_gamma=(1.25,1.75), brightness=False,
+        brightness_factor=(1,3), brightness_mode='2D', contrast=False, contrast_factor=(1,3), contrast_mode='2D',
+        brightness_em=False, brightness_em_factor=(1,3), brightness_em_mode='2D', contrast_em=False,
+        contrast_em_factor=(1,3), contrast_em_mode='2D', dropout=False, drop_range=(0, 0.2), gaussian_noise=False,
+        gaussian_noise_mean=0, gaussian_noise_var=0.01, gaussian_noise_use_input_img_mean_and_var=False,
+        poisson_noise=False, salt=False, salt_amount=0.05, pepper=False, pepper_amount=0.05, salt_and_pepper=False,
+        salt_pep_amount=0.05, salt_pep_proportion=0.5, mask_type='as_mask', channel_info=None, seed=0):
+
+        assert ndim in [2,3], "'ndim' must be 2 or 3"
+        assert mask_type in ['as_mask', 'as_image', 'none']
+        self.ndim = ndim
+        self.da_prob = da_prob
+        self.rotation90 = rotation90
+        self.rand_rot = rand_rot
+        self.rnd_rot_range = rnd_rot_range
+        self.shear = shear
+        self.shear_range = shear_range
+        self.zoom = zoom
+        self.zoom_range = zoom_range
+        self.shift = shift
+        self.shift_range = shift_range
+        self.vflip = vflip
+        self.hflip = hflip
+        self.zflip = zflip and ndim == 3
+        self.elastic = elastic
+        self.e_alpha = e_alpha
+        self.e_sigma = e_sigma
+        self.g_blur = g_blur
+        self.g_sigma = g_sigma
+        self.gamma_contrast = gamma_contrast
+        self.gc_gamma = gc_gamma
+        self.brightness = brightness
+        self.brightness_factor = brightness_factor
+        self.brightness_mode = brightness_mode
+        self.contrast = contrast
+        self.contrast_factor = contrast_factor
+        self.contrast_mode = contrast_mode
+        self.brightness_em = brightness_em
+        self.brightness_em_factor = brightness_em_factor
+        self.brightness_em_mode = brightness_em_mode
+        self.contrast_em = contrast_em
+        self.contrast_em_factor = contrast_em_factor
+        self.contrast_em_mode = contrast_em_mode
+        self.dropout = dropout
+        self.drop_range = drop_range
+        self.gaussian_noise = gaussian_noise
+        self.gaussian_noise_mean = gaussian_noise_mean
+        self.gaussian_noise_var = gaussian_noise_var
+        self.gaussian_noise_use_input_img_mean_and_var = gaussian_noise_use_input_img_mean_and_var
+        self.poisson_noise = poisson_noise
+        self.salt = salt
+        self.salt_amount = salt_amount
+        self.pepper = pepper
+        self.pepper_amount = pepper_amount
+        self.salt_and_pepper = salt_and_pepper
+        self.salt_pep_amount = salt_pep_amount
+        self.salt_pep_proportion = salt_pep_proportion
+        self.affine = rotation90 or rand_rot or shear or zoom or shift
+        mode = affine_mode if self.affine else e_mode
+        if mode not in PADDING_MODES:
+            raise ValueError("Padding mode '{}' not supported. Options: {}".format(mode, list(PADDING_MODES.keys())))
+        self.padding_mode = PADDING_MODES[mode]
+
+        # Mask channels that need to be interpolated with nearest neighbour
+        self.mask_type = mask_type
+        self.channel_info = channel_info if channel_info is not None else {}
+        self.seed = seed
+        self.generator = None
+
+    def __call__(self, img, mask):
+        """
+        Transform a batch of images and their masks.
+
+        Parameters
+        ----------
+        img : Torch tensor
+            Images to transform. E.g. ``(batch, y, x, channels)`` in ``2D`` and ``(batch, z, y, x, channels)`` in ``3D``.
+
+        mask : Torch tensor
+            Masks to transform. E.g. ``(batch, y, x, channels)`` in ``2D`` and ``(batch, z, y, x, channels)`` in ``3D``.
+
+        Returns
+        -------
+        img : Torch tensor
+            Transformed images. E.g. ``(batch, y, x, channels)`` in ``2D`` and ``(batch, z, y, x, channels)`` in ``3D``.
+
+        mask : Torch tensor
+            Transformed masks. E.g. ``(batch, y, x, channels)`` in ``2D`` and ``(batch, z, y, x, channels)`` in ``3D``.
+        """
+        if self.generator is None or self.generator.device != img.device:
+            self.generator = torch.Generator(device=img.device)
+            self.generator.manual_seed(self.seed)
+
+        # Work with channels first
+        to_first = (0, self.ndim+1) + tuple(range(1, self.ndim+1))
+        to_last = (0,) + tuple(range(2, self.ndim+2)) + (1,)
+        if not torch.is_floating_point(img):
+            img = img.float()
+        img = img.permute(to_first).contiguous()
+        mask = mask.permute(to_first).contiguous()
+
+        img, mask = self.flips(img, mask)
+        if self.affine or self.elastic:
+            img, mask = self.geometric_transform(img, mask)
+        img = self.intensity_transform(img)
+
+        return img.permute(to_last), mask.permute(to_last)
+
+    def _rand(self, *size, device):
+        return torch.rand(size, generator=self.generator, device=device)
+
+    def _uniform(self, value_range, *size, device):
+        return value_range[0] + (value_range[1]-value_range[0])*self._rand(*size, device=device)
+
+    def _selected(self, n, device):
+        """Choose the samples of the batch where a transformation is going to be applied."""
+        return self._rand(n, device=device) < self.da_prob
+
+    def _per_sample(self, values, x):
+        """Reshape ``values`` (one per sample) so they can be broadcasted against ``x``."""
+        return values.view((-1,)+(1,)*(x.ndim-1))
+
+    def flips(self, img, mask):
+        """Flip samples in the ``y``, ``x`` and ``z`` axes. Channels first tensors are expected."""
+        flips = []
+        if self.vflip: flips.append(-2)
+        if self.hflip: flips.append(-1)
+        if self.zflip: flips.append(-3)
+        for axis in flips:
+            sel = self._per_sample(self._selected(img.shape[0], img.device), img)
+            img = torch.where(sel, img.flip(axis), img)
+            mask = torch.where(sel, mask.flip(axis), mask)
+        return img, mask
+
+    def geometric_transform(self, img, mask):
+        """
+        Apply rotations, shear, zoom, shift and elastic deformations to the samples with one interpolation. Channels
+        first tensors are expected.
+        """
+        b, device = img.shape[0], img.device
+        h, w = img.shape[-2:]
+
+        # Forward transformation in pixel units, centered in the image: out = A*in + t
+        t = torch.zeros((b, 2), device=device)
+        changed = torch.zeros(b, dtype=torch.bool, device=device)
+        angle = torch.zeros(b, device=device)
+        if self.rand_rot:
+            sel = self._selected(b, device)
+            angle += torch.where(sel, self._uniform(self.rnd_rot_range, b, device=device), angle.new_zeros(()))
+            changed |= sel
+        if self.rotation90:
+            sel = self._selected(b, device)
+            k = torch.randint(1, 4, (b,), generator=self.generator, device=device)
+            angle += torch.where(sel, 90.*k, angle.new_zeros(()))
+            changed |= sel
+        angle = torch.deg2rad(angle)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        A = torch.stack([torch.stack([cos, -sin], -1), torch.stack([sin, cos], -1)], -2)
+        if self.shear:
+            sel = self._selected(b, device)
+            s = torch.deg2rad(self._uniform(self.shear_range, b, device=device))
+            Sh = torch.eye(2, device=device).repeat(b, 1, 1)
+            Sh[:, 0, 1] = torch.where(sel, -torch.tan(s), s.new_zeros(()))
+            A = A @ Sh
+            changed |= sel
+        if self.zoom:
+            sel = self._selected(b, device)
+            z = torch.where(sel[:, None], self._uniform(self.zoom_range, b, 2, device=device), A.new_ones(()))
+            A = A * z[:, None, :]
+            changed |= sel
+        if self.shift:
+            sel = self._selected(b, device)
+            t = torch.where(sel[:, None], self._uniform(self.shift_range, b, 2, device=device), t)
+            t = t * torch.tensor([w, h], dtype=t.dtype, device=device)
+            changed |= sel
+        if self.elastic:
+            el_sel = self._selected(b, device)
+            changed |= el_sel
+
+        idx = torch.nonzero(changed).flatten()
+        if len(idx) == 0:
+            return img, mask
+
+        # Sampling grid in grid_sample's normalized coordinates: in = D*A^-1*D^-1*out - D*A^-1*t
+        D = torch.tensor([2./w, 2./h], device=device)
+        A_inv = torch.linalg.inv(A[idx])
+        theta = torch.cat([A_inv * D[None, :, None] / D[None, None, :],
+            (-(A_inv @ t[idx, :, None]) * D[None, :, None])], -1)
+        grid = F.affine_grid(theta, (len(idx), 1, h, w), align_corners=False)
+        if self.elastic:
+            # Displacement fields as imgaug: gaussian smoothed random values in [-1,1] scaled by alpha
+            n = len(idx)
+            field = self._rand(n, 2, h, w, device=device)*2 - 1
+            field = gaussian_blur(field, torch.full((n,), float(self.e_sigma), device=device))
+            alpha = self._uniform(self.e_alpha, n, device=device) * el_sel[idx]
+            grid = grid + (field * alpha[:, None, None, None]).permute(0, 2, 3, 1) * D
+
+        img = img.clone()
+        img[idx] = _sample(img[idx], grid, 'bilinear', self.padding_mode)
+
+        # Interpolate each mask channel as it is needed
+        mask = mask.clone()
+        if self.mask_type == 'as_image':
+            nearest, linear = [], list(range(mask.shape[1]))
+        else:
+            linear = [j for j in range(mask.shape[1]) if self.channel_info.get(j, {}).get('type') == 'no_bin']
+            nearest = [j for j in range(mask.shape[1]) if j not in linear]
+        for channels, interp in [(nearest, 'nearest'), (linear, 'bilinear')]:
+            if len(channels) > 0:
+                m = mask[idx][:, channels]
+                mask[idx[:, None], torch.tensor(channels, device=device)[None]] = _sample(m, grid, interp, self.padding_mode)
+
+        return img, mask
+
+    def intensity_transform(self, img):
+        """Apply blur, contrast, brightness, dropout and noise transformations. Channels first tensors are expected."""
+        b, device = img.shape[0], img.device
+
+        if self.g_blur:
+            sel = self._per_sample(self._selected(b, device), img)
+            img = torch.where(sel, gaussian_blur(img, self._uniform(self.g_sigma, b, device=device)), img)
+
+        if self.gamma_contrast:
+            sel = self._per_sample(self._selected(b, device), img)
+            gamma = self._per_sample(self._uniform(self.gc_gamma, b, device=device), img)
+            img = torch.where(sel, torch.sign(img) * img.abs()**gamma, img)
+
+        if self.brightness:
+            sel = self._per_sample(self._selected(b, device), img)
+            factor = self._uniform(self.brightness_factor, *self._intensity_factor_shape(img, self.brightness_mode),
+                device=device)
+            img = torch.where(sel, torch.clamp(img + factor, 0, 1), img)
+
+        if self.contrast:
+            sel = self._per_sample(self._selected(b, device), img)
+            factor = self._uniform(self.contrast_factor, *self._intensity_factor_shape(img, self.contrast_mode),
+                device=device)
+            img = torch.where(sel, torch.clamp(img * (1 + factor), 0, 1), img)
+
+        if self.brightness_em:
+            sel = self._per_sample(self._selected(b, device), img)
+            factor = self._per_sample(self._uniform(self.brightness_em_factor, b, device=device), img)
+            shape = self._intensity_factor_shape(img, self.brightness_em_mode)
+            ran1, ran2 = self._rand(*shape, device=device), self._rand(*shape, device=device)
+            aux = torch.clamp(img + (ran1 - 0.5)*factor, 0, 1)**(2.0**(ran2*2 - 1))
+            img = torch.where(sel, aux, img)
+
+        if self.contrast_em:
+            sel = self._per_sample(self._selected(b, device), img)
+            factor = self._per_sample(self._uniform(self.contrast_em_factor, b, device=device), img)
+            shape = self._intensity_factor_shape(img, self.contrast_em_mode)
+            ran0, ran2 = self._rand(*shape, device=device), self._rand(*shape, device=device)
+            aux = torch.clamp(img * (1 + (ran0 - 0.5)*factor), 0, 1)**(2.0**(ran2*2 - 1))
+            img = torch.where(sel, aux, img)
+
+        if self.dropout:
+            sel = self._per_sample(self._selected(b, device), img)
+            p = self._per_sample(self._uniform(self.drop_range, b, device=device), img)
+            drop = self._rand(b, 1, *img.shape[2:], device=device) < p
+            img = torch.where(sel & drop, img.new_zeros(()), img)
+
+        if not (self.gaussian_noise or self.poisson_noise or self.salt or self.pepper or self.salt_and_pepper):
+            return img
+
+        # Noise is clipped as skimage's random_noise() does: to [-1,1] if the image has negative values or to [0,1]
+        # otherwise
+        low_clip = self._per_sample(-(img.flatten(1).amin(1) < 0).to(img.dtype), img)
+        if self.gaussian_noise:
+            sel = self._per_sample(self._selected(b, device), img)
+            if self.gaussian_noise_use_input_img_mean_and_var:
+                mean = self._per_sample(img.flatten(1).mean(1), img)
+                var = self._per_sample(img.flatten(1).var(1) * self._uniform((0.9, 1.1), b, device=device), img)
+            else:
+                mean, var = self.gaussian_noise_mean, self.gaussian_noise_var
+            noise = torch.randn(img.shape, generator=self.generator, device=device) * var**0.5 + mean
+            img = torch.where(sel, torch.maximum(torch.clamp(img + noise, max=1), low_clip), img)
+
+        if self.poisson_noise:
+            sel = self._selected(b, device)
+            img = img.clone()
+            for i in torch.nonzero(sel).flatten().tolist():
+                x, low = img[i], low_clip[i]
+                # Scale the image so the number of unique values are the number of photons to simulate
+                vals = 2 ** math.ceil(math.log2(len(torch.unique(x))))
+                old_max = x.max()
+                if low < 0:
+                    x = (x + 1.) / (old_max + 1.)
+                x = torch.poisson(torch.clamp(x, min=0) * vals, generator=self.generator) / float(vals)
+                if low < 0:
+                    x = x * (old_max + 1.) - 1.
+                img[i] = torch.maximum(torch.clamp(x, max=1), low)
+
+        for apply, amount, proportion in [(self.salt, self.salt_amount, 1.), (self.pepper, self.pepper_amount, 0.),
+            (self.salt_and_pepper, self.salt_pep_amount, self.salt_pep_proportion)]:
+            if not apply:
+                continue
+            sel = self._per_sample(self._selected(b, device), img)
+            flipped = self._rand(*img.shape, device=device) < amount
+            salted = self._rand(*img.shape, device=device) < proportion
+            values = torch.where(salted, img.new_ones(()), low_clip)
+            img = torch.where(sel & flipped, values, img)
+
+        return img
+
+    def _intensity_factor_shape(self, img, mode):
+        """
+        Shape of the random factors of brightness/contrast transformations: one per sample or, with ``2D`` mode in
+        ``3D`` volumes, one per ``z`` slice.
+        """
+        if self.ndim == 3 and mode == '2D':
+            return (img.shape[0], 1, img.shape[2], 1, 1)
+        return (img.shape[0],) + (1,)*(img.ndim-1)
+
+
+def _sample(x, grid, mode, padding_mode):
+    """
+    Sample ``x`` (channels first, ``2D`` or ``3D``) in ``grid``. ``3D`` volumes are sampled slice by slice, in ``yx``,
+    with the same grid.
+    """
+    shape = x.shape
+    x = x.reshape((shape[0], -1) + shape[-2:])
+    x = F.grid_sample(x, grid.to(x.dtype), mode=mode, padding_mode=padding_mode, align_corners=False)
+    return x.reshape(shape)
+
+
+def gaussian_blur(x, sigma):
+    """
+    Blur each sample in its ``yx`` dimensions with a separable gaussian kernel.
+
+    Parameters
+    ----------
+    x : Torch tensor
+        Samples to blur. E.g. ``(batch, channels, y, x)`` in ``2D`` and ``(batch, channels, z, y, x)`` in ``3D``.
+
+    sigma : Torch tensor
+        Standard deviation of the gaussian kernel of each sample. E.g. ``(batch)``.
+
+    Returns
+    -------
+    x : Torch tensor
+        Blurred samples. E.g. ``(batch, channels, y, x)`` in ``2D`` and ``(batch, channels, z, y, x)`` in ``3D``.
+    """
+    shape = x.shape
+    b, h, w = shape[0], shape[-2], shape[-1]
+    radius = max(1, int(math.ceil(3*float(sigma.max()))))
+    pos = torch.arange(-radius, radius+1, dtype=x.dtype, device=x.device)
+    kernel = torch.exp(-0.5 * (pos[None] / sigma[:, None].to(x.dtype))**2)
+    kernel = kernel / kernel.sum(1, keepdim=True)
+
+    # One group per sample channel (and slice) so each one uses its sample's kernel
+    per_sample = int(torch.tensor(shape[1:-2]).prod())
+    kernel = kernel.repeat_interleave(per_sample, 0)
+    x = x.reshape(1, b*per_sample, h, w)
+    pad_mode = 'reflect' if radius < min(h, w) else 'replicate'
+    x = F.conv2d(F.pad(x, (0, 0, radius, radius), mode=pad_mode), kernel[:, None, :, None], groups=b*per_sample)
+    x = F.conv2d(F.pad(x, (radius, radius, 0, 0), mode=pad_mode), kernel[:, None, None, :], groups=b*per_sample)
+    return x.reshape(shape)
@@ -2,6 +2,7 @@ import torch
 import cv2
 import os
 import math
+import shutil
 import statistics
 import sys
 import time
@@ -10,11 +11,17 @@ import matplotlib.pyplot as plt
 import matplotlib.transforms as transforms
 import fill_voids
 import edt
+import h5py
+import zarr
+import torch.distributed as dist
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from scipy import ndimage as ndi
 from scipy.signal import find_peaks
 from scipy.spatial import KDTree, cKDTree
 from scipy.spatial.distance import cdist
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from scipy.ndimage.morphology import binary_erosion, binary_dilation
 from scipy.ndimage import rotate, grey_dilation, distance_transform_edt
 from scipy.signal import savgol_filter
@@ -24,16 +31,16 @@ from skimage import morphology
 from skimage.morphology import disk, ball, remove_small_objects, dilation, erosion
 from skimage.segmentation import watershed, find_boundaries, relabel_sequential
 from skimage.filters import rank, threshold_otsu
-from skimage.measure import label, regionprops_table, marching_cubes, mesh_surface_area
+from skimage.measure import label, regionprops_table, marching_cubes
 from skimage.io import imread
 from skimage.exposure import equalize_adapthist
 
 from biapy.engine.metrics import jaccard_index_numpy
-from biapy.utils.util import pad_and_reflect, save_tif
+from biapy.utils.util import pad_and_reflect, save_tif, read_chunked_data, order_dimensions
 from biapy.data.pre_processing import normalize
 from biapy.data.data_3D_manipulation import crop_3D_data_with_overlap
 from biapy.data.pre_processing import reduce_dtype
-from biapy.utils.misc import to_numpy_format, to_pytorch_format
+from biapy.utils.misc import to_numpy_format, to_pytorch_format, is_dist_avail_and_initialized
 
 def boundary_refinement_watershed(X, Y_pred, erode=True, save_marks_dir=None):
     """Apply watershed to the given predictions with the goal of refine the boundaries of the artifacts.
@@ -431,6 +438,262 @@ def watershed_by_channels(data, channels, ths={}, remove_before=False, thres_sma
     return segm
 
 
+def _watershed_block(pred_filename, axes_order, core, halo, channels, watershed_kwargs):
+    """
+    Apply :func:`watershed_by_channels` to one block of the prediction extended with a halo. Used by 
+    :func:`watershed_by_chunks`.
+
+    Returns
+    -------
+    labels : 3D Numpy array
+        Instances of the core of the block (without the halo), relabeled as ``1, 2, ..., num``.
+
+    strips : List of 3D Numpy arrays
+        Instances, with the same ids as ``labels``, of the halo placed after the core of the block in each axis. 
+        ``None`` if there is no halo in that axis (last block). Instances only present in the halo are set to ``0``.
+
+    num : int
+        Number of instances of ``labels``.
+    """
+    pred_file, pred = read_chunked_data(pred_filename)
+    vol_shape = order_dimensions(pred.shape, axes_order, "ZYX")
+    ext = [(max(0, s-h), min(d, e+h)) for (s, e), h, d in zip(core, halo, vol_shape)]
+    slices = tuple(slice(s, e) for s, e in ext) + (slice(None),)
+    data = np.array(pred[order_dimensions(slices, "ZYXC", axes_order, default_value=0)])
+    if isinstance(pred_file, h5py.File):
+        pred_file.close()
+    data_order = axes_order.replace("T", "")
+    data = data.transpose([data_order.index(a) for a in "ZYXC"])
+
+    # The thresholds are copied as they are modified when calculated automatically
+    watershed_kwargs = dict(watershed_kwargs, ths=dict(watershed_kwargs.get('ths', {})))
+    w = watershed_by_channels(data, channels, **watershed_kwargs)
+    del data
+
+    # Relabel the instances of the core so the ids go from 1 to the number of instances 
+    core_slices = tuple(slice(s-es, e-es) for (s, e), (es, ee) in zip(core, ext))
+    labels = w[core_slices]
+    ids = np.unique(labels)
+    ids = ids[ids > 0]
+    lut = np.zeros(int(w.max())+1, dtype=np.uint32)
+    lut[ids] = np.arange(1, len(ids)+1)
+    labels = lut[labels]
+
+    strips = []
+    for d in range(3):
+        if core[d][1] < ext[d][1]:
+            sl = list(core_slices)
+            sl[d] = slice(core[d][1]-ext[d][0], ext[d][1]-ext[d][0])
+            strips.append(lut[w[tuple(sl)]])
+        else:
+            strips.append(None)
+    return labels, strips, len(ids)
+
+
+def watershed_by_chunks(pred_filename, out_filename, channels, block_shape, halo=(8,32,32), axes_order="ZYXC", 
+    stitch_th=0.5, num_workers=1, verbose=False, **watershed_kwargs):
+    """
+    Create the instances of a prediction stored in a H5/Zarr file block by block, without loading it entirely into 
+    memory. The prediction is divided into blocks of ``block_shape`` and :func:`watershed_by_channels` is applied 
+    to each block extended with a ``halo`` (so the watershed sees the instances that cross the faces of the block). 
+    The instances of each block get a globally unique id adding to them the number of instances of the previous 
+    blocks. After that, the instances are stitched across the faces of the blocks: an instance is merged with the 
+    instance of the next block it overlaps the most in the halo if that overlap is over ``stitch_th`` of its voxels 
+    in the halo. The merges are resolved as the connected components of the graph they form (union-find). 
+
+    The blocks are processed in parallel by ``num_workers`` processes and, if the distributed mode is initialized, 
+    they are distributed across all the ranks. All the ranks need to call this function. 
+
+    Parameters
+    ----------
+    pred_filename : str
+        H5/Zarr file with the prediction. 
+
+    out_filename : str
+        H5/Zarr file where the instances are saved, in ``(z,y,x)`` order and ``uint32`` dtype. The format is decided 
+        by the extension. 
+
+    channels : str
+        Channel type used. See :func:`watershed_by_channels`. 
+
+    block_shape : tuple of ints
+        Shape of the blocks, in ``(z,y,x)`` order. E.g. ``(40,256,256)``.
+
+    halo : tuple of ints, optional
+        Voxels added to each side of the block, in ``(z,y,x)`` order. E.g. ``(8,32,32)``.
+
+    axes_order : str, optional
+        Order of the axes of the prediction. E.g. ``"TZCYX"``. The first time point is used if ``T`` is present.
+
+    stitch_th : float, optional
+        Minimum fraction of the voxels of an instance in the halo that need to overlap an instance of the next block
+        to merge them.
+
+    num_workers : int, optional
+        Number of processes used to process the blocks of each rank. 
+
+    verbose : bool, optional
+        To print information about the process. 
+
+    watershed_kwargs : dict, optional
+        Arguments of :func:`watershed_by_channels` (``ths``, ``remove_before``...). ``save_dir`` is not used. 
+
+    Returns
+    -------
+    num_instances : int
+        Number of instances created. 
+    """
+    rank = dist.get_rank() if is_dist_avail_and_initialized() else 0
+    world_size = dist.get_world_size() if is_dist_avail_and_initialized() else 1
+    use_h5 = out_filename.endswith('.h5') or out_filename.endswith('.hdf5')
+    watershed_kwargs['save_dir'] = None
+
+    pred_file, pred = read_chunked_data(pred_filename)
+    vol_shape = order_dimensions(pred.shape, axes_order, "ZYX")
+    if isinstance(pred_file, h5py.File):
+        pred_file.close()
+    block_shape = tuple(min(b, d) for b, d in zip(block_shape, vol_shape))
+
+    grid = tuple(math.ceil(d/b) for d, b in zip(vol_shape, block_shape))
+    blocks = [tuple((i*b, min(d, (i+1)*b)) for i, b, d in zip(idx, block_shape, vol_shape)) for idx in np.ndindex(grid)]
+    own_blocks = list(range(rank, len(blocks), world_size))
+
+    def _create(filename):
+        if use_h5:
+            fid = h5py.File(filename, 'w')
+            data = fid.create_dataset("data", vol_shape, dtype=np.uint32, chunks=block_shape, compression="gzip")
+        else:
+            fid = zarr.open_group(filename, mode="w")
+            data = fid.create_dataset("data", shape=vol_shape, chunks=block_shape, dtype=np.uint32)
+        return fid, data
+
+    # The local ids of each block are written first in the output file. A file per rank is needed in H5 as it does
+    # not support concurrent writes from different processes. Zarr does, as each block is a different chunk 
+    part_filenames = [out_filename]
+    if use_h5 and world_size > 1:
+        base, ext = os.path.splitext(out_filename)
+        part_filenames = [base+"_part"+str(r)+ext for r in range(world_size)]
+    if rank == 0 or len(part_filenames) > 1:
+        out_file, out_data = _create(part_filenames[rank % len(part_filenames)])
+    if world_size > 1:
+        dist.barrier()
+        if rank != 0 and len(part_filenames) == 1:
+            out_file = zarr.open_group(out_filename, mode="r+")
+            out_data = out_file["data"]
+
+    # Watershed of each block
+    if verbose:
+        print("[Rank {}] Applying watershed to {} blocks of shape {} (halo: {}) . . .".format(rank, len(own_blocks), 
+            block_shape, halo))
+    num_instances, strips = {}, {}
+    def _save_block(k, result):
+        labels, block_strips, n = result
+        out_data[tuple(slice(s, e) for s, e in blocks[k])] = labels
+        num_instances[k], strips[k] = n, block_strips
+
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {executor.submit(_watershed_block, pred_filename, axes_order, blocks[k], halo, channels, 
+                watershed_kwargs): k for k in own_blocks}
+            for future in tqdm(as_completed(futures), total=len(futures), disable=not verbose):
+                _save_block(futures.pop(future), future.result())
+    else:
+        for k in tqdm(own_blocks, disable=not verbose):
+            _save_block(k, _watershed_block(pred_filename, axes_order, blocks[k], halo, channels, watershed_kwargs))
+    if use_h5:
+        out_file.close()
+
+    # Global ids: the instances of block k start after all the instances of the previous blocks
+    if world_size > 1:
+        all_num_instances = [None for _ in range(world_size)]
+        dist.all_gather_object(all_num_instances, num_instances)
+        num_instances = {k: n for d in all_num_instances for k, n in d.items()}
+    counts = np.array([num_instances[k] for k in range(len(blocks))], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    total = int(counts.sum())
+    if total >= np.iinfo(np.uint32).max:
+        raise ValueError("Too many instances found ({}) to be stored as uint32".format(total))
+
+    # Stitch the instances across the faces of the blocks. The strip of the halo after block k in axis d overlaps the 
+    # beginning of the core of the next block in that axis, which is read from the file where it was saved
+    part_files = [read_chunked_data(f) for f in part_filenames]
+    pairs = []
+    for k in own_blocks:
+        idx = np.unravel_index(k, grid)
+        for d in range(3):
+            strip = strips[k][d]
+            if strip is None:
+                continue
+            next_idx = list(idx)
+            next_idx[d] += 1
+            next_k = int(np.ravel_multi_index(next_idx, grid))
+            region = [slice(s, e) for s, e in blocks[k]]
+            region[d] = slice(blocks[k][d][1], blocks[k][d][1]+strip.shape[d])
+            next_labels = np.asarray(part_files[next_k % len(part_files)][1][tuple(region)])
+
+            strip, next_labels = strip.ravel().astype(np.int64), next_labels.ravel().astype(np.int64)
+            in_halo = np.bincount(strip, minlength=num_instances[k]+1)
+            fg = (strip > 0) & (next_labels > 0)
+            if not np.any(fg):
+                continue
+            codes, overlap = np.unique(strip[fg]*(num_instances[next_k]+1)+next_labels[fg], return_counts=True)
+            a, b = codes//(num_instances[next_k]+1), codes%(num_instances[next_k]+1)
+            # Keep the largest overlap of each instance
+            order = np.lexsort((-overlap, a))
+            a, b, overlap = a[order], b[order], overlap[order]
+            first = np.concatenate([[True], a[1:] != a[:-1]])
+            a, b, overlap = a[first], b[first], overlap[first]
+            merge = overlap >= stitch_th*in_halo[a]
+            pairs.append(np.stack([a[merge]+offsets[k], b[merge]+offsets[next_k]], axis=1))
+    pairs = np.concatenate(pairs) if len(pairs) > 0 else np.zeros((0,2), dtype=np.int64)
+    if world_size > 1:
+        all_pairs = [None for _ in range(world_size)]
+        dist.all_gather_object(all_pairs, pairs)
+        pairs = np.concatenate(all_pairs)
+    del strips
+
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:,0], pairs[:,1])), shape=(total+1, total+1))
+    _, components = connected_components(graph, directed=False)
+    _, new_ids = np.unique(components[1:], return_inverse=True)
+    global_ids = np.concatenate([[0], new_ids+1]).astype(np.uint32)
+    if verbose:
+        print("[Rank {}] {} instances found in the blocks, {} after stitching them".format(rank, total, 
+            int(global_ids.max())))
+
+    # Replace the local ids by the global ones. With H5 and many ranks the first rank composes the final file
+    if world_size > 1:
+        dist.barrier()
+    write_blocks = own_blocks
+    if use_h5:
+        for fid, _ in part_files:
+            fid.close()
+        part_files = [read_chunked_data(f) for f in part_filenames] if len(part_filenames) > 1 else []
+        if len(part_filenames) > 1:
+            write_blocks = list(range(len(blocks))) if rank == 0 else []
+            if rank == 0:
+                out_file, out_data = _create(out_filename)
+        else:
+            out_file = h5py.File(out_filename, 'r+')
+            out_data = out_file["data"]
+    for k in write_blocks:
+        sl = tuple(slice(s, e) for s, e in blocks[k])
+        src = part_files[k % len(part_files)][1] if len(part_files) > 0 else out_data
+        labels = np.asarray(src[sl]).astype(np.int64)
+        out_data[sl] = np.where(labels > 0, global_ids[labels+offsets[k]], 0)
+    if use_h5:
+        for fid, _ in part_files:
+            fid.close()
+        if len(write_blocks) > 0:
+            out_file.close()
+
+    if world_size > 1:
+        dist.barrier()
+        if rank == 0 and len(part_filenames) > 1:
+            for f in part_filenames:
+                os.remove(f)
+    return int(global_ids.max())
+
+
 def calculate_zy_filtering(data, mf_size=5):
     """Applies a median filtering in the z and y axes of the provided data.
 
@@ -800,6 +1063,82 @@ def ensemble16_3d_predictions(vol, pred_func, axis_order_back, axis_order, devic
         return out
 
 
+def ensemble_predictions(img, pred_func, batch_size_value=1):
+    """
+    Outputs the mean prediction of a given image generating its 8 (2D) or 16 (3D) possible rotations and flips. The 
+    transformations are exact (made with ``torch.rot90`` and ``torch.flip``) and they are made, undone and averaged in the 
+    device where ``img`` is, passing the transformed images to ``pred_func`` in batches.
+
+    Parameters
+    ----------
+    img : Tensor
+        Input image. E.g. ``(1, channels, y, x)`` or ``(1, channels, z, y, x)``.
+
+    pred_func : function
+        Function to make predictions. It receives a batch of images as a tensor.
+
+    batch_size_value : int, optional
+        Number of transformed images passed to ``pred_func`` at once.
+
+    Returns
+    -------
+    out : Tensor or list of Tensors
+        Output image ensembled. E.g. ``(1, channels, y, x)`` or ``(1, channels, z, y, x)``. A list of them if the model
+        returns more than one output.
+
+    Examples
+    --------
+    ::
+
+        # EXAMPLE 1
+        # Apply ensemble to each image of X_test
+        X_test = np.ones((165, 768, 1024, 1))
+        out_X_test = np.zeros(X_test.shape, dtype=(np.float32))
+
+        for i in tqdm(range(X_test.shape[0])):
+            img = to_pytorch_format(X_test[i:i+1], (0,3,1,2), device)
+            pred_ensembled = ensemble_predictions(img, pred_func=(lambda img_batch_subdiv: model(img_batch_subdiv)),
+                batch_size_value=8)
+            out_X_test[i] = to_numpy_format(pred_ensembled, (0,2,3,1))[0]
+    """
+    # Rotations are made in (y, x) plane, combined with flips in x (2D) and also in z (3D)
+    rot_dims = (img.ndim-2, img.ndim-1)
+    flips = [(), (img.ndim-1,)]
+    if img.ndim == 5:
+        flips += [(2,), (2, img.ndim-1)]
+    # Transformations that do not change the shape first, so non-square images can be batched too
+    transforms = [(k, f) for k in [0, 2, 1, 3] for f in flips]
+
+    def _transform(x, k, f):
+        x = torch.flip(x, f) if len(f) > 0 else x
+        return torch.rot90(x, k, rot_dims) if k > 0 else x
+
+    def _undo(x, k, f):
+        x = torch.rot90(x, -k, rot_dims) if k > 0 else x
+        return torch.flip(x, f) if len(f) > 0 else x
+
+    out = None
+    start = 0
+    while start < len(transforms):
+        # Each batch only contains transformations of the same shape
+        end = start+1
+        while end < len(transforms) and end-start < batch_size_value and transforms[end][0]%2 == transforms[start][0]%2:
+            end += 1
+        batch = torch.cat([_transform(img, k, f) for k, f in transforms[start:end]])
+        with torch.cuda.amp.autocast():
+            r_aux = pred_func(batch)
+        multiple_outputs = isinstance(r_aux, list)
+        r_aux = r_aux if multiple_outputs else [r_aux]
+        r_aux = [torch.stack([_undo(r[j:j+1], k, f) for j, (k, f) in enumerate(transforms[start:end])]).float().sum(0) 
+            for r in r_aux]
+        out = r_aux if out is None else [o+r for o, r in zip(out, r_aux)]
+        start = end
+    del batch, r_aux
+
+    out = [o/len(transforms) for o in out]
+    return out if multiple_outputs else out[0]
+
+
 def create_th_plot(ths, y_list, th_name="TH_BINARY_MASK", chart_dir=None, per_sample=True, ideal_value=None):
     """Create plots for threshold value calculation.
 
@@ -965,7 +1304,65 @@ def voronoi_on_mask(data, mask, th=0, verbose=False):
     return voronoiCyst
 
 
-def remove_close_points(points, radius, resolution, classes=None, ndim=3, return_drops=False):
+def _close_point_neighbors(points, radius, num_workers=1):
+    """
+    Find the neighbours of each point that are at ``radius`` or less distance. When ``num_workers`` is greater than 
+    ``1`` the points are split into slabs along the first axis, each one extended with a halo of ``radius`` so all 
+    the neighbours of its points are seen, and the slabs are processed in parallel.
+
+    Parameters
+    ----------
+    points : 2D Numpy array of floats
+        Calibrated coordinates of the points. E.g. ``(num_of_points, 3)``.
+
+    radius : float
+        Distance to consider two points neighbours. E.g. ``10.0``.
+
+    num_workers : int, optional
+        Number of slabs processed in parallel.
+
+    Returns
+    -------
+    indptr : 1D Numpy array of ints
+        Neighbours of point ``i`` are ``indices[indptr[i]:indptr[i+1]]`` (CSR layout). 
+
+    indices : 1D Numpy array of ints
+        Neighbour indices of all points.
+    """
+    npoints = len(points)
+    num_workers = max(1, min(num_workers, npoints//1000))
+    if num_workers == 1:
+        pairs = cKDTree(points).query_pairs(radius, output_type='ndarray')
+        src = np.concatenate([pairs[:,0], pairs[:,1]])
+        dst = np.concatenate([pairs[:,1], pairs[:,0]])
+    else:
+        order = np.argsort(points[:,0], kind='stable')
+        first_axis = points[order,0]
+        bounds = np.linspace(0, npoints, num_workers+1).astype(int)
+
+        def _slab_neighbors(t):
+            # Core of the slab plus the points at radius distance at most in the first axis
+            start = np.searchsorted(first_axis, first_axis[bounds[t]]-radius, side='left')
+            end = np.searchsorted(first_axis, first_axis[bounds[t+1]-1]+radius, side='right')
+            pairs = cKDTree(points[order[start:end]]).query_pairs(radius, output_type='ndarray')
+            in_core = (pairs >= bounds[t]-start) & (pairs < bounds[t+1]-start)
+            pairs = order[start+pairs]
+            # Each directed edge is only taken by the slab of its source point
+            return (np.concatenate([pairs[in_core[:,0],0], pairs[in_core[:,1],1]]),
+                np.concatenate([pairs[in_core[:,0],1], pairs[in_core[:,1],0]]))
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            slabs = list(executor.map(_slab_neighbors, range(num_workers)))
+        src = np.concatenate([x[0] for x in slabs])
+        dst = np.concatenate([x[1] for x in slabs])
+
+    indices = dst[np.argsort(src, kind='stable')]
+    indptr = np.zeros(npoints+1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=npoints), out=indptr[1:])
+    return indptr, indices
+
+def remove_close_points(points, radius, resolution, classes=None, ndim=3, return_drops=False, probabilities=None, 
+    num_workers=1):
     """
     Remove all points from ``point_list`` that are at a ``radius``
     or less distance from each other.
@@ -987,6 +1384,13 @@ def remove_close_points(points, radius, resolution, classes=None, ndim=3, return
 
     return_drops : bool, optional
         Whether to return or not a list containing the positions of the points removed. 
+
+    probabilities : ndarray of floats, optional
+        Predicted probability of each point. If given, the points with higher probability are visited first, so 
+        they are kept over their neighbours. Otherwise, the points are visited in the order they are given.
+
+    num_workers : int, optional
+        Number of threads to find the neighbours of the points. 
         
     Returns
     -------
@@ -997,46 +1401,29 @@ def remove_close_points(points, radius, resolution, classes=None, ndim=3, return
     print("Removing close points . . .")
     print('Initial number of points: ' + str( len( points ) ) )
 
-    point_list = points.copy()
-    if classes is not None:
-        class_list = classes.copy()
+    if len(points) == 0:
+        return []
 
     # Resolution adjust
-    for i in range(len(point_list)):
-        point_list[i][0] = point_list[i][0]* resolution[0]
-        point_list[i][1] = point_list[i][1]* resolution[1]
-        if ndim == 3:
-            point_list[i][2] = point_list[i][2]* resolution[2]
+    point_list = np.array(points, dtype=np.float64).reshape(len(points), -1)
+    point_list[:,-ndim:] *= np.array(resolution[:ndim], dtype=np.float64)
 
-    mynumbers = [tuple(point) for point in point_list] 
-
-    if len(mynumbers) == 0:
-        return []
-        
-    tree = cKDTree(mynumbers) # build k-dimensional tree
-    
-    pairs = tree.query_pairs( radius ) # find all pairs closer than radius
+    indptr, indices = _close_point_neighbors(point_list, radius, num_workers=num_workers)
     
-    neighbors = {} # create dictionary of neighbors
-
-    for i,j in pairs: # iterate over all pairs
-        if i not in neighbors:
-            neighbors[i] = {j}
-        else:
-            neighbors[i].add(j)
-        if j not in neighbors:
-            neighbors[j] = {i}
-        else:
-            neighbors[j].add(i)
-            
-    positions = [i for i in range(0, len( point_list ))]
-    
-    keep = []
-    discard = set()
-    for node in positions:
-        if node not in discard: # if node already in discard set: skip
-            keep.append(node) # add node to keep list
-            discard.update(neighbors.get(node,set())) # add node's neighbors to discard set
+    if probabilities is not None:
+        positions = np.argsort(-np.asarray(probabilities, dtype=np.float64).reshape(-1), kind='stable')
+    else:
+        positions = np.arange(len(point_list))
+
+    # Points without neighbours are always kept so only the rest need to be visited
+    degree = np.diff(indptr)
+    keep = degree == 0
+    discard = np.zeros(len(point_list), dtype=bool)
+    for node in positions[degree[positions] > 0]:
+        if not discard[node]: # if node already discarded: skip
+            keep[node] = True
+            discard[indices[indptr[node]:indptr[node+1]]] = True # discard node's neighbors
+    keep = np.flatnonzero(keep)
 
     # points to keep
     new_point_list = [points[i] for i in keep]
@@ -1045,12 +1432,12 @@ def remove_close_points(points, radius, resolution, classes=None, ndim=3, return
     if classes is not None:
         new_class_list = [classes[i] for i in keep]
         if return_drops:
-            return new_point_list, new_class_list, list(discard)
+            return new_point_list, new_class_list, np.flatnonzero(discard).tolist()
         else:
             return new_point_list, new_class_list
     else:
         if return_drops:
-            return new_point_list, list(discard)
+            return new_point_list, np.flatnonzero(discard).tolist()
         else:
             return new_point_list
     
@@ -1472,51 +1859,28 @@ def measure_morphological_props_and_filter(img, resolution, filter_instances=Fal
     correct_str = "Correct"
     unsure_str = "Removed"
 
-    comment = []
-    label_list = []
-    label_list, npixels = np.unique(img, return_counts=True)
-    
-    # Delete background instance '0'
-    label_list = label_list[1:] 
-    npixels = npixels[1:]
-
-    total_labels = len(label_list)
-    comment = ['none' for i in range(total_labels)]
-
-    # Measure array definitions
-    areas = np.zeros(total_labels, dtype=np.uint32)
-    diameters = np.zeros(total_labels, dtype=np.uint32)
-    centers = np.zeros((total_labels, 3 if image3d else 2), dtype=np.uint16)
-    circularities = np.zeros(total_labels, dtype=np.float32)
-    perimeters = np.zeros(total_labels, dtype=np.uint32)
-    if not image3d:
-        elongations = np.zeros(total_labels, dtype=np.float32)    
-
-    # Area, diameter, center, circularity (if 2D), elongation (if 2D) and perimeter (if 2D) calculation over the whole image 
-    lprops = ['label', 'bbox', 'perimeter'] if not image3d else ['label', 'bbox']
+    # Area, diameter, center, circularity (if 2D), elongation (if 2D) and perimeter (if 2D) of all the instances at once. 
+    # Each column is sorted by label
+    lprops = ['label', 'area', 'bbox', 'perimeter'] if not image3d else ['label', 'area', 'bbox']
     props = regionprops_table(img, properties=(lprops)) 
-    for k, l in tqdm(enumerate(props['label']), total=len(props['label']), leave=False):
-        label_index = np.where(label_list == l)[0]
-        pixels = npixels[label_index]
-
-        if image3d:
-            vol = pixels*(resolution[0]+resolution[1]+resolution[2])
-            diam = max(props['bbox-3'][k]-props['bbox-0'][k],props['bbox-4'][k]-props['bbox-1'][k],props['bbox-5'][k]-props['bbox-2'][k])
-            center = [(props['bbox-3'][k]-props['bbox-0'][k])//2, (props['bbox-4'][k]-props['bbox-1'][k])//2, (props['bbox-5'][k]-props['bbox-2'][k])//2]
-        else:
-            vol = pixels*(resolution[0]+resolution[1])
-            diam = max(props['bbox-2'][k]-props['bbox-0'][k],props['bbox-3'][k]-props['bbox-1'][k])
-            center = [(props['bbox-2'][k]-props['bbox-0'][k])//2, (props['bbox-3'][k]-props['bbox-1'][k])//2]
-            perimeter = props['perimeter'][k]
-            elongations[label_index] = (perimeter*perimeter)/(4 * math.pi * pixels) if pixels > 0 else 0 
-            circularity = (4 * math.pi * pixels) / (perimeter*perimeter) if perimeter > 0 else 0
-
-            perimeters[label_index] = perimeter
-            circularities[label_index] = circularity
+    label_list = props['label']
+    npixels = props['area'].astype(np.int64)
+    total_labels = len(label_list)
 
-        areas[label_index] = vol
-        diameters[label_index] = diam
-        centers[label_index] = center
+    ndim = 3 if image3d else 2
+    extents = np.stack([props['bbox-{}'.format(i+ndim)]-props['bbox-{}'.format(i)] for i in range(ndim)], axis=-1)
+    areas = (npixels*sum(resolution[:ndim])).astype(np.uint32)
+    diameters = (extents.max(axis=-1) if total_labels > 0 else np.zeros(0)).astype(np.uint32)
+    centers = (extents//2).astype(np.uint16)
+    if image3d:
+        circularities = np.zeros(total_labels, dtype=np.float32)
+        perimeters = np.zeros(total_labels, dtype=np.uint32)
+    else:
+        perimeter = props['perimeter']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            elongations = np.where(npixels > 0, (perimeter*perimeter)/(4 * math.pi * npixels), 0).astype(np.float32)
+            circularities = np.where(perimeter > 0, (4 * math.pi * npixels)/(perimeter*perimeter), 0).astype(np.float32)
+        perimeters = perimeter.astype(np.uint32)
 
     # Calculate surface area (as in https://github.com/scikit-image/scikit-image/issues/3797) and sphericity
     if image3d and total_labels > 0:
@@ -1528,72 +1892,47 @@ def measure_morphological_props_and_filter(img, resolution, filter_instances=Fal
         except: 
             print("Some error found during marching_cubes() call")
         else:
-            lst = [[] for i in range(total_labels+1)]
-            for i in fs: lst[int(cs[i[0]])].append(i)
-            surface_area = [0 if len(i)==0 else mesh_surface_area(vts, i) for i in lst]
-
-            for i in range(total_labels):
-                sphericity = (36 * math.pi * pixels * pixels) / (surface_area[i+1] * surface_area[i+1] * surface_area[i+1]) if surface_area[i+1] > 0 else 0
-                perimeters[i] = surface_area[i+1]
-                circularities[i] = sphericity
-
-    # Remove those instances that do not satisfy the properties      
-    conditions = []
-    labels_removed = 0
-    for i in tqdm(range(len(circularities)), leave=False):
-        conditions.append([])
-        if filter_instances:
-            for k, list_of_conditions in enumerate(properties):
-                # Check each list of conditions
-                comps = []
-                for j, prop in enumerate(list_of_conditions):
-                    if prop == "circularity":
-                        value_to_compare = circularities[i]
-                    elif prop == "npixels":
-                        value_to_compare = npixels[i]
-                    elif prop == "area":
-                        value_to_compare = areas[i]
-                    elif prop == "diameter":
-                        value_to_compare = diameters[i]
-                    elif prop == "perimeter":
-                        value_to_compare = perimeters[i]
-                    elif prop == "elongation":
-                        value_to_compare = elongations[i]
-
-                    if comp_signs[k][j] == "gt":
-                        if value_to_compare > prop_values[k][j]:
-                            comps.append(True)
-                        else:
-                            comps.append(False)
-                    elif comp_signs[k][j] == "ge":
-                        if value_to_compare >= prop_values[k][j]:
-                            comps.append(True)
-                        else:
-                            comps.append(False)
-                    elif comp_signs[k][j] == "lt":
-                        if value_to_compare < prop_values[k][j]:
-                            comps.append(True)
-                        else:
-                            comps.append(False)
-                    elif comp_signs[k][j] == "le":
-                        if value_to_compare <= prop_values[k][j]:
-                            comps.append(True)
-                        else:
-                            comps.append(False)
-
-                # Check if the conditions where satified
-                if all(comps):
-                    conditions[-1].append(True)
-                else:
-                    conditions[-1].append(False)            
-        
-        # If satisfied all conditions remove the instance 
-        if any(conditions[-1]):
-            comment[i] = unsure_str
-            img[img==label_list[i]] = 0
-            labels_removed += 1
+            # Area of each triangle accumulated in the instance of its first vertex
+            tri = vts[fs]
+            tri_areas = np.linalg.norm(np.cross(tri[:,1]-tri[:,0], tri[:,2]-tri[:,0]), axis=-1)/2
+            surface_area = np.bincount(cs[fs[:,0]].astype(np.int64), weights=tri_areas, minlength=total_labels+1)[1:total_labels+1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                circularities = np.where(surface_area > 0, (36 * math.pi * npixels * npixels)/(surface_area*surface_area*surface_area), 
+                    0).astype(np.float32)
+            perimeters = surface_area.astype(np.uint32)
+
+    # Evaluate each list of conditions over all the instances at once
+    conditions = np.zeros((total_labels, 0), dtype=bool)
+    if filter_instances:
+        values = {'circularity': circularities, 'npixels': npixels, 'area': areas, 'diameter': diameters, 
+            'perimeter': perimeters}
+        if image3d:
+            values['sphericity'] = circularities
+        else:
+            values['elongation'] = elongations
+        comparisons = {'gt': np.greater, 'ge': np.greater_equal, 'lt': np.less, 'le': np.less_equal}
+        satisfied = []
+        for k, list_of_conditions in enumerate(properties):
+            comps = np.ones(total_labels, dtype=bool)
+            for j, prop in enumerate(list_of_conditions):
+                if comp_signs[k][j] in comparisons:
+                    comps &= comparisons[comp_signs[k][j]](values[prop], prop_values[k][j])
+            satisfied.append(comps)
+        if len(satisfied) > 0:
+            conditions = np.stack(satisfied, axis=-1)
+
+    # If satisfied all conditions of any list remove the instance 
+    removed = conditions.any(axis=-1)
+    labels_removed = int(removed.sum())
+    comment = np.where(removed, unsure_str, correct_str).tolist()
+    conditions = conditions.tolist()
+    if labels_removed > 0:
+        if label_list[-1] <= img.size:
+            remove_lut = np.zeros(label_list[-1]+1, dtype=bool)
+            remove_lut[label_list[removed]] = True
+            img[remove_lut[img]] = 0
         else:
-            comment[i] = correct_str
+            img[np.isin(img, label_list[removed])] = 0
 
     d_result = {
         'labels': label_list,
@@ -1614,6 +1953,48 @@ def measure_morphological_props_and_filter(img, resolution, filter_instances=Fal
 
     return img, d_result
     
+def assign_instance_classes(instances, class_channel):
+    """
+    Classify each instance with the most common class of its pixels (majority vote), ignoring the background class 
+    (``0``). All the votes are counted at once with a label x class histogram. In case of a tie the lowest class is 
+    selected, and the instances without class information are set to class ``1``.
+
+    Parameters
+    ----------
+    instances : 2D/3D Numpy array
+        Image with instances. E.g. ``(1450, 2000)`` for 2D and ``(397, 1450, 2000)`` for 3D.
+
+    class_channel : Numpy array
+        Class of each pixel. It must have the same number of elements as ``instances``. E.g. ``(397, 1450, 2000, 1)``.
+
+    Returns
+    -------
+    instance_classes : 2D/3D Numpy array
+        Class of each instance painted over it. Same shape and data type as ``instances``. 
+    """
+    instances = np.asarray(instances)
+    class_channel = np.asarray(class_channel).reshape(instances.shape)
+    if instances.size == 0 or instances.max() <= 0:
+        return np.zeros(instances.shape, dtype=instances.dtype)
+
+    # Votes of the foreground pixels with class information
+    mask = (instances > 0) & (class_channel > 0)
+    voters = instances[mask]
+    classes, class_idx = np.unique(class_channel[mask], return_inverse=True)
+    labels, label_idx = np.unique(voters, return_inverse=True)
+    del mask, voters
+
+    # label x class histogram. argmax returns the first maximum, i.e. the lowest class, as np.unique sorts them
+    hist = np.bincount(label_idx.ravel()*len(classes)+class_idx.ravel(), minlength=len(labels)*len(classes))
+    hist = hist.reshape(len(labels), len(classes))
+
+    # Paint the class of each instance with a look-up table. Class 1 by default
+    lut = np.ones(int(instances.max())+1, dtype=instances.dtype)
+    lut[0] = 0
+    if len(labels) > 0:
+        lut[labels.astype(np.int64)] = classes[np.argmax(hist, axis=1)].astype(instances.dtype)
+    return lut[instances]
+
 def find_neighbors(img, label, neighbors=1):
     """
     Find neighbors of a label in a given image. 
@@ -28,10 +28,10 @@ def _spline_window(window_size, power=2):
     https://www.wolframalpha.com/input/?i=y%3Dx**2,+y%3D-(x-2)**2+%2B2,+y%3D(x-4)**2,+from+y+%3D+0+to+2
     """
     intersection = int(window_size/4)
-    wind_outer = (abs(2*(scipy.signal.triang(window_size))) ** power)/2
+    wind_outer = (abs(2*(scipy.signal.windows.triang(window_size))) ** power)/2
     wind_outer[intersection:-intersection] = 0
 
-    wind_inner = 1 - (abs(2*(scipy.signal.triang(window_size) - 1)) ** power)/2
+    wind_inner = 1 - (abs(2*(scipy.signal.windows.triang(window_size) - 1)) ** power)/2
     wind_inner[:intersection] = 0
     wind_inner[-intersection:] = 0
 
@@ -66,6 +66,27 @@ def _window_2D(window_size, power=2):
     return wind
 
 
+cached_3d_windows = dict()
+def _window_3D(window_shape, power=2):
+    """
+    Make a 3D window function of shape ``(z, y, x, 1)`` multiplying the 1D spline window of each axis. 
+    Unlike :func:`_window_2D`, each axis can have a different size.
+    """
+    # Memoization
+    global cached_3d_windows
+    key = "{}_{}".format(tuple(window_shape), power)
+    if key in cached_3d_windows:
+        wind = cached_3d_windows[key]
+    else:
+        wind_z = _spline_window(window_shape[0], power)
+        wind_y = _spline_window(window_shape[1], power)
+        wind_x = _spline_window(window_shape[2], power)
+        wind = wind_z[:, None, None] * wind_y[None, :, None] * wind_x[None, None, :]
+        wind = np.expand_dims(wind, -1).astype(np.float32)
+        cached_3d_windows[key] = wind
+    return wind
+
+
 def _pad_img(img, window_size, subdivisions):
     """
     Add borders to img for a "valid" border pattern according to "window_size" and
@@ -271,6 +292,90 @@ def predict_img_with_smooth_windowing(input_img, window_size, subdivisions, n_cl
         plt.show()
     return prd
 
+def predict_img_with_smooth_windowing_streaming(input_img, window_size, subdivisions, pred_func, batch_size=1, tta=False):
+    """
+    Streaming version of `predict_img_with_smooth_windowing`. The windows are cut from the padded image only when they
+    are going to be predicted, passed to ``pred_func`` in batches and their predictions, weighted with the spline window,
+    accumulated into one output image. So, apart from the input image, only the output image and a weight map are kept
+    in memory, instead of all the windows of the 8 rotated/mirrored images.
+
+    Parameters
+    ----------
+    input_img : 3D Numpy array
+        Image to predict. E.g. ``(y, x, channels)``.
+
+    window_size : int or tuple of 2 ints
+        Size of the windows. E.g. ``256`` or ``(256, 512)``.
+
+    subdivisions : int
+        Number of windows that overlap in each axis, i.e. the step between windows is ``window_size/subdivisions``.
+
+    pred_func : function
+        Function to make predictions. It receives a batch of windows, e.g. ``(batch, y, x, channels)`` Numpy array, and
+        must return their predictions, e.g. ``(batch, y, x, n_classes)`` Numpy array.
+
+    batch_size : int, optional
+        Number of windows passed to ``pred_func`` at once.
+
+    tta : bool, optional
+        Whether to predict each window with its 8 possible rotations and mirrors (D4 dihedral group), averaging them,
+        instead of creating the 8 rotated/mirrored images first.
+
+    Returns
+    -------
+    prd : 3D Numpy array
+        Prediction. E.g. ``(y, x, n_classes)``.
+    """
+    window_size = (window_size, window_size) if isinstance(window_size, int) else tuple(window_size)
+    window = _spline_window(window_size[0], power=2)[:, None] * _spline_window(window_size[1], power=2)[None, :]
+    window = np.expand_dims(window, -1).astype(np.float32)
+    step = [int(w/subdivisions) for w in window_size]
+    aug = [int(round(w * (1 - 1.0/subdivisions))) for w in window_size]
+    # Pad more at the end when the image is smaller than a window
+    extra = [max(0, window_size[i]-input_img.shape[i]-2*aug[i]) for i in range(2)]
+    pad = np.pad(input_img, pad_width=((aug[0], aug[0]+extra[0]), (aug[1], aug[1]+extra[1]), (0, 0)), mode='reflect')
+
+    # Windows' top left corners. An extra window is added at the end of each axis when the step does not reach it
+    corners = []
+    for i in range(2):
+        c = list(range(0, pad.shape[i]-window_size[i]+1, step[i]))
+        if c[-1] != pad.shape[i]-window_size[i]:
+            c.append(pad.shape[i]-window_size[i])
+        corners.append(c)
+    corners = [(i, j) for i in corners[0] for j in corners[1]]
+
+    def _predict(batch):
+        if not tta:
+            return pred_func(batch)
+        out = 0
+        for mirror in [False, True]:
+            b = batch[:, :, ::-1] if mirror else batch
+            for k in range(4):
+                p = pred_func(np.ascontiguousarray(np.rot90(b, k=k, axes=(1, 2))))
+                p = np.rot90(p, k=-k, axes=(1, 2))
+                out = out + (p[:, :, ::-1] if mirror else p)
+        return out / 8
+
+    y = None
+    weights = np.zeros(pad.shape[:2]+(1,), dtype=np.float32)
+    for start in tqdm(range(0, len(corners), batch_size), leave=False):
+        batch_corners = corners[start:start+batch_size]
+        batch = np.stack([pad[i:i+window_size[0], j:j+window_size[1]] for i, j in batch_corners])
+        p = _predict(batch)
+        if isinstance(p, list):
+            p = p[-1]
+        if y is None:
+            y = np.zeros(pad.shape[:2]+(p.shape[-1],), dtype=np.float32)
+        for (i, j), patch in zip(batch_corners, p):
+            y[i:i+window_size[0], j:j+window_size[1]] += patch * window
+            weights[i:i+window_size[0], j:j+window_size[1]] += window
+    del pad
+
+    # Normalize with the weights instead of with 'subdivisions ** 2', so the borders are correct too
+    y = y[aug[0]:aug[0]+input_img.shape[0], aug[1]:aug[1]+input_img.shape[1]]
+    y /= weights[aug[0]:aug[0]+input_img.shape[0], aug[1]:aug[1]+input_img.shape[1]]
+    return y
+
 def predict_img_with_overlap(input_img, window_size, subdivisions, n_classes, pred_func):
     """Based on predict_img_with_smooth_windowing but works just with the 
        original image instead of creating 8 new ones.
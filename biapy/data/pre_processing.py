@@ -4,6 +4,7 @@ import scipy
 import h5py
 import numpy as np
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from skimage.segmentation import clear_border, find_boundaries
 from skimage.io import imread
@@ -47,33 +48,29 @@ def create_instance_channels(cfg, data_type='train'):
     tag = "TRAIN" if data_type == "train" else "VAL"
     Y, _, _, filenames = f_name(getattr(cfg.DATA, tag).GT_PATH, check_drange=False, return_filenames=True)
     print("Creating Y_{} channels . . .".format(data_type))
-    if isinstance(Y, list):
-        for i in tqdm(range(len(Y)), disable=not is_main_process()):
-            if cfg.MODEL.N_CLASSES > 2:
-                if Y[i].shape[-1] != 2:
-                    raise ValueError("In instance segmentation, when 'MODEL.N_CLASSES' are more than 2 labels need to have two channels, "
-                        "e.g. (256,256,2), containing the instance segmentation map (first channel) and classification map (second channel).")
-                else:
-                    class_channel = np.expand_dims(Y[i,...,1].copy(),-1)
-                    Y[i] = labels_into_channels(Y[i], mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CHANNELS, save_dir=getattr(cfg.PATHS, tag+'_INSTANCE_CHANNELS_CHECK'),
-                        fb_mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CONTOUR_MODE)
-                    Y[i] = np.concatenate([Y[i],class_channel],axis=-1)
-            else:
-                Y[i] = labels_into_channels(Y[i], mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CHANNELS, save_dir=getattr(cfg.PATHS, tag+'_INSTANCE_CHANNELS_CHECK'),
-                    fb_mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CONTOUR_MODE)
-    else:
+
+    def _instance_channels(y, num_workers, save_dir):
         if cfg.MODEL.N_CLASSES > 2:
-            if Y.shape[-1] != 2:
+            if y.shape[-1] != 2:
                 raise ValueError("In instance segmentation, when 'MODEL.N_CLASSES' are more than 2 labels need to have two channels, "
                     "e.g. (256,256,2), containing the instance segmentation map (first channel) and classification map (second channel).")
-            else:
-                class_channel = np.expand_dims(Y[...,1].copy(),-1)
-                Y = labels_into_channels(Y, mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CHANNELS, save_dir=getattr(cfg.PATHS, tag+'_INSTANCE_CHANNELS_CHECK'),
-                    fb_mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CONTOUR_MODE)
-                Y = np.concatenate([Y, class_channel], axis=-1)
-        else:
-            Y = labels_into_channels(Y, mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CHANNELS, save_dir=getattr(cfg.PATHS, tag+'_INSTANCE_CHANNELS_CHECK'),
-                fb_mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CONTOUR_MODE)
+            class_channel = np.expand_dims(y[...,1].copy(),-1)
+        y = labels_into_channels(y, mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CHANNELS, save_dir=save_dir,
+            fb_mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CONTOUR_MODE, num_workers=num_workers)
+        if cfg.MODEL.N_CLASSES > 2:
+            y = np.concatenate([y, class_channel], axis=-1)
+        return y
+
+    if isinstance(Y, list):
+        # Workers are split between the samples and the Z blocks of each sample. Only the first sample is saved for 
+        # debugging, so the threads do not write the same files
+        sample_workers = max(1, min(cfg.SYSTEM.NUM_CPUS, len(Y)))
+        with ThreadPoolExecutor(max_workers=sample_workers) as executor:
+            Y = list(tqdm(executor.map(lambda i: _instance_channels(Y[i], max(1, cfg.SYSTEM.NUM_CPUS//sample_workers), 
+                getattr(cfg.PATHS, tag+'_INSTANCE_CHANNELS_CHECK') if i == 0 else None), range(len(Y))), total=len(Y), 
+                disable=not is_main_process()))
+    else:
+        Y = _instance_channels(Y, cfg.SYSTEM.NUM_CPUS, getattr(cfg.PATHS, tag+'_INSTANCE_CHANNELS_CHECK'))
     
     save_tif(Y, data_dir=getattr(cfg.DATA, tag).INSTANCE_CHANNELS_MASK_DIR, filenames=filenames, verbose=cfg.TEST.VERBOSE)
     X, _, _, filenames = f_name(getattr(cfg.DATA, tag).PATH, return_filenames=True)
@@ -102,12 +99,17 @@ def create_test_instance_channels(cfg):
         Y_test, _, _, test_filenames = f_name(cfg.DATA.TEST.GT_PATH, check_drange=False, return_filenames=True)
         print("Creating Y_test channels . . .")
         if isinstance(Y_test, list):
-            for i in tqdm(range(len(Y_test)), disable=not is_main_process()):
-                Y_test[i] = labels_into_channels(Y_test[i], mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CHANNELS, save_dir=cfg.PATHS.TEST_INSTANCE_CHANNELS_CHECK,
-                                            fb_mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CONTOUR_MODE)
+            # Workers are split between the samples and the Z blocks of each sample. Only the first sample is saved for 
+            # debugging, so the threads do not write the same files
+            sample_workers = max(1, min(cfg.SYSTEM.NUM_CPUS, len(Y_test)))
+            with ThreadPoolExecutor(max_workers=sample_workers) as executor:
+                Y_test = list(tqdm(executor.map(lambda i: labels_into_channels(Y_test[i], mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CHANNELS, 
+                    save_dir=cfg.PATHS.TEST_INSTANCE_CHANNELS_CHECK if i == 0 else None, fb_mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CONTOUR_MODE, 
+                    num_workers=max(1, cfg.SYSTEM.NUM_CPUS//sample_workers)), range(len(Y_test))), total=len(Y_test), 
+                    disable=not is_main_process()))
         else:
             Y_test = labels_into_channels(Y_test, mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CHANNELS, save_dir=cfg.PATHS.TEST_INSTANCE_CHANNELS_CHECK,
-                                     fb_mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CONTOUR_MODE)
+                                     fb_mode=cfg.PROBLEM.INSTANCE_SEG.DATA_CONTOUR_MODE, num_workers=cfg.SYSTEM.NUM_CPUS)
         save_tif(Y_test, data_dir=cfg.DATA.TEST.INSTANCE_CHANNELS_MASK_DIR, filenames=test_filenames, verbose=cfg.TEST.VERBOSE)
 
     print("Creating X_test channels . . .")
@@ -121,7 +123,7 @@ def create_test_instance_channels(cfg):
         else:
             save_tif(np.expand_dims(X_test[i],0), cfg.PATHS.TEST_INSTANCE_CHANNELS_CHECK, filenames=['vol'+str(i)+".tif"], verbose=True)
 
-def labels_into_channels(data_mask, mode="BC", fb_mode="outer", save_dir=None):
+def labels_into_channels(data_mask, mode="BC", fb_mode="outer", save_dir=None, num_workers=1):
     """Converts input semantic or instance segmentation data masks into different binary channels to train an instance segmentation
        problem. 
 
@@ -142,6 +144,9 @@ def labels_into_channels(data_mask, mode="BC", fb_mode="outer", save_dir=None):
        save_dir : str, optional
            Path to store samples of the created array just to debug it is correct.
 
+       num_workers : int, optional
+           Number of threads used to process the samples and, in 3D, the Z blocks of each sample.
+
        Returns
        -------
        new_mask : 5D Numpy array
@@ -165,7 +170,11 @@ def labels_into_channels(data_mask, mode="BC", fb_mode="outer", save_dir=None):
         dtype = np.uint8
 
     new_mask = np.zeros(data_mask.shape[:d_shape] + (c_number,), dtype=dtype)
-    for img in tqdm(range(data_mask.shape[0]), disable=not is_main_process()):
+    # Workers are split between samples and Z blocks of each sample 
+    sample_workers = max(1, min(num_workers, data_mask.shape[0]))
+    block_workers = max(1, num_workers//sample_workers) if data_mask.ndim == 5 and fb_mode != "subpixel" else 1
+
+    def _sample_channels(img):
         vol = data_mask[img,...,0].astype(np.int64)
         instances = np.unique(vol)
         instance_count = len(instances)
@@ -203,7 +212,17 @@ def labels_into_channels(data_mask, mode="BC", fb_mode="outer", save_dir=None):
         # Contour
         if ('C' in mode or 'Dv2' in mode) and instance_count != 1: 
             f = "thick" if fb_mode == "dense" else fb_mode
-            new_mask[img,...,1] = find_boundaries(vol, mode=f).astype(np.uint8)
+            if block_workers > 1:
+                # Boundaries only depend on the neighboring voxels, so each Z block is processed with one slice of halo 
+                def _block_boundaries(z):
+                    z0, z1 = max(z-1, 0), min(z+block_size+1, vol.shape[0])
+                    b = find_boundaries(vol[z0:z1], mode=f).astype(np.uint8)
+                    new_mask[img,z:min(z+block_size, vol.shape[0]),...,1] = b[z-z0:z-z0+min(block_size, vol.shape[0]-z)]
+                block_size = int(np.ceil(vol.shape[0]/block_workers))
+                with ThreadPoolExecutor(max_workers=block_workers) as executor:
+                    list(executor.map(_block_boundaries, range(0, vol.shape[0], block_size)))
+            else:
+                new_mask[img,...,1] = find_boundaries(vol, mode=f).astype(np.uint8)
             if fb_mode == "dense" and mode != "BCM":
                 if new_mask[img,...,1].ndim == 2:
                     new_mask[img,...,1] = 1 - binary_dilation(new_mask[img,...,1], disk(1))
@@ -220,11 +239,23 @@ def labels_into_channels(data_mask, mode="BC", fb_mode="outer", save_dir=None):
         if ('D' in mode or 'Dv2' in mode) and instance_count != 1:
             # Foreground distance
             new_mask[img,...,-1] = scipy.ndimage.distance_transform_edt(new_mask[img,...,0])
-            props = regionprops(vol, new_mask[img,...,-1])
-            max_values = np.zeros(vol.shape)
-            for i in range(len(props)):
-                max_values = np.where(vol==props[i].label, props[i].intensity_max, max_values)     
+            # Maximum distance of each instance computed at once and painted with a look-up table
+            labels = instances[instances > 0]
+            max_values = np.zeros(len(labels)+1, dtype=np.float64)
+            max_values[1:] = scipy.ndimage.maximum(new_mask[img,...,-1], labels=vol, index=labels)
+            if labels[-1] <= vol.size:
+                lut = np.zeros(labels[-1]+1, dtype=np.float64)
+                lut[labels] = max_values[1:]
+                max_values = lut[vol]
+            else: # Sparse labels: index them by their position among the sorted labels
+                max_values = max_values[np.where(vol > 0, np.searchsorted(labels, vol)+1, 0)]
             new_mask[img,...,-1] = max_values - new_mask[img,...,-1]
+        return instance_count
+
+    with ThreadPoolExecutor(max_workers=sample_workers) as executor:
+        instance_counts = list(tqdm(executor.map(_sample_channels, range(data_mask.shape[0])), total=data_mask.shape[0], 
+            disable=not is_main_process()))
+    instance_count = instance_counts[-1]
 
     # Normalize and merge distance channels
     if 'Dv2' in mode:
@@ -992,7 +1023,8 @@ def percentile_norm(x, lower=0.1, upper=99.9, lwr_perc_val=None,
     if x_upr - x_lwr > 1e-3:
         x = (x - x_lwr) / (x_upr - x_lwr)
     else:
-        x[:] = 0    
+        # Not in place, as 'x' may be a view of the input data
+        x = x*0
     return np.clip(x, 0, 1).astype(np.float32), norm_steps
 
 def resize_images(images, **kwards):
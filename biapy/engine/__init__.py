@@ -37,7 +37,7 @@ def prepare_optimizer(cfg, model_without_ddp, steps_per_epoch):
             lr_scheduler = OneCycleLR(optimizer, cfg.TRAIN.LR, epochs=cfg.TRAIN.EPOCHS,
                 steps_per_epoch=steps_per_epoch)
 
-    loss_scaler = NativeScaler()
+    loss_scaler = NativeScaler(enabled=cfg.TRAIN.PRECISION == 'fp16')
 
     return optimizer, lr_scheduler, loss_scaler
 
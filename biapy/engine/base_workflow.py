@@ -15,16 +15,21 @@ import torch.distributed as dist
 
 from biapy.models import build_model, build_torchvision_model
 from biapy.engine import prepare_optimizer, build_callbacks
-from biapy.data.generators import create_train_val_augmentors, create_test_augmentor, check_generator_consistence
+from biapy.data.generators import create_train_val_augmentors, create_test_augmentor, check_generator_consistence, PrefetchGenerator, \
+    MultiEpochsDataLoader
 from biapy.utils.misc import (get_world_size, get_rank, is_main_process, save_model, time_text, load_model_checkpoint, TensorboardLogger,
     to_pytorch_format, to_numpy_format, is_dist_avail_and_initialized, setup_for_distributed)
 from biapy.utils.util import (load_data_from_dir, load_3d_images_from_dir, create_plots, pad_and_reflect, save_tif, check_downsample_division,
-    read_chunked_data, order_dimensions)
+    read_chunked_data, order_dimensions, share_array, chunked_data_compression)
 from biapy.engine.train_engine import train_one_epoch, evaluate
-from biapy.data.data_2D_manipulation import crop_data_with_overlap, merge_data_with_overlap, load_and_prepare_2D_train_data
+from biapy.data.data_2D_manipulation import (crop_data_with_overlap, merge_data_with_overlap, load_and_prepare_2D_train_data,
+    merge_data_with_overlap_coords)
 from biapy.data.data_3D_manipulation import (crop_3D_data_with_overlap, merge_3D_data_with_overlap, load_and_prepare_3D_data, 
-    load_and_prepare_3D_efficient_format_data, load_3D_efficient_files, extract_3D_patch_with_overlap_yield)
-from biapy.data.post_processing.post_processing import ensemble8_2d_predictions, ensemble16_3d_predictions, apply_binary_mask
+    load_and_prepare_3D_efficient_format_data, load_3D_efficient_files, extract_3D_patch_with_overlap_yield,
+    extract_3D_patch_coords_with_overlap, StreamingPatchMerger, SlabPatchAccumulator, _patch_axis_coords)
+from biapy.data.post_processing.smooth_tiled_predictions import predict_img_with_smooth_windowing_streaming
+from biapy.data.post_processing.post_processing import (ensemble8_2d_predictions, ensemble16_3d_predictions, ensemble_predictions,
+    apply_binary_mask)
 from biapy.engine.metrics import jaccard_index_numpy, voc_calculation
 from biapy.data.post_processing import apply_post_processing
 from biapy.data.pre_processing import preprocess_data
@@ -268,7 +273,8 @@ class Base_Workflow(metaclass=ABCMeta):
                         shuffle_val=self.cfg.DATA.VAL.RANDOM, crop_shape=self.cfg.DATA.PATCH_SIZE, 
                         y_upscaling=self.cfg.PROBLEM.SUPER_RESOLUTION.UPSCALING, 
                         ov=self.cfg.DATA.TRAIN.OVERLAP, padding=self.cfg.DATA.TRAIN.PADDING, 
-                        minimum_foreground_perc=self.cfg.DATA.TRAIN.MINIMUM_FOREGROUND_PER)
+                        minimum_foreground_perc=self.cfg.DATA.TRAIN.MINIMUM_FOREGROUND_PER, 
+                        cache_dir=self.cfg.PATHS.PATCH_INDEX_CACHE_DIR)
                     
                     if self.cfg.DATA.VAL.FROM_TRAIN:
                         if self.cfg.DATA.VAL.CROSS_VAL:
@@ -335,7 +341,8 @@ class Base_Workflow(metaclass=ABCMeta):
                             print("WARNING: 'DATA.FORCE_RGB' not taken into account when working with Zarr/H5 images")
 
                         self.X_val, _ = load_3D_efficient_files(data_path=img_files, input_axes=self.cfg.DATA.VAL.INPUT_IMG_AXES_ORDER,
-                            crop_shape=self.cfg.DATA.PATCH_SIZE, overlap=self.cfg.DATA.VAL.OVERLAP, padding=self.cfg.DATA.VAL.PADDING)
+                            crop_shape=self.cfg.DATA.PATCH_SIZE, overlap=self.cfg.DATA.VAL.OVERLAP, padding=self.cfg.DATA.VAL.PADDING,
+                            cache_dir=self.cfg.PATHS.PATCH_INDEX_CACHE_DIR)
 
                         if self.cfg.PROBLEM.NDIM == '2D':
                             crop_shape = (self.cfg.DATA.PATCH_SIZE[0]*self.cfg.PROBLEM.SUPER_RESOLUTION.UPSCALING[0],
@@ -348,7 +355,8 @@ class Base_Workflow(metaclass=ABCMeta):
                         if self.load_Y_val:
                             print("1) Loading validation GT information . . .")
                             self.Y_val, _ = load_3D_efficient_files(data_path=img_files, input_axes=self.cfg.DATA.VAL.INPUT_IMG_AXES_ORDER,
-                                crop_shape=crop_shape, overlap=self.cfg.DATA.VAL.OVERLAP, padding=self.cfg.DATA.VAL.PADDING, check_channel=False)                          
+                                crop_shape=crop_shape, overlap=self.cfg.DATA.VAL.OVERLAP, padding=self.cfg.DATA.VAL.PADDING, check_channel=False,
+                                cache_dir=self.cfg.PATHS.PATCH_INDEX_CACHE_DIR)                          
                         else:
                             self.Y_val = None
                         if self.Y_val is not None and len(self.X_val) != len(self.Y_val):
@@ -358,11 +366,40 @@ class Base_Workflow(metaclass=ABCMeta):
                     else:        
                         self.X_val, self.Y_val = None, None
 
+            if self.cfg.DATA.IN_MEMORY_BACKEND != 'numpy':
+                self.share_train_data()
+
         # Ensure all the processes have read the data                 
         if is_dist_avail_and_initialized():
             print("Waiting until all processes have read the data . . .")
             dist.barrier()
 
+    def share_train_data(self):
+        """
+        Place the training and validation data loaded into memory in shared memory (``DATA.IN_MEMORY_BACKEND``), so the 
+        data loader workers (and the processes of the same node with ``'memmap'``) read the same physical copy.
+        """
+        backend = self.cfg.DATA.IN_MEMORY_BACKEND
+        print("Placing training data in shared memory ({}) . . .".format(backend))
+        for name in ['X_train', 'Y_train', 'X_val', 'Y_val']:
+            data = getattr(self, name, None)
+            # Zarr/H5 patch information and lists of images of different shape are not shared 
+            if not isinstance(data, np.ndarray) or data.dtype.names is not None:
+                continue
+            if backend == 'shared_memory':
+                setattr(self, name, share_array(data, backend))
+            else:
+                npy_file = os.path.join(self.cfg.PATHS.SHARED_ARRAYS_DIR, name+".npy")
+                if is_main_process():
+                    shared_data = share_array(data, backend, npy_file)
+                # Other processes wait until the file is written and open it
+                if is_dist_avail_and_initialized():
+                    dist.barrier()
+                if not is_main_process():
+                    shared_data = share_array(None, backend, npy_file, create=False)
+                setattr(self, name, shared_data)
+            del data
+
     def destroy_train_data(self):
         """
         Delete training variable to release memory.
@@ -392,7 +429,8 @@ class Base_Workflow(metaclass=ABCMeta):
             self.train_generator, \
             self.val_generator, \
             self.data_norm, \
-            self.num_training_steps_per_epoch = create_train_val_augmentors(self.cfg, self.X_train, self.Y_train, 
+            self.num_training_steps_per_epoch, \
+            self.batch_augmentor = create_train_val_augmentors(self.cfg, self.X_train, self.Y_train, 
                 self.X_val, self.Y_val, self.world_size, self.global_rank, self.args.distributed)
             if self.cfg.DATA.CHECK_GENERATORS and self.cfg.PROBLEM.TYPE != 'CLASSIFICATION':
                 check_generator_consistence(
@@ -588,7 +626,9 @@ class Base_Workflow(metaclass=ABCMeta):
             print("~~~ Epoch {}/{} ~~~\n".format(epoch+1, self.cfg.TRAIN.EPOCHS))
             e_start = time.time()
 
-            if self.args.distributed:
+            if isinstance(self.train_generator, MultiEpochsDataLoader):
+                self.train_generator.set_epoch(epoch)
+            elif self.args.distributed:
                 self.train_generator.sampler.set_epoch(epoch)
             if self.log_writer is not None:
                 self.log_writer.set_step(epoch * self.num_training_steps_per_epoch)
@@ -598,7 +638,7 @@ class Base_Workflow(metaclass=ABCMeta):
                 activations=self.apply_model_activations, metric_function=self.metric_calculation, prepare_targets=self.prepare_targets, 
                 data_loader=self.train_generator, optimizer=self.optimizer, device=self.device, loss_scaler=self.loss_scaler, epoch=epoch, 
                 log_writer=self.log_writer, lr_scheduler=self.lr_scheduler, start_steps=epoch * self.num_training_steps_per_epoch,
-                verbose=self.cfg.TRAIN.VERBOSE)
+                verbose=self.cfg.TRAIN.VERBOSE, batch_augmentor=self.batch_augmentor)
 
             # Save checkpoint
             if self.cfg.MODEL.SAVE_CKPT_FREQ != -1:
@@ -780,6 +820,71 @@ class Base_Workflow(metaclass=ABCMeta):
             print("############################")
             self.test_generator, self.data_norm = create_test_augmentor(self.cfg, self.X_test, self.Y_test, self.cross_val_samples_ids)
 
+    def predict_with_tta(self, img):
+        """
+        Predict an image with test-time augmentation (``TEST.AUGMENTATION_BACKEND``).
+
+        Parameters
+        ----------
+        img : 3D/4D Numpy array
+            Image to predict. E.g. ``(y, x, channels)`` for 2D or ``(z, y, x, channels)`` for 3D.
+
+        Returns
+        -------
+        pred : Torch tensor or list of Torch tensors
+            Mean prediction of the transformed images. E.g. ``(1, channels, y, x)`` for 2D or ``(1, channels, z, y, x)`` for 3D.
+        """
+        if self.cfg.TEST.AUGMENTATION_BACKEND == 'torch':
+            img = to_pytorch_format(np.expand_dims(img, 0), self.axis_order, self.device)
+            return ensemble_predictions(img, pred_func=lambda x: self.model_call_func(x, to_pytorch=False), 
+                batch_size_value=self.cfg.TRAIN.BATCH_SIZE)
+        elif self.cfg.PROBLEM.NDIM == '2D':
+            return ensemble8_2d_predictions(img, axis_order_back=self.axis_order_back,
+                pred_func=self.model_call_func, axis_order=self.axis_order, device=self.device)
+        else:
+            return ensemble16_3d_predictions(img, batch_size_value=self.cfg.TRAIN.BATCH_SIZE,
+                axis_order_back=self.axis_order_back, pred_func=self.model_call_func, 
+                axis_order=self.axis_order, device=self.device)
+
+    def predict_with_smooth_windowing(self, img):
+        """
+        Predict a 2D image by overlapping windows of ``DATA.PATCH_SIZE`` blended with a spline window, without keeping 
+        all the windows in memory (``TEST.FULL_IMG_INFERENCE`` is ``'smooth_windowing'``). 
+
+        Parameters
+        ----------
+        img : 3D Numpy array
+            Image to predict. E.g. ``(y, x, channels)``.
+
+        Returns
+        -------
+        pred : 4D Numpy array
+            Prediction of the image. E.g. ``(1, y, x, channels)``.
+        """
+        # Number of channels of the first head when the model has two
+        first_head_channels = []
+
+        def _pred_func(batch):
+            if self.cfg.TEST.AUGMENTATION:
+                p = [self.predict_with_tta(batch[j]) for j in range(batch.shape[0])]
+                p = [torch.cat(h) for h in zip(*p)] if isinstance(p[0], list) else torch.cat(p)
+            else:
+                with torch.cuda.amp.autocast():
+                    p = self.model_call_func(batch)
+            p = self.apply_model_activations(p)
+            # Multi-head concatenation. The class channels are merged too and the argmax is made afterwards
+            if isinstance(p, list):
+                if len(first_head_channels) == 0: first_head_channels.append(p[0].shape[1])
+                p = torch.cat((p[0], p[1]), dim=1)
+            return to_numpy_format(p.float(), self.axis_order_back)
+
+        pred = predict_img_with_smooth_windowing_streaming(img, self.cfg.DATA.PATCH_SIZE[:-1], 
+            self.cfg.TEST.SMOOTH_WINDOWING_SUBDIVISIONS, _pred_func, batch_size=self.cfg.TRAIN.BATCH_SIZE)
+        if len(first_head_channels) > 0:
+            c = first_head_channels[0]
+            pred = np.concatenate([pred[...,:c], np.expand_dims(np.argmax(pred[...,c:], -1), -1)], -1)
+        return np.expand_dims(pred, 0)
+
     def apply_model_activations(self, pred, training=False):
         """
         Function that apply the last activation (if any) to the model's output. 
@@ -854,7 +959,8 @@ class Base_Workflow(metaclass=ABCMeta):
             setup_for_distributed(True)
 
         # Process all the images
-        for i, gen_obj in tqdm(enumerate(self.test_generator), total=len(self.test_generator), disable=not is_main_process()):
+        test_samples = PrefetchGenerator(self.test_generator, depth=self.cfg.DATA.TEST.PREFETCH_DEPTH)
+        for i, gen_obj in tqdm(enumerate(test_samples), total=len(test_samples), disable=not is_main_process()):
             self._X, X_norm, self._Y, Y_norm = None, None, None, None
             if 'X' in gen_obj: self._X = gen_obj['X']
             if 'X_norm' in gen_obj: X_norm = gen_obj['X_norm']
@@ -865,6 +971,10 @@ class Base_Workflow(metaclass=ABCMeta):
             self.f_numbers = [i]
             del gen_obj
 
+            # Normalization of the sample being processed
+            if X_norm is not None:
+                self.data_norm = X_norm
+
             if is_main_process():
                 if self.cfg.TEST.BY_CHUNKS.ENABLE and self.cfg.PROBLEM.NDIM == '3D':
                     print(f"[Rank {get_rank()} ({os.getpid()})] Processing image(s): {self.processing_filenames[0]}")
@@ -945,18 +1055,63 @@ class Base_Workflow(metaclass=ABCMeta):
             out_data_filename = os.path.join(self.cfg.PATHS.RESULT_DIR.PER_IMAGE, filename+"_nodiv"+ext)
             out_data_mask_filename = os.path.join(self.cfg.PATHS.RESULT_DIR.PER_IMAGE, filename+"_mask"+ext)
         out_data_div_filename = os.path.join(self.cfg.PATHS.RESULT_DIR.PER_IMAGE, filename+ext)
+        # The data is written already divided when accumulating with a buffer, so no division is needed at the end
+        use_mask = self.cfg.TEST.BY_CHUNKS.ACCUMULATION == "mask"
+        if not use_mask and self.cfg.SYSTEM.NUM_GPUS <= 1:
+            out_data_filename = out_data_div_filename
+        compression = chunked_data_compression(self.cfg.TEST.BY_CHUNKS.FORMAT, self.cfg.TEST.BY_CHUNKS.COMPRESSION)
         in_data = self._X
 
-        # Process in charge of processing one predicted patch
-        output_handle_proc = mp.Process(target=insert_patch_into_dataset, args=(out_data_filename, out_data_mask_filename, 
-            data_shape, self.output_queue, self.extract_info_queue, self.cfg, self.dtype_str, self.dtype, 
-            self.cfg.TEST.BY_CHUNKS.FORMAT, self.cfg.TEST.VERBOSE))
+        if "C" not in self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER:
+            out_data_order = self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER + "C"
+            c_index = -1
+        else:
+            out_data_order = self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER
+            c_index = out_data_order.index("C")
+
+        dynamic_scheduler = self.cfg.TEST.BY_CHUNKS.SCHEDULER == "dynamic"
+        work_queue_filename = None
+        if dynamic_scheduler:
+            # All the ranks write directly into the final Zarr, each patch into the chunks it owns, while they claim 
+            # the blocks of patches to process from a counter shared through a file
+            work_queue_filename = os.path.join(self.cfg.PATHS.RESULT_DIR.PER_IMAGE, filename+"_work_queue")
+
+            # Number of channels of the prediction. All the ranks need to run the model, as the forward pass of DDP 
+            # synchronizes them
+            pred_channels = self.predict_batch_by_chunks(
+                np.zeros((1,)+tuple(self.cfg.DATA.PATCH_SIZE), dtype=np.float32)).shape[-1]
+            if is_main_process():
+                if os.path.exists(work_queue_filename):
+                    os.remove(work_queue_filename)
+
+                *_, chunk_shape = next(extract_3D_patch_with_overlap_yield(in_data, self.cfg.DATA.PATCH_SIZE, 
+                    self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER, overlap=self.cfg.DATA.TEST.OVERLAP, 
+                    padding=self.cfg.DATA.TEST.PADDING, return_only_stats=True))
+
+                out_data_shape = list(data_shape) + [pred_channels] if c_index == -1 else list(data_shape)
+                out_data_shape[c_index] = pred_channels
+                out_chunks = order_dimensions(chunk_shape+(pred_channels,), input_order="ZYXC", 
+                    output_order=out_data_order, default_value=1)
+                fid = zarr.open_group(out_data_div_filename, mode="w")
+                fid.create_dataset("data", shape=tuple(out_data_shape), chunks=tuple(out_chunks), dtype=self.dtype_str,
+                    **compression)
+            if self.cfg.SYSTEM.NUM_GPUS > 1 and is_dist_avail_and_initialized():
+                dist.barrier()
+
+            # Process in charge of writing the owned part of each predicted patch
+            output_handle_proc = mp.Process(target=write_patch_into_owned_chunks, args=(out_data_div_filename, 
+                self.output_queue, self.cfg, self.cfg.TEST.VERBOSE))
+        else:
+            # Process in charge of processing one predicted patch
+            output_handle_proc = mp.Process(target=insert_patch_into_dataset, args=(out_data_filename, out_data_mask_filename, 
+                data_shape, self.output_queue, self.extract_info_queue, self.cfg, self.dtype_str, self.dtype, 
+                self.cfg.TEST.BY_CHUNKS.FORMAT, self.cfg.TEST.VERBOSE))
         output_handle_proc.daemon=True
         output_handle_proc.start()
         
         # Process in charge of loading part of the data 
         load_data_process = mp.Process(target=extract_patch_from_dataset, args=(in_data, self.cfg, self.input_queue, 
-            self.extract_info_queue, self.cfg.TEST.VERBOSE))
+            self.extract_info_queue, self.cfg.TEST.VERBOSE, work_queue_filename))
         load_data_process.daemon=True
         load_data_process.start()
 
@@ -967,38 +1122,45 @@ class Base_Workflow(metaclass=ABCMeta):
         # Lock the thread inferring until no more patches 
         if self.cfg.TEST.VERBOSE and self.cfg.SYSTEM.NUM_GPUS > 1:
             print(f"[Rank {get_rank()} ({os.getpid()})] Doing inference ")
-        while True:
+        batch_size = self.cfg.TEST.BY_CHUNKS.BATCH_SIZE if self.cfg.TEST.BY_CHUNKS.BATCH_SIZE != -1 else self.cfg.TRAIN.BATCH_SIZE
+        imgs, imgs_coords = [], []
+        no_more_patches = False
+        while not no_more_patches:
             obj = self.input_queue.get(timeout=60)
-            if obj == None: break
-
-            img, patch_coords = obj
-            img, _ = self.test_generator.norm_X(img)
-            if self.cfg.TEST.AUGMENTATION:
-                p = ensemble16_3d_predictions(img[0], batch_size_value=self.cfg.TRAIN.BATCH_SIZE,
-                    axis_order_back=self.axis_order_back, pred_func=self.model_call_func, 
-                    axis_order=self.axis_order, device=self.device)
+            if obj == None: 
+                no_more_patches = True
             else:
-                with torch.cuda.amp.autocast():
-                    p = self.model_call_func(img)
-            p = self.apply_model_activations(p)
-            # Multi-head concatenation
-            if isinstance(p, list):
-                p = torch.cat((p[0], torch.argmax(p[1], axis=1).unsqueeze(1)), dim=1)
-            p = to_numpy_format(p, self.axis_order_back)
-
-            # Create a mask with the overlap. Calculate the exact part of the patch that will be inserted in the 
-            # final H5/Zarr file
-            p = p[0, self.cfg.DATA.TEST.PADDING[0]:p.shape[1]-self.cfg.DATA.TEST.PADDING[0],
-                self.cfg.DATA.TEST.PADDING[1]:p.shape[2]-self.cfg.DATA.TEST.PADDING[1],
-                self.cfg.DATA.TEST.PADDING[2]:p.shape[3]-self.cfg.DATA.TEST.PADDING[2]]
-            m = np.ones(p.shape, dtype=np.uint8)
-
-            # Put the prediction into queue
-            self.output_queue.put([p, m, patch_coords])         
+                img, patch_coords = obj
+                img, _ = self.test_generator.norm_X(img)
+                imgs.append(img)
+                imgs_coords.append(patch_coords)
+
+            # Wait until the batch is full (or there are no more patches) to call the model
+            if len(imgs) == 0 or (len(imgs) < batch_size and not no_more_patches):
+                continue
+
+            pred = self.predict_batch_by_chunks(np.concatenate(imgs))
+
+            # Scatter the predictions of the batch with their coordinates
+            for p, patch_coords in zip(pred, imgs_coords):
+                # Create a mask with the overlap. Calculate the exact part of the patch that will be inserted in the 
+                # final H5/Zarr file
+                p = p[self.cfg.DATA.TEST.PADDING[0]:p.shape[0]-self.cfg.DATA.TEST.PADDING[0],
+                    self.cfg.DATA.TEST.PADDING[1]:p.shape[1]-self.cfg.DATA.TEST.PADDING[1],
+                    self.cfg.DATA.TEST.PADDING[2]:p.shape[2]-self.cfg.DATA.TEST.PADDING[2]]
+                m = np.ones(p.shape, dtype=np.uint8)
+
+                # Put the prediction into queue
+                self.output_queue.put([p, m, patch_coords])
+            imgs, imgs_coords = [], []
+
+        # The number of patches of each rank is not known in advance with the dynamic scheduler
+        if dynamic_scheduler:
+            self.output_queue.put(None)
 
         # Get some auxiliar variables
         self.stats['patch_counter'] = self.extract_info_queue.get(timeout=60)
-        if is_main_process():
+        if is_main_process() and not dynamic_scheduler:
             z_vol_info = self.extract_info_queue.get(timeout=60)
             list_of_vols_in_z  = self.extract_info_queue.get(timeout=60)
         load_data_process.join()
@@ -1013,14 +1175,24 @@ class Base_Workflow(metaclass=ABCMeta):
 
         # Create the final H5/Zarr file that contains all the individual parts 
         if is_main_process():
-            if "C" not in self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER:
-                out_data_order = self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER + "C"
-                c_index = -1
-            else:
-                out_data_order = self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER
-                c_index = out_data_order.index("C")
-                
-            if self.cfg.SYSTEM.NUM_GPUS > 1:
+            if dynamic_scheduler:
+                # The final Zarr has been already filled by all the ranks
+                os.remove(work_queue_filename)
+
+                # Save image
+                if self.cfg.TEST.BY_CHUNKS.SAVE_OUT_TIF and self.cfg.PATHS.RESULT_DIR.PER_IMAGE != "":
+                    _, pred = read_chunked_data(out_data_div_filename)
+                    current_order = np.array(range(len(pred.shape)))
+                    transpose_order = order_dimensions(current_order, input_order=out_data_order,
+                        output_order="TZYXC", default_value=np.nan)
+                    transpose_order = [x for x in transpose_order if not np.isnan(x)]
+                    pred = np.array(pred, dtype=self.dtype).transpose(transpose_order)
+                    if "T" not in out_data_order:
+                        pred = np.expand_dims(pred,0)
+
+                    save_tif(pred, self.cfg.PATHS.RESULT_DIR.PER_IMAGE, [filename+".tif"], verbose=self.cfg.TEST.VERBOSE)
+
+            elif self.cfg.SYSTEM.NUM_GPUS > 1:
                 # Obtain parts of the data created by all GPUs
                 if self.cfg.TEST.BY_CHUNKS.FORMAT == "h5":
                     data_parts_filenames = sorted(next(os.walk(self.cfg.PATHS.RESULT_DIR.PER_IMAGE))[2])
@@ -1045,16 +1217,19 @@ class Base_Workflow(metaclass=ABCMeta):
                 for i, data_part_fname in enumerate(data_parts_filenames):
                     print("Reading {}".format(os.path.join(self.cfg.PATHS.RESULT_DIR.PER_IMAGE, data_part_fname)))
                     data_part_file, data_part = read_chunked_data(os.path.join(self.cfg.PATHS.RESULT_DIR.PER_IMAGE, data_part_fname))
-                    data_mask_part_file, data_mask_part = read_chunked_data(os.path.join(self.cfg.PATHS.RESULT_DIR.PER_IMAGE, data_parts_mask_filenames[i]))
+                    if use_mask:
+                        data_mask_part_file, data_mask_part = read_chunked_data(os.path.join(self.cfg.PATHS.RESULT_DIR.PER_IMAGE, data_parts_mask_filenames[i]))
 
                     if 'data' not in locals():
                         all_data_filename = os.path.join(self.cfg.PATHS.RESULT_DIR.PER_IMAGE, filename+ext)
                         if self.cfg.TEST.BY_CHUNKS.FORMAT == "h5":
                             allfile = h5py.File(all_data_filename,'w')
-                            data = allfile.create_dataset("data", data_part.shape, dtype=self.dtype_str, compression="gzip")
+                            data = allfile.create_dataset("data", data_part.shape, dtype=self.dtype_str, 
+                                chunks=data_part.chunks, **compression)
                         else:
                             allfile = zarr.open_group(all_data_filename, mode="w")
-                            data = allfile.create_dataset("data", shape=data_part.shape, dtype=self.dtype_str, compression="gzip")
+                            data = allfile.create_dataset("data", shape=data_part.shape, dtype=self.dtype_str, 
+                                chunks=data_part.chunks, **compression)
 
                     for j, k in enumerate(list_of_vols_in_z[i]):
                         
@@ -1073,14 +1248,18 @@ class Base_Workflow(metaclass=ABCMeta):
 
                         if self.cfg.TEST.VERBOSE:
                             print(f"Filling {k} [{z_vol_info[k][0]}:{z_vol_info[k][1]}]")
-                        data[data_ordered_slices] = data_part[data_ordered_slices] / data_mask_part[data_ordered_slices]
+                        if use_mask:
+                            data[data_ordered_slices] = data_part[data_ordered_slices] / data_mask_part[data_ordered_slices]
+                        else:
+                            data[data_ordered_slices] = data_part[data_ordered_slices]
 
                         if self.cfg.TEST.BY_CHUNKS.FORMAT == "h5":
                             allfile.flush() 
 
                     if self.cfg.TEST.BY_CHUNKS.FORMAT == "h5":
                         data_part_file.close()
-                        data_mask_part_file.close()
+                        if use_mask:
+                            data_mask_part_file.close()
 
                 # Save image
                 if self.cfg.TEST.BY_CHUNKS.SAVE_OUT_TIF and self.cfg.PATHS.RESULT_DIR.PER_IMAGE != "":
@@ -1098,7 +1277,7 @@ class Base_Workflow(metaclass=ABCMeta):
                     allfile.close()      
 
             # Just make the division with the overlap
-            else:
+            elif use_mask:
                 # Load predictions and overlapping mask
                 pred_file, pred = read_chunked_data(out_data_filename)
                 mask_file, mask = read_chunked_data(out_data_mask_filename)
@@ -1106,10 +1285,10 @@ class Base_Workflow(metaclass=ABCMeta):
                 # Create new file
                 if self.cfg.TEST.BY_CHUNKS.FORMAT == "h5":
                     fid_div = h5py.File(out_data_div_filename,'w')
-                    pred_div = fid_div.create_dataset("data", pred.shape, dtype=pred.dtype, compression="gzip")
+                    pred_div = fid_div.create_dataset("data", pred.shape, dtype=pred.dtype, **compression)
                 else:
                     fid_div = zarr.open_group(out_data_div_filename, mode="w")
-                    pred_div = fid_div.create_dataset("data", shape=pred.shape, dtype=pred.dtype)
+                    pred_div = fid_div.create_dataset("data", shape=pred.shape, dtype=pred.dtype, **compression)
                     
                 t_dim, z_dim, c_dim, y_dim, x_dim = order_dimensions(
                     data_shape, self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER)
@@ -1158,11 +1337,14 @@ class Base_Workflow(metaclass=ABCMeta):
                     mask_file.close()
                     fid_div.close()
 
-            if self.cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS:
-                if self.cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.TYPE == "chunk_by_chunk":
-                    self.after_merge_patches_by_chunks_proccess_patch(out_data_div_filename) 
-                else:            
-                    self.after_merge_patches_by_chunks_proccess_entire_pred(out_data_div_filename) 
+            if self.cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.ENABLE and self.cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.TYPE == "entire_pred":
+                self.after_merge_patches_by_chunks_proccess_entire_pred(out_data_div_filename) 
+
+        # All the ranks go through the chunk by chunk process so the workflows can distribute the chunks among them
+        if self.cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.ENABLE and self.cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.TYPE == "chunk_by_chunk":
+            if self.cfg.SYSTEM.NUM_GPUS > 1 and is_dist_avail_and_initialized():
+                dist.barrier()
+            self.after_merge_patches_by_chunks_proccess_patch(out_data_div_filename) 
                     
         # Wait until the main thread is done to predict the next sample
         if self.cfg.SYSTEM.NUM_GPUS > 1 :
@@ -1173,6 +1355,35 @@ class Base_Workflow(metaclass=ABCMeta):
             if self.cfg.TEST.VERBOSE:
                 print(f"[Rank {get_rank()} ({os.getpid()})] Synched with main thread. Go for the next sample")
 
+    def predict_batch_by_chunks(self, imgs):
+        """
+        Predict a batch of patches extracted in :func:`process_sample_by_chunks`. 
+
+        Parameters
+        ----------
+        imgs : 5D Numpy array
+            Normalized patches to predict. E.g. ``(num_patches, z, y, x, channels)``.
+
+        Returns
+        -------
+        pred : 5D Numpy array
+            Predictions. E.g. ``(num_patches, z, y, x, channels)``.
+        """
+        if self.cfg.TEST.AUGMENTATION:
+            p = [self.predict_with_tta(img) for img in imgs]
+            if isinstance(p[0], list):
+                p = [torch.cat([x[i] for x in p]) for i in range(len(p[0]))]
+            else:
+                p = torch.cat(p)
+        else:
+            with torch.cuda.amp.autocast():
+                p = self.model_call_func(imgs)
+        p = self.apply_model_activations(p)
+        # Multi-head concatenation
+        if isinstance(p, list):
+            p = torch.cat((p[0], torch.argmax(p[1], axis=1).unsqueeze(1)), dim=1)
+        return to_numpy_format(p, self.axis_order_back)
+
     def process_sample(self, norm):
         """
         Function to process a sample in the inference phase. 
@@ -1220,19 +1431,23 @@ class Base_Workflow(metaclass=ABCMeta):
                             self._X = obj
                         del obj
                     else:
+                        # The patches are extracted from the padded image only when needed and, as the GT patches are not 
+                        # modified, the original GT can be kept instead of merging its patches back 
+                        if self.cfg.TEST.LAZY_PATCHES and self.cfg.DATA.TEST.LOAD_GT: 
+                            Y_original = self._Y[0]
                         if self.cfg.TEST.REDUCE_MEMORY:
                             self._X = crop_3D_data_with_overlap(self._X[0], self.cfg.DATA.PATCH_SIZE, overlap=self.cfg.DATA.TEST.OVERLAP, 
                                 padding=self.cfg.DATA.TEST.PADDING, verbose=self.cfg.TEST.VERBOSE, 
-                                median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING)
+                                median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING, lazy=self.cfg.TEST.LAZY_PATCHES)
                             if self.cfg.DATA.TEST.LOAD_GT:
                                 self._Y = crop_3D_data_with_overlap(self._Y[0], self.cfg.DATA.PATCH_SIZE[:-1]+(self._Y.shape[-1],), overlap=self.cfg.DATA.TEST.OVERLAP, 
                                     padding=self.cfg.DATA.TEST.PADDING, verbose=self.cfg.TEST.VERBOSE, 
-                                    median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING)
+                                    median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING, lazy=self.cfg.TEST.LAZY_PATCHES)
                         else:
                             if self.cfg.DATA.TEST.LOAD_GT: self._Y = self._Y[0]
                             obj = crop_3D_data_with_overlap(self._X[0], self.cfg.DATA.PATCH_SIZE, data_mask=self._Y, overlap=self.cfg.DATA.TEST.OVERLAP, 
                                 padding=self.cfg.DATA.TEST.PADDING, verbose=self.cfg.TEST.VERBOSE, 
-                                median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING)
+                                median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING, lazy=self.cfg.TEST.LAZY_PATCHES)
                             if self.cfg.DATA.TEST.LOAD_GT:
                                 self._X, self._Y = obj
                             else:
@@ -1258,21 +1473,36 @@ class Base_Workflow(metaclass=ABCMeta):
 
                 self.stats['patch_counter'] += self._X.shape[0]
 
+                # Merge each patch as soon as it is predicted instead of storing all the predictions 
+                streaming_merge = self.cfg.TEST.STREAMING_MERGE and original_data_shape[1:-1] != self.cfg.DATA.PATCH_SIZE[:-1]
+                if streaming_merge:
+                    merger = None
+                    if self.cfg.PROBLEM.NDIM == '2D':
+                        merge_coords = merge_data_with_overlap_coords(original_data_shape, self.cfg.DATA.PATCH_SIZE, 
+                            overlap=self.cfg.DATA.TEST.OVERLAP, padding=self.cfg.DATA.TEST.PADDING)
+                        merge_padding = (0, self.cfg.DATA.TEST.PADDING[1], self.cfg.DATA.TEST.PADDING[0])
+                    else:
+                        merge_coords = extract_3D_patch_coords_with_overlap(original_data_shape[1:], self.cfg.DATA.PATCH_SIZE, 
+                            "ZYXC", overlap=self.cfg.DATA.TEST.OVERLAP, padding=self.cfg.DATA.TEST.PADDING)[:, :3]
+                        merge_padding = self.cfg.DATA.TEST.PADDING
+                    merge_patch_shape = tuple(merge_coords[0,:,1]-merge_coords[0,:,0])
+                    merge_out_shape = original_data_shape[:-1] if self.cfg.PROBLEM.NDIM == '2D' else original_data_shape[1:-1]
+
                 # Predict each patch
                 if self.cfg.TEST.AUGMENTATION:
                     for k in tqdm(range(self._X.shape[0]), leave=False):
-                        if self.cfg.PROBLEM.NDIM == '2D':
-                            p = ensemble8_2d_predictions(self._X[k], axis_order_back=self.axis_order_back,
-                                pred_func=self.model_call_func, axis_order=self.axis_order, device=self.device)
-                        else:
-                            p = ensemble16_3d_predictions(self._X[k], batch_size_value=self.cfg.TRAIN.BATCH_SIZE,
-                                axis_order_back=self.axis_order_back, pred_func=self.model_call_func, 
-                                axis_order=self.axis_order, device=self.device)
+                        p = self.predict_with_tta(self._X[k])
                         p = self.apply_model_activations(p)
                         # Multi-head concatenation
                         if isinstance(p, list):
                             p = torch.cat((p[0], p[1]), dim=1)
                         p = to_numpy_format(p, self.axis_order_back)
+                        if streaming_merge:
+                            if merger is None:
+                                merger = StreamingPatchMerger(merge_out_shape+(p.shape[-1],), merge_patch_shape, 
+                                    padding=merge_padding, blending=self.cfg.TEST.MERGE_BLENDING)
+                            merger.add(p[0], merge_coords[k])
+                            continue
                         if 'pred' not in locals():
                             pred = np.zeros((self._X.shape[0],)+p.shape[1:], dtype=self.dtype)
                         pred[k] = p
@@ -1286,6 +1516,13 @@ class Base_Workflow(metaclass=ABCMeta):
                             if isinstance(p, list):
                                 p = torch.cat((p[0], p[1]), dim=1)
                             p = to_numpy_format(p, self.axis_order_back)
+                        if streaming_merge:
+                            if merger is None:
+                                merger = StreamingPatchMerger(merge_out_shape+(p.shape[-1],), merge_patch_shape, 
+                                    padding=merge_padding, blending=self.cfg.TEST.MERGE_BLENDING)
+                            for j in range(p.shape[0]):
+                                merger.add(p[j], merge_coords[k*self.cfg.TRAIN.BATCH_SIZE+j])
+                            continue
                         if 'pred' not in locals():
                             pred = np.zeros((self._X.shape[0],)+p.shape[1:], dtype=self.dtype)
                         pred[k*self.cfg.TRAIN.BATCH_SIZE:top] = p
@@ -1299,17 +1536,28 @@ class Base_Workflow(metaclass=ABCMeta):
                     if self.cfg.PROBLEM.NDIM == '3D': original_data_shape = original_data_shape[1:]
                     f_name = merge_data_with_overlap if self.cfg.PROBLEM.NDIM == '2D' else merge_3D_data_with_overlap
 
-                    if self.cfg.TEST.REDUCE_MEMORY:
+                    merge_Y = self.cfg.DATA.TEST.LOAD_GT
+                    if self.cfg.PROBLEM.NDIM == '3D' and self.cfg.TEST.LAZY_PATCHES and self.cfg.DATA.TEST.LOAD_GT:
+                        self._Y, merge_Y = Y_original, False
+                        del Y_original
+
+                    if streaming_merge:
+                        pred = merger.result(self.dtype)
+                        del merger
+                        if merge_Y:
+                            self._Y = f_name(self._Y, original_data_shape[:-1]+(self._Y.shape[-1],), padding=self.cfg.DATA.TEST.PADDING, 
+                                overlap=self.cfg.DATA.TEST.OVERLAP, verbose=self.cfg.TEST.VERBOSE)
+                    elif self.cfg.TEST.REDUCE_MEMORY:
                         pred = f_name(pred, original_data_shape[:-1]+(pred.shape[-1],), padding=self.cfg.DATA.TEST.PADDING, 
-                            overlap=self.cfg.DATA.TEST.OVERLAP, verbose=self.cfg.TEST.VERBOSE)
-                        if self.cfg.DATA.TEST.LOAD_GT:
+                            overlap=self.cfg.DATA.TEST.OVERLAP, verbose=self.cfg.TEST.VERBOSE, blending=self.cfg.TEST.MERGE_BLENDING)
+                        if merge_Y:
                             self._Y = f_name(self._Y, original_data_shape[:-1]+(self._Y.shape[-1],), padding=self.cfg.DATA.TEST.PADDING, 
                                 overlap=self.cfg.DATA.TEST.OVERLAP, verbose=self.cfg.TEST.VERBOSE)
                     else:
-                        obj = f_name(pred, original_data_shape[:-1]+(pred.shape[-1],), data_mask=self._Y,
+                        obj = f_name(pred, original_data_shape[:-1]+(pred.shape[-1],), data_mask=self._Y if merge_Y else None,
                             padding=self.cfg.DATA.TEST.PADDING, overlap=self.cfg.DATA.TEST.OVERLAP,
-                            verbose=self.cfg.TEST.VERBOSE)
-                        if self.cfg.DATA.TEST.LOAD_GT:
+                            verbose=self.cfg.TEST.VERBOSE, blending=self.cfg.TEST.MERGE_BLENDING)
+                        if merge_Y:
                             pred, self._Y = obj
                         else:
                             pred = obj
@@ -1389,13 +1637,17 @@ class Base_Workflow(metaclass=ABCMeta):
         ### FULL IMAGE ###
         ##################
         if self.cfg.TEST.FULL_IMG and self.cfg.PROBLEM.NDIM == '2D':
-            self._X, o_test_shape = check_downsample_division(self._X, len(self.cfg.MODEL.FEATURE_MAPS)-1)
+            smooth_windowing = self.cfg.TEST.FULL_IMG_INFERENCE == 'smooth_windowing'
+            if smooth_windowing:
+                o_test_shape = self._X.shape
+            else:
+                self._X, o_test_shape = check_downsample_division(self._X, len(self.cfg.MODEL.FEATURE_MAPS)-1)
             if not self.cfg.TEST.REUSE_PREDICTIONS:
-                if self.cfg.DATA.TEST.LOAD_GT:
+                if self.cfg.DATA.TEST.LOAD_GT and not smooth_windowing:
                     self._Y, _ = check_downsample_division(self._Y, len(self.cfg.MODEL.FEATURE_MAPS)-1)
 
                 # Evaluate each img
-                if self.cfg.DATA.TEST.LOAD_GT:
+                if self.cfg.DATA.TEST.LOAD_GT and not smooth_windowing:
                     with torch.cuda.amp.autocast():
                         output = self.model_call_func(self._X)
                         loss = self.loss(output, to_pytorch_format(self._Y, self.axis_order, self.device, dtype=self.loss_dtype))
@@ -1403,18 +1655,20 @@ class Base_Workflow(metaclass=ABCMeta):
                     del output
 
                 # Make the prediction
-                if self.cfg.TEST.AUGMENTATION:
-                    pred = ensemble8_2d_predictions(self._X[0], axis_order_back=self.axis_order_back, 
-                        pred_func=self.model_call_func, axis_order=self.axis_order, device=self.device)
+                if smooth_windowing:
+                    pred = self.predict_with_smooth_windowing(self._X[0])
                 else:
-                    with torch.cuda.amp.autocast():
-                        pred = self.model_call_func(self._X)
-                pred = self.apply_model_activations(pred)
-                # Multi-head concatenation
-                if isinstance(pred, list):
-                    pred = torch.cat((pred[0], torch.argmax(pred[1], axis=1).unsqueeze(1)), dim=1)  
-                pred = to_numpy_format(pred, self.axis_order_back)  
-                if self.cfg.TEST.AUGMENTATION: pred = np.expand_dims(pred, 0)
+                    if self.cfg.TEST.AUGMENTATION:
+                        pred = self.predict_with_tta(self._X[0])
+                    else:
+                        with torch.cuda.amp.autocast():
+                            pred = self.model_call_func(self._X)
+                    pred = self.apply_model_activations(pred)
+                    # Multi-head concatenation
+                    if isinstance(pred, list):
+                        pred = torch.cat((pred[0], torch.argmax(pred[1], axis=1).unsqueeze(1)), dim=1)  
+                    pred = to_numpy_format(pred, self.axis_order_back)  
+                    if self.cfg.TEST.AUGMENTATION: pred = np.expand_dims(pred, 0)
                 del self._X 
 
                 # Recover original shape if padded with check_downsample_division
@@ -1568,7 +1822,7 @@ class Base_Workflow(metaclass=ABCMeta):
         """
         Place any code that needs to be done after merging all predicted patches into the original image
         but in the process made chunk by chunk. This function will operate patch by patch defined by 
-        ``DATA.PATCH_SIZE``.
+        ``DATA.PATCH_SIZE``. It is called from all the ranks.
 
         Parameters
         ----------
@@ -1604,7 +1858,7 @@ class Base_Workflow(metaclass=ABCMeta):
             self.all_pred, self.stats['iou_as_3D_stack_post'], self.stats['ov_iou_as_3D_stack_post'] = apply_post_processing(self.cfg, self.all_pred, self.all_gt)
             save_tif(np.expand_dims(self.all_pred,0), self.cfg.PATHS.RESULT_DIR.AS_3D_STACK_POST_PROCESSING, verbose=self.cfg.TEST.VERBOSE)
 
-def extract_patch_from_dataset(data, cfg, input_queue, extract_info_queue, verbose=False):
+def extract_patch_from_dataset(data, cfg, input_queue, extract_info_queue, verbose=False, work_queue_filename=None):
     """
     Extract patches from data and put them into a queue read by each GPU inference process.
     This function will be run by a child process created for every test sample.  
@@ -1626,6 +1880,11 @@ def extract_patch_from_dataset(data, cfg, input_queue, extract_info_queue, verbo
     
     verbose : bool, optional
         To print useful information for debugging.  
+
+    work_queue_filename : str, optional
+        File of the counter shared between all the ranks to claim the next block of patches to process 
+        (``TEST.BY_CHUNKS.SCHEDULER`` is ``'dynamic'``). In that case, the coordinates put into ``input_queue`` 
+        are a list with the coordinates of the patch and the region it owns in the data. 
     """
     if verbose and cfg.SYSTEM.NUM_GPUS > 1:
         if isinstance(data, str):
@@ -1637,13 +1896,22 @@ def extract_patch_from_dataset(data, cfg, input_queue, extract_info_queue, verbo
     if isinstance(data, str):
         data_file, data = read_chunked_data(data)
 
+    # Counter shared by all the ranks (no process group is needed to use the store)
+    work_queue = None
+    if work_queue_filename is not None:
+        store = dist.FileStore(work_queue_filename, -1)
+        work_queue = lambda: store.add("next_block", 1)-1
+
     # Process of extracting each patch
     patch_counter = 0
     for obj in extract_3D_patch_with_overlap_yield(data, cfg.DATA.PATCH_SIZE, cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER,
         overlap=cfg.DATA.TEST.OVERLAP, padding=cfg.DATA.TEST.PADDING, total_ranks=max(1,cfg.SYSTEM.NUM_GPUS), 
-        rank=get_rank(), verbose=verbose):
+        rank=get_rank(), max_slab_mb=cfg.TEST.BY_CHUNKS.MAX_SLAB_MB, work_queue=work_queue, verbose=verbose):
 
-        if is_main_process():
+        if work_queue is not None:
+            img, patch_coords, owned_in_data = obj
+            patch_coords = [patch_coords, owned_in_data]
+        elif is_main_process():
             img, patch_coords, total_vol, z_vol_info, list_of_vols_in_z = obj
         else: 
             img, patch_coords, total_vol = obj
@@ -1651,7 +1919,7 @@ def extract_patch_from_dataset(data, cfg, input_queue, extract_info_queue, verbo
         img = np.expand_dims(img,0)
         input_queue.put([img, patch_coords])
 
-        if patch_counter == 0:
+        if patch_counter == 0 and work_queue is None:
             # This goes for the child process in charge of inserting data patches (insert_patch_into_dataset function)
             extract_info_queue.put(total_vol)
         patch_counter += 1
@@ -1661,7 +1929,7 @@ def extract_patch_from_dataset(data, cfg, input_queue, extract_info_queue, verbo
 
     # Send to the main thread patch_counter
     extract_info_queue.put(patch_counter)
-    if is_main_process():
+    if is_main_process() and work_queue is None:
         extract_info_queue.put(z_vol_info)
         extract_info_queue.put(list_of_vols_in_z)
 
@@ -1682,6 +1950,11 @@ def insert_patch_into_dataset(data_filename, data_filename_mask, data_shape, out
     the main rank will create the final image. This function will be run by a child process created for every 
     test sample.  
 
+    If ``TEST.BY_CHUNKS.ACCUMULATION`` is ``'mask'`` the patches are added into the file and the overlaps are counted
+    in ``data_filename_mask``. If it is ``'buffer'`` they are accumulated with 
+    :class:`~biapy.data.data_3D_manipulation.SlabPatchAccumulator`, so the data is written already divided and 
+    ``data_filename_mask`` is not created. 
+
     Parameters
     ----------
     data_filename : Str or Numpy array
@@ -1713,12 +1986,16 @@ def insert_patch_into_dataset(data_filename, data_filename_mask, data_shape, out
     if verbose and cfg.SYSTEM.NUM_GPUS > 1:
         print(f"[Rank {get_rank()} ({os.getpid()})] In charge of inserting patches into data . . .")
     
+    use_mask = cfg.TEST.BY_CHUNKS.ACCUMULATION == "mask"
     if file_type == "h5":
         fid = h5py.File(data_filename, "w") 
-        fid_mask = h5py.File(data_filename_mask, "w") 
+        if use_mask:
+            fid_mask = h5py.File(data_filename_mask, "w") 
     else:
         fid = zarr.open_group(data_filename, mode="w")
-        fid_mask = zarr.open_group(data_filename_mask, mode="w")
+        if use_mask:
+            fid_mask = zarr.open_group(data_filename_mask, mode="w")
+    compression = chunked_data_compression(file_type, cfg.TEST.BY_CHUNKS.COMPRESSION)
       
     filename, file_extension = os.path.splitext(os.path.basename(data_filename))
     
@@ -1737,12 +2014,31 @@ def insert_patch_into_dataset(data_filename, data_filename_mask, data_shape, out
                 out_data_shape = tuple(out_data_shape[:-1]) + (p.shape[-1],)
                 out_data_order = cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER
 
-            if file_type == "h5":
-                data = fid.create_dataset("data", out_data_shape, dtype=dtype_str, compression="gzip")
-                mask = fid_mask.create_dataset("data", out_data_shape, dtype=dtype_str, compression="gzip")
+            if use_mask:
+                data = fid.create_dataset("data", shape=out_data_shape, dtype=dtype_str, **compression)
+                mask = fid_mask.create_dataset("data", shape=out_data_shape, dtype=dtype_str, **compression)
             else:
-                data = fid.create_dataset("data", shape=out_data_shape, dtype=dtype_str)
-                mask = fid_mask.create_dataset("data", shape=out_data_shape, dtype=dtype_str)
+                # Chunks of the size of the patches (without padding) so the slabs are written in whole chunks 
+                chunks = [min(s, cfg.DATA.PATCH_SIZE[i]-2*cfg.DATA.TEST.PADDING[i]) for i, s in 
+                    enumerate(order_dimensions(out_data_shape, input_order=out_data_order, output_order="ZYX"))]
+                chunks = order_dimensions(tuple(chunks)+(p.shape[-1],), input_order="ZYXC", output_order=out_data_order,
+                    default_value=1)
+                data = fid.create_dataset("data", shape=out_data_shape, chunks=tuple(chunks), dtype=dtype_str, **compression)
+
+                # Patch positions of the rows in Z processed by this rank
+                axis_coords = [_patch_axis_coords(dim, cfg.DATA.PATCH_SIZE[i], cfg.DATA.TEST.OVERLAP[i], 
+                    cfg.DATA.TEST.PADDING[i]) for i, dim in enumerate(order_dimensions(data_shape, 
+                    input_order=cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER, output_order="ZYX"))]
+                total_ranks, rank = max(1,cfg.SYSTEM.NUM_GPUS), get_rank()
+                vols_per_z = len(axis_coords[0])
+                first_z = sum([vols_per_z//total_ranks + (1 if vols_per_z%total_ranks > r else 0) for r in range(rank)])
+                axis_coords[0] = axis_coords[0][first_z:first_z+vols_per_z//total_ranks + 
+                    (1 if vols_per_z%total_ranks > rank else 0)]
+                accumulator = SlabPatchAccumulator(data, out_data_order, chunks[out_data_order.index("Z")], axis_coords)
+
+        if not use_mask:
+            accumulator.add(p, patch_coords)
+            continue
 
         # Adjust slices to calculate where to insert the predicted patch. This slice does not have into account the 
         # channel so any of them can be inserted 
@@ -1765,6 +2061,9 @@ def insert_patch_into_dataset(data_filename, data_filename_mask, data_shape, out
             fid.flush() 
             fid_mask.flush() 
 
+    if not use_mask and 'accumulator' in locals():
+        accumulator.finish()
+
     # Save image
     if cfg.TEST.BY_CHUNKS.SAVE_OUT_TIF and cfg.PATHS.RESULT_DIR.PER_IMAGE != "":
         current_order = np.array(range(len(data.shape)))
@@ -1772,15 +2071,73 @@ def insert_patch_into_dataset(data_filename, data_filename_mask, data_shape, out
             output_order="TZYXC", default_value=np.nan)
         transpose_order = [x for x in transpose_order if not np.isnan(x)]
         data = np.array(data, dtype=dtype).transpose(transpose_order)
-        mask = np.array(mask, dtype=dtype).transpose(transpose_order)
         if "T" not in out_data_order:
             data = np.expand_dims(data,0)
-            mask = np.expand_dims(mask,0)
         save_tif(data, cfg.PATHS.RESULT_DIR.PER_IMAGE, [filename+".tif"], verbose=verbose)
-        save_tif(mask, cfg.PATHS.RESULT_DIR.PER_IMAGE, [filename+"_mask.tif"], verbose=verbose)
+        if use_mask:
+            mask = np.array(mask, dtype=dtype).transpose(transpose_order)
+            if "T" not in out_data_order:
+                mask = np.expand_dims(mask,0)
+            save_tif(mask, cfg.PATHS.RESULT_DIR.PER_IMAGE, [filename+"_mask.tif"], verbose=verbose)
     if file_type == "h5":
         fid.close()        
-        fid_mask.close()
+        if use_mask:
+            fid_mask.close()
 
     if verbose and cfg.SYSTEM.NUM_GPUS > 1:
         print(f"[Rank {get_rank()} ({os.getpid()})] Finish inserting patches into data . . .")
+
+def write_patch_into_owned_chunks(data_filename, output_queue, cfg, verbose=False):
+    """
+    Write the part of the predicted patches (in ``output_queue``) that each of them owns into the final Zarr file, 
+    created beforehand by the main rank, until a ``None`` is received. Used when ``TEST.BY_CHUNKS.SCHEDULER`` is 
+    ``'dynamic'``: the owned regions of the patches do not overlap and are aligned to the chunks of the Zarr so 
+    all the ranks can write into the same file at the same time. This function will be run by a child process 
+    created for every test sample.  
+
+    Parameters
+    ----------
+    data_filename : str
+        Path to the Zarr file to write into. 
+
+    output_queue : Multiprocessing queue 
+        Queue to get each prediction from.
+
+    cfg : YACS configuration
+        Running configuration.
+
+    verbose : bool, optional
+        To print useful information for debugging. 
+    """
+    if verbose and cfg.SYSTEM.NUM_GPUS > 1:
+        print(f"[Rank {get_rank()} ({os.getpid()})] In charge of writing patches into data . . .")
+
+    fid = zarr.open_group(data_filename, mode="r+")
+    data = fid["data"]
+    if "C" not in cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER:
+        out_data_order = cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER + "C"
+    else:
+        out_data_order = cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER
+
+    # Adjust patch slice to transpose it before inserting into the final data 
+    current_order = np.array(range(4))
+    transpose_order = order_dimensions(current_order, input_order="ZYXC", output_order=out_data_order,
+        default_value=np.nan)
+    transpose_order = [x for x in transpose_order if not np.isnan(x)]
+
+    while True:
+        obj = output_queue.get(timeout=60)
+        if obj is None:
+            break
+        p, _, (patch_coords, owned_in_data) = obj
+
+        # Crop the owned region of the patch
+        p = p[tuple(slice(o[0]-c[0], o[1]-c[0]) for o, c in zip(owned_in_data, patch_coords))]
+
+        slices = tuple(slice(o[0], o[1]) for o in owned_in_data) + (slice(None),)
+        data_ordered_slices = tuple(order_dimensions(slices, input_order="ZYXC", output_order=out_data_order,
+            default_value=0))
+        data[data_ordered_slices] = p.transpose(transpose_order)
+
+    if verbose and cfg.SYSTEM.NUM_GPUS > 1:
+        print(f"[Rank {get_rank()} ({os.getpid()})] Finish writing patches into data . . .")
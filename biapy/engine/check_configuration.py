@@ -1,4 +1,5 @@
 import os
+import importlib.util
 import numpy as np
 import collections
 import requests
@@ -13,6 +14,10 @@ def check_configuration(cfg, jobname, check_data_paths=True):
 
     if cfg.SYSTEM.NUM_WORKERS < 0:
         raise ValueError("'SYSTEM.NUM_WORKERS' can not be less than 0")
+    if cfg.SYSTEM.DATALOADER not in ['default', 'multi_epochs']:
+        raise ValueError("'SYSTEM.DATALOADER' must be one between ['default', 'multi_epochs']")
+    if cfg.SYSTEM.PREFETCH_FACTOR < 1:
+        raise ValueError("'SYSTEM.PREFETCH_FACTOR' needs to be greater than 0")
 
     dim_count = 2 if cfg.PROBLEM.NDIM == '2D' else 3
 
@@ -158,6 +163,10 @@ def check_configuration(cfg, jobname, check_data_paths=True):
     if cfg.PROBLEM.NDIM == '3D' and cfg.TEST.FULL_IMG:
         print("WARNING: TEST.FULL_IMG == True while using PROBLEM.NDIM == '3D'. As 3D images are usually 'huge'"
             ", full image statistics will be disabled to avoid GPU memory overflow")
+    if cfg.TEST.FULL_IMG_INFERENCE not in ['entire', 'smooth_windowing']:
+        raise ValueError("'TEST.FULL_IMG_INFERENCE' must be one between ['entire', 'smooth_windowing']")
+    if cfg.TEST.FULL_IMG_INFERENCE == 'smooth_windowing' and cfg.TEST.SMOOTH_WINDOWING_SUBDIVISIONS < 1:
+        raise ValueError("'TEST.SMOOTH_WINDOWING_SUBDIVISIONS' must be 1 or greater")
 
     if cfg.LOSS.TYPE != "CE" and cfg.PROBLEM.TYPE not in ['SEMANTIC_SEG', 'DETECTION']:
         raise ValueError("Not implemented pipeline option: LOSS.TYPE != 'CE' only available in 'SEMANTIC_SEG' and 'DETECTION'")
@@ -188,9 +197,13 @@ def check_configuration(cfg, jobname, check_data_paths=True):
         if cfg.TEST.AUGMENTATION:
             print("WARNING: 'TEST.AUGMENTATION' is not available using TorchVision models")
 
-    if cfg.TEST.AUGMENTATION and cfg.TEST.REDUCE_MEMORY:
-        raise ValueError("'TEST.AUGMENTATION' and 'TEST.REDUCE_MEMORY' are incompatible as the function used to make the rotation "
-            "does not support float16 data type.") 
+    if cfg.TEST.AUGMENTATION_BACKEND not in ['torch', 'numpy']:
+        raise ValueError("'TEST.AUGMENTATION_BACKEND' must be one between ['torch', 'numpy']")
+    if cfg.TEST.AUGMENTATION and cfg.TEST.AUGMENTATION_BACKEND == 'numpy' and cfg.TEST.REDUCE_MEMORY:
+        raise ValueError("'TEST.AUGMENTATION' with 'TEST.AUGMENTATION_BACKEND' 'numpy' and 'TEST.REDUCE_MEMORY' are incompatible "
+            "as the function used to make the rotation does not support float16 data type. Use 'TEST.AUGMENTATION_BACKEND' 'torch' instead") 
+    if cfg.TEST.LAZY_PATCHES and cfg.PROBLEM.NDIM == '2D':
+        raise ValueError("'TEST.LAZY_PATCHES' can only be activated when 'PROBLEM.NDIM' == 3D")
 
     if cfg.MODEL.N_CLASSES > 2 and cfg.PROBLEM.TYPE not in ['SEMANTIC_SEG','INSTANCE_SEG','DETECTION','CLASSIFICATION',"IMAGE_TO_IMAGE"]:
         raise ValueError("'MODEL.N_CLASSES' can only be greater than 2 in the following workflows: 'SEMANTIC_SEG', "
@@ -249,6 +262,12 @@ def check_configuration(cfg, jobname, check_data_paths=True):
         if cfg.PROBLEM.INSTANCE_SEG.DATA_CONTOUR_MODE == 'dense' and cfg.PROBLEM.INSTANCE_SEG.DATA_CHANNELS == "BCM":
             raise ValueError("'PROBLEM.INSTANCE_SEG.DATA_CONTOUR_MODE' can not be 'dense' when 'PROBLEM.INSTANCE_SEG.DATA_CHANNELS' is 'BCM'"
                 " as it does not have sense")
+        if cfg.TEST.MATCHING_STATS_OVERLAP_ENGINE not in ['bincount', 'loop']:
+            raise ValueError("'TEST.MATCHING_STATS_OVERLAP_ENGINE' must be one between ['bincount', 'loop']")
+        if cfg.TEST.MATCHING_STATS_OVERLAP_CHUNK_SIZE == 0 or cfg.TEST.MATCHING_STATS_OVERLAP_CHUNK_SIZE < -1:
+            raise ValueError("'TEST.MATCHING_STATS_OVERLAP_CHUNK_SIZE' must be -1 or a positive integer")
+        if cfg.TEST.MATCHING_STATS_MODE not in ['dense', 'sparse']:
+            raise ValueError("'TEST.MATCHING_STATS_MODE' must be one between ['dense', 'sparse']")
         if cfg.PROBLEM.INSTANCE_SEG.WATERSHED_BY_2D_SLICES:
             if cfg.PROBLEM.NDIM == "2D" and not cfg.TEST.ANALIZE_2D_IMGS_AS_3D_STACK:
                 raise ValueError("'PROBLEM.INSTANCE_SEG.WATERSHED_BY_2D_SLICE' can only be activated when 'PROBLEM.NDIM' == 3D or "
@@ -287,6 +306,8 @@ def check_configuration(cfg, jobname, check_data_paths=True):
                     "when 'TEST.POST_PROCESSING.DET_WATERSHED' is enabled")
         if cfg.TEST.DET_POINT_CREATION_FUNCTION not in ['peak_local_max', 'blob_log']:
             raise ValueError("'TEST.DET_POINT_CREATION_FUNCTION' must be one between: ['peak_local_max', 'blob_log']")
+        if cfg.TEST.DET_POINT_MATCHING not in ['dense', 'sparse']:
+            raise ValueError("'TEST.DET_POINT_MATCHING' must be one between: ['dense', 'sparse']")
         if cfg.MODEL.SOURCE == "torchvision":
             if cfg.MODEL.TORCHVISION_MODEL_NAME not in ['fasterrcnn_mobilenet_v3_large_320_fpn', 'fasterrcnn_mobilenet_v3_large_fpn', \
                 'fasterrcnn_resnet50_fpn', 'fasterrcnn_resnet50_fpn_v2', 'fcos_resnet50_fpn', 'ssd300_vgg16', 'ssdlite320_mobilenet_v3_large', \
@@ -406,6 +427,20 @@ def check_configuration(cfg, jobname, check_data_paths=True):
             raise ValueError('To use preprocessing DATA.VAL.IN_MEMORY needs to be True.')
     if not cfg.DATA.TEST.IN_MEMORY and cfg.DATA.PREPROCESS.TEST:
         raise ValueError('To use preprocessing DATA.TEST.IN_MEMORY needs to be True.')
+    if cfg.DATA.TEST.PREFETCH_DEPTH < 0:
+        raise ValueError("'DATA.TEST.PREFETCH_DEPTH' can not be less than 0")
+    if cfg.TRAIN.PRECISION not in ['fp32', 'fp16', 'bf16']:
+        raise ValueError("'TRAIN.PRECISION' must be one between ['fp32', 'fp16', 'bf16']")
+    if cfg.TRAIN.PRECISION == 'fp16' and cfg.SYSTEM.NUM_GPUS == 0:
+        raise ValueError("'TRAIN.PRECISION' 'fp16' can only be used with GPUs. Use 'bf16' instead to train in CPU")
+    if cfg.TEST.MERGE_BLENDING not in ['uniform', 'spline']:
+        raise ValueError("'TEST.MERGE_BLENDING' must be one between ['uniform', 'spline']")
+    if cfg.DATA.CHUNKED_DATA.MAX_OPEN_FILES <= 0:
+        raise ValueError("'DATA.CHUNKED_DATA.MAX_OPEN_FILES' needs to be greater than 0")
+    if cfg.DATA.CHUNKED_DATA.CACHE_MB < 0:
+        raise ValueError("'DATA.CHUNKED_DATA.CACHE_MB' can not be negative")
+    if cfg.DATA.IN_MEMORY_BACKEND not in ['numpy', 'shared_memory', 'memmap']:
+        raise ValueError("'DATA.IN_MEMORY_BACKEND' must be one between ['numpy', 'shared_memory', 'memmap']")
     
     ### Pre-processing ###
     if cfg.DATA.PREPROCESS.TRAIN or cfg.DATA.PREPROCESS.TEST or cfg.DATA.PREPROCESS.VAL:
@@ -456,8 +491,32 @@ def check_configuration(cfg, jobname, check_data_paths=True):
         if cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.ENABLE:     
             assert cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.TYPE in ["chunk_by_chunk", "entire_pred"], \
                 "'TEST.BY_CHUNKS.WORKFLOW_PROCESS.TYPE' needs to be one between ['chunk_by_chunk', 'entire_pred']"
+            assert cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.POINTS_FILE_FORMAT in ["csv", "parquet"], \
+                "'TEST.BY_CHUNKS.WORKFLOW_PROCESS.POINTS_FILE_FORMAT' needs to be one between ['csv', 'parquet']"
+            if cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.POINTS_FILE_FORMAT == "parquet" and importlib.util.find_spec("pyarrow") is None:
+                raise ValueError("'pyarrow' needs to be installed to use 'parquet' in 'TEST.BY_CHUNKS.WORKFLOW_PROCESS.POINTS_FILE_FORMAT'")
+            if len(cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.INSTANCE_HALO) != 3 or any([x < 0 for x in cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.INSTANCE_HALO]):
+                raise ValueError("'TEST.BY_CHUNKS.WORKFLOW_PROCESS.INSTANCE_HALO' needs to be a tuple of 3 non-negative integers, e.g. (8,32,32)")
+            if not (0 < cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.INSTANCE_STITCH_TH <= 1):
+                raise ValueError("'TEST.BY_CHUNKS.WORKFLOW_PROCESS.INSTANCE_STITCH_TH' needs to be in (0,1] range")
         if len(cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER) < 3:
             raise ValueError("'TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER' needs to be at least of length 3, e.g., 'ZYX'")
+        if cfg.TEST.BY_CHUNKS.BATCH_SIZE == 0 or cfg.TEST.BY_CHUNKS.BATCH_SIZE < -1:
+            raise ValueError("'TEST.BY_CHUNKS.BATCH_SIZE' needs to be -1 or a positive integer")
+        if cfg.TEST.BY_CHUNKS.MAX_SLAB_MB == 0 or cfg.TEST.BY_CHUNKS.MAX_SLAB_MB < -1:
+            raise ValueError("'TEST.BY_CHUNKS.MAX_SLAB_MB' needs to be -1 or a positive number")
+        if cfg.TEST.BY_CHUNKS.SCHEDULER not in ['static', 'dynamic']:
+            raise ValueError("'TEST.BY_CHUNKS.SCHEDULER' must be one between ['static', 'dynamic']")
+        if cfg.TEST.BY_CHUNKS.SCHEDULER == 'dynamic' and cfg.TEST.BY_CHUNKS.FORMAT.lower() != 'zarr':
+            raise ValueError("'TEST.BY_CHUNKS.SCHEDULER' == 'dynamic' needs 'TEST.BY_CHUNKS.FORMAT' to be 'zarr'")
+        if cfg.TEST.BY_CHUNKS.ACCUMULATION not in ['mask', 'buffer']:
+            raise ValueError("'TEST.BY_CHUNKS.ACCUMULATION' must be one between ['mask', 'buffer']")
+        if cfg.TEST.BY_CHUNKS.COMPRESSION not in ['default', 'gzip', 'blosc', 'lz4', 'zstd']:
+            raise ValueError("'TEST.BY_CHUNKS.COMPRESSION' must be one between ['default', 'gzip', 'blosc', 'lz4', 'zstd']")
+        if cfg.TEST.BY_CHUNKS.FORMAT.lower() == 'h5' and cfg.TEST.BY_CHUNKS.COMPRESSION not in ['default', 'gzip'] \
+            and importlib.util.find_spec("hdf5plugin") is None:
+            raise ValueError("'hdf5plugin' needs to be installed to use '{}' in 'TEST.BY_CHUNKS.COMPRESSION' with H5 files"
+                .format(cfg.TEST.BY_CHUNKS.COMPRESSION))
         if cfg.MODEL.N_CLASSES > 2:
             raise ValueError("Not implemented pipeline option: 'MODEL.N_CLASSES' > 2 and 'TEST.BY_CHUNKS'")
 
@@ -695,6 +754,18 @@ def check_configuration(cfg, jobname, check_data_paths=True):
     if cfg.AUGMENTOR.ENABLE:
         if not check_value(cfg.AUGMENTOR.DA_PROB):
             raise ValueError("AUGMENTOR.DA_PROB not in [0, 1] range")
+        if cfg.AUGMENTOR.BACKEND not in ['imgaug', 'torch']:
+            raise ValueError("AUGMENTOR.BACKEND not in ['imgaug', 'torch']")
+        if cfg.AUGMENTOR.BACKEND == 'torch':
+            if cfg.PROBLEM.TYPE not in ['SEMANTIC_SEG', 'INSTANCE_SEG', 'DETECTION', 'IMAGE_TO_IMAGE', 'SELF_SUPERVISED'] or \
+                (cfg.PROBLEM.TYPE == 'SELF_SUPERVISED' and cfg.PROBLEM.SELF_SUPERVISED.PRETEXT_TASK == "masking"):
+                raise ValueError("AUGMENTOR.BACKEND 'torch' is only available for SEMANTIC_SEG, INSTANCE_SEG, DETECTION, "
+                    "IMAGE_TO_IMAGE and SELF_SUPERVISED (with 'crappify' pretext task) workflows")
+            if cfg.AUGMENTOR.AFFINE_MODE not in ['constant', 'nearest', 'edge', 'reflect', 'symmetric', 'mirror']:
+                raise ValueError("AUGMENTOR.AFFINE_MODE not in ['constant', 'nearest', 'edge', 'reflect', 'symmetric', 'mirror'] "
+                    "when AUGMENTOR.BACKEND is 'torch'")
+            if cfg.AUGMENTOR.ELASTIC and cfg.AUGMENTOR.E_MODE == 'wrap':
+                raise ValueError("AUGMENTOR.E_MODE 'wrap' is not available when AUGMENTOR.BACKEND is 'torch'")
         if cfg.AUGMENTOR.RANDOM_ROT:
             if not check_value(cfg.AUGMENTOR.RANDOM_ROT_RANGE, (-360,360)):
                 raise ValueError("AUGMENTOR.RANDOM_ROT_RANGE values needs to be between [-360,360]")
@@ -754,4 +825,6 @@ def check_configuration(cfg, jobname, check_data_paths=True):
             raise ValueError("'DATA.TEST.RESOLUTION' must match in length to {}, which is the number of "
                              "dimensions".format(dim_count))
         if cfg.TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS_RADIUS[0] == -1:
-            raise ValueError("'TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS' needs to be set when 'TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS' is True")   
\ No newline at end of file
+            raise ValueError("'TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS' needs to be set when 'TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS' is True")   
+        if cfg.TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS_ORDER not in ['position', 'probability']:
+            raise ValueError("'TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS_ORDER' must be one between ['position', 'probability']")
\ No newline at end of file
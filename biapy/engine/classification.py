@@ -86,16 +86,16 @@ class Classification_Workflow(Base_Workflow):
         """
         with torch.no_grad():
             train_acc = self.metrics[0](output.to(torch.float32).detach().cpu(), targets.to(torch.float32).detach().cpu())
-            train_acc = train_acc.item() if not torch.isnan(train_acc) else 0
+            train_acc = torch.nan_to_num(train_acc, nan=0.)
             if self.cfg.MODEL.N_CLASSES > 5:
                 train_5acc = self.metrics[1](output.to(torch.float32).detach().cpu(), targets.to(torch.float32).detach().cpu())
-                train_5acc = train_5acc.item() if not torch.isnan(train_5acc) else 0
+                train_5acc = torch.nan_to_num(train_5acc, nan=0.)
             if metric_logger is not None:
                 metric_logger.meters[self.metric_names[0]].update(train_acc)
                 if self.cfg.MODEL.N_CLASSES > 5:
                     metric_logger.meters[self.metric_names[1]].update(train_5acc)
             else:
-                return train_acc
+                return train_acc.item()
 
     def prepare_targets(self, targets, batch):
         """
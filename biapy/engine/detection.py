@@ -1,6 +1,8 @@
 import os
 import math
 import csv
+import h5py
+import threading
 import torch 
 import torch.distributed as dist
 import numpy as np
@@ -139,11 +141,11 @@ class Detection_Workflow(Base_Workflow):
         """
         with torch.no_grad():
             train_iou = self.metrics[0](output, targets)
-            train_iou = train_iou.item() if not torch.isnan(train_iou) else 0
+            train_iou = torch.nan_to_num(train_iou, nan=0.)
             if metric_logger is not None:
                 metric_logger.meters[self.metric_names[0]].update(train_iou)
             else:
-                return train_iou
+                return train_iou.item()
 
     def detection_process(self, pred, filenames, metric_names=[], patch_pos=None, verbose=False):
         """
@@ -170,6 +172,8 @@ class Detection_Workflow(Base_Workflow):
             print("Capturing the local maxima ")
         all_points = []
         all_classes = []
+        all_probs = []
+        by_prob = self.cfg.TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS_ORDER == 'probability'
         for channel in range(pred.shape[-1]):
             if self.cfg.TEST.VERBOSE:
                 print("Class {}".format(channel+1))
@@ -196,10 +200,13 @@ class Detection_Workflow(Base_Workflow):
                 else:
                     radius = self.cfg.TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS_RADIUS[channel]
 
+                probs = pred[tuple(np.array(pred_coordinates).T)+(channel,)] if by_prob and len(pred_coordinates) > 0 else None
                 pred_coordinates = remove_close_points(pred_coordinates, radius, self.cfg.DATA.TEST.RESOLUTION,
-                    ndim=ndim)
+                    ndim=ndim, probabilities=probs, num_workers=self.cfg.SYSTEM.NUM_CPUS)
                     
             all_points.append(pred_coordinates)   
+            if by_prob and len(pred_coordinates) > 0:
+                all_probs.append(pred[tuple(np.array(pred_coordinates).T)+(channel,)])
             c_size = 1 if len(pred_coordinates) == 0 else len(pred_coordinates)
             all_classes.append(np.full(c_size, channel))
 
@@ -215,7 +222,8 @@ class Detection_Workflow(Base_Workflow):
             all_classes = np.concatenate(all_classes, axis=0)
 
             new_points, all_classes = remove_close_points(all_points, radius, self.cfg.DATA.TEST.RESOLUTION,
-                classes=all_classes, ndim=ndim)
+                classes=all_classes, ndim=ndim, probabilities=np.concatenate(all_probs) if by_prob and len(all_probs) > 0 else None, 
+                num_workers=self.cfg.SYSTEM.NUM_CPUS)
             
             # Create again list of arrays of all points
             all_points = []
@@ -412,7 +420,7 @@ class Detection_Workflow(Base_Workflow):
                     if self.cfg.TEST.VERBOSE:
                         print("Detection (class "+str(ch+1)+")")
                     d_metrics, gt_assoc, fp = detection_metrics(gt_coordinates, pred_coordinates, tolerance=self.cfg.TEST.DET_TOLERANCE[ch],
-                        voxel_size=self.v_size, return_assoc=True, verbose=self.cfg.TEST.VERBOSE)
+                        voxel_size=self.v_size, return_assoc=True, verbose=self.cfg.TEST.VERBOSE, matching=self.cfg.TEST.DET_POINT_MATCHING)
                     if self.cfg.TEST.VERBOSE:
                         print("Detection metrics: {}".format(d_metrics))
                     all_channel_d_metrics[0] += d_metrics["Precision"]
@@ -572,7 +580,7 @@ class Detection_Workflow(Base_Workflow):
             NotImplementedError
         
 
-    def process_patch(self, z, y, x, _filename, total_patches, c, pred, d, file_ext, z_dim, y_dim, x_dim):
+    def process_patch(self, z, y, x, _filename, total_patches, c, pred_filename, d, file_ext, z_dim, y_dim, x_dim):
         """
         Process a patch for the detection workflow.
 
@@ -596,8 +604,8 @@ class Detection_Workflow(Base_Workflow):
         c : int
             Current patch number.
 
-        pred : 4D numpy array
-            Model prediction.
+        pred_filename : str
+            Path to the H5/Zarr file of the model prediction. Each thread reads it through its own handle.
 
         d : int
             Number of digits of the total patches.
@@ -646,6 +654,7 @@ class Detection_Workflow(Base_Workflow):
             default_value = 0,
             )
 
+        pred = self._thread_chunked_data(pred_filename)
         raw_patch = pred[data_ordered_slices]
 
         if "C" not in self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER:                                                     
@@ -695,6 +704,27 @@ class Detection_Workflow(Base_Workflow):
         
         return None, None
 
+    def _thread_chunked_data(self, filename):
+        """
+        Return the dataset of ``filename`` opened by the calling thread, opening it the first time. H5 and Zarr handles 
+        are not safe to share between threads so each thread reads through its own.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the H5/Zarr file.
+
+        Returns
+        -------
+        data : H5 dataset or Zarr array
+            First dataset found in the file.
+        """
+        if not hasattr(self._chunked_data_handles, filename):
+            fid, data = read_chunked_data(filename)
+            setattr(self._chunked_data_handles, filename, data)
+            self._opened_chunked_files.append(fid)
+        return getattr(self._chunked_data_handles, filename)
+
     def after_merge_patches_by_chunks_proccess_patch(self, filename):
         """
         Place any code that needs to be done after merging all predicted patches into the original image
@@ -706,6 +736,8 @@ class Detection_Workflow(Base_Workflow):
         filename : List of str
             Filename of the predicted image H5/Zarr.
         """
+        if not is_main_process():
+            return
 
         _filename, file_ext = os.path.splitext(os.path.basename(filename))
         print("Detection workflow pipeline continues for image {}".format(_filename))
@@ -725,44 +757,57 @@ class Detection_Workflow(Base_Workflow):
         c=1
 
         workers = self.cfg.SYSTEM.NUM_WORKERS if self.cfg.SYSTEM.NUM_WORKERS > 0 else None
+        self._chunked_data_handles = threading.local()
+        self._opened_chunked_files = []
         with ThreadPoolExecutor(max_workers=workers) as executor:
             futures = []
             for z in tqdm(range(z_vols), disable=not is_main_process()):
                 for y in range(y_vols):
                     for x in range(x_vols):
-                        futures.append(executor.submit(self.process_patch, z, y, x, _filename, total_patches, c, pred, d, file_ext, z_dim, y_dim, x_dim))
+                        futures.append(executor.submit(self.process_patch, z, y, x, _filename, total_patches, c, filename, d, file_ext, z_dim, y_dim, x_dim))
                         c+=1
 
-        for future in futures:
-            df_patch, fname = future.result()
-            if df_patch is not None:
-                if 'df' not in locals():
-                    df = df_patch.copy()
-                    df['file'] = fname
-                else:
-                    df_patch['file'] = fname
-                    df = pd.concat([df, df_patch], ignore_index=True)
+            # Gather the columns of all patches to build the table only once
+            columns, fnames, npoints = {}, [], []
+            for future in futures:
+                df_patch, fname = future.result()
+                if df_patch is not None:
+                    for col in df_patch.columns:
+                        columns.setdefault(col, []).append(df_patch[col].to_numpy())
+                    fnames.append(fname)
+                    npoints.append(len(df_patch))
+            del futures
+
+        for fid in self._opened_chunked_files:
+            if isinstance(fid, h5py.File):
+                fid.close()
+        del self._chunked_data_handles, self._opened_chunked_files
+
+        if len(columns) == 0:
+            columns = {'axis-0': [np.zeros(0, dtype=int)], 'axis-1': [np.zeros(0, dtype=int)], 'axis-2': [np.zeros(0, dtype=int)]}
+        df = pd.DataFrame({col: np.concatenate(arrays) for col, arrays in columns.items()})
+        df['file'] = np.repeat(np.array(fnames, dtype=object), npoints)
+        del columns
 
         # Take point coords
-        pred_coordinates = []
-        coordz = df['axis-0'].tolist()
-        coordy = df['axis-1'].tolist()
-        coordx = df['axis-2'].tolist()
-        for z,y,x in zip(coordz,coordy,coordx):
-            pred_coordinates.append([z,y,x])
+        pred_coordinates = df[['axis-0', 'axis-1', 'axis-2']].to_numpy()
 
         # Apply post-processing of removing points
-        if self.cfg.TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS and self.by_chunks:
+        if self.cfg.TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS and self.by_chunks and len(pred_coordinates) > 0:
             radius = self.cfg.TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS_RADIUS[0]
+            probs = df['probability'].to_numpy() if self.cfg.TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS_ORDER == 'probability' else None
             pred_coordinates, dropped_pos = remove_close_points(pred_coordinates, radius, self.cfg.DATA.TEST.RESOLUTION,
-                ndim=3, return_drops=True)
+                ndim=3, return_drops=True, probabilities=probs, num_workers=self.cfg.SYSTEM.NUM_CPUS)
 
             # Remove points from dataframe
             df = df.drop(dropped_pos)
 
         # Save large csv with all point of all patches
         df = df.sort_values(by=['file'])
-        df.to_csv(os.path.join(self.cfg.PATHS.RESULT_DIR.DET_LOCAL_MAX_COORDS_CHECK, _filename+'_all_points.csv'))
+        if self.cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.POINTS_FILE_FORMAT == "parquet":
+            df.to_parquet(os.path.join(self.cfg.PATHS.RESULT_DIR.DET_LOCAL_MAX_COORDS_CHECK, _filename+'_all_points.parquet'))
+        else:
+            df.to_csv(os.path.join(self.cfg.PATHS.RESULT_DIR.DET_LOCAL_MAX_COORDS_CHECK, _filename+'_all_points.csv'))
 
         if self.cfg.TEST.BY_CHUNKS.FORMAT == "h5":
             pred_file.close()
@@ -788,7 +833,7 @@ class Detection_Workflow(Base_Workflow):
 
             # Measure metrics
             d_metrics, gt_assoc, fp = detection_metrics(gt_coordinates, pred_coordinates, tolerance=self.cfg.TEST.DET_TOLERANCE[0],
-                voxel_size=self.v_size, return_assoc=True, verbose=self.cfg.TEST.VERBOSE)
+                voxel_size=self.v_size, return_assoc=True, verbose=self.cfg.TEST.VERBOSE, matching=self.cfg.TEST.DET_POINT_MATCHING)
             print("Detection metrics: {}".format(d_metrics))
 
             self.stats['d_precision_by_chunks'] += d_metrics["Precision"]
@@ -10,7 +10,6 @@ from biapy.engine.base_workflow import Base_Workflow
 from biapy.utils.util import save_tif, check_masks, pad_and_reflect
 from biapy.utils.misc import to_pytorch_format, to_numpy_format
 from biapy.data.pre_processing import norm_range01, undo_norm_range01, denormalize
-from biapy.data.post_processing.post_processing import ensemble8_2d_predictions, ensemble16_3d_predictions
 from biapy.data.data_2D_manipulation import crop_data_with_overlap, merge_data_with_overlap
 from biapy.data.data_3D_manipulation import crop_3D_data_with_overlap, merge_3D_data_with_overlap
 from biapy.engine.metrics import L1_wrapper, MSE_wrapper
@@ -77,16 +76,16 @@ class Image_to_Image_Workflow(Base_Workflow):
         """
         with torch.no_grad():
             train_psnr = self.metrics[0](output.squeeze(), targets.squeeze())
-            train_psnr = train_psnr.item() if not torch.isnan(train_psnr) else 0
+            train_psnr = torch.nan_to_num(train_psnr, nan=0.)
 
             train_mse = self.metrics[1](output.squeeze(), targets.squeeze())
-            train_mse = train_mse.item() if not torch.isnan(train_mse) else 0
+            train_mse = torch.nan_to_num(train_mse, nan=0.)
 
             if metric_logger is not None:
                 metric_logger.meters[self.metric_names[0]].update(train_psnr)
                 metric_logger.meters[self.metric_names[1]].update(train_mse)
-
-            return train_psnr, train_mse
+            else:
+                return train_psnr.item(), train_mse.item()
 
     def process_sample(self, norm): 
         """
@@ -139,13 +138,7 @@ class Image_to_Image_Workflow(Base_Workflow):
         # Predict each patch
         if self.cfg.TEST.AUGMENTATION:
             for k in tqdm(range(self._X.shape[0]), leave=False):
-                if self.cfg.PROBLEM.NDIM == '2D':
-                    p = ensemble8_2d_predictions(self._X[k], axis_order_back=self.axis_order_back,
-                            pred_func=self.model_call_func, axis_order=self.axis_order, device=self.device)
-                else:
-                    p = ensemble16_3d_predictions(self._X[k], batch_size_value=self.cfg.TRAIN.BATCH_SIZE,
-                            axis_order_back=self.axis_order_back, pred_func=self.model_call_func, 
-                            axis_order=self.axis_order, device=self.device)
+                p = self.predict_with_tta(self._X[k])
                 p = self.apply_model_activations(p)
                 p = to_numpy_format(p, self.axis_order_back)
                 if 'pred' not in locals():
@@ -8,8 +8,8 @@ from skimage.segmentation import clear_border
 from skimage.transform import resize
 import torch.distributed as dist
 
-from biapy.data.post_processing.post_processing import (watershed_by_channels, voronoi_on_mask, 
-    measure_morphological_props_and_filter, repare_large_blobs, apply_binary_mask)
+from biapy.data.post_processing.post_processing import (watershed_by_channels, watershed_by_chunks, voronoi_on_mask, 
+    measure_morphological_props_and_filter, repare_large_blobs, apply_binary_mask, assign_instance_classes)
 from biapy.data.pre_processing import create_instance_channels, create_test_instance_channels, norm_range01
 from biapy.utils.util import save_tif
 from biapy.utils.matching import matching, wrapper_matching_dataset_lazy
@@ -183,13 +183,13 @@ class Instance_Segmentation_Workflow(Base_Workflow):
             out = self.metrics(output, targets)
             first_val = None
             for key, value in out.items():
-                value = value.item() if not torch.isnan(value) else 0
+                value = torch.nan_to_num(value, nan=0.)
                 if first_val is None and "jaccard_index" in key: 
                     first_val = value
                 if metric_logger is not None:
                     metric_logger.meters[key].update(value)
-        if first_val is None: first_val = 0
-        return first_val
+        if metric_logger is None:
+            return first_val.item() if first_val is not None else 0
 
     def instance_seg_process(self, pred, filenames, out_dir, out_dir_post_proc, resolution):
         """
@@ -237,26 +237,9 @@ class Instance_Segmentation_Workflow(Base_Workflow):
             # Multi-head: instances + classification
             if self.cfg.MODEL.N_CLASSES > 2:
                 print("Adapting class channel . . .")
-                labels = np.unique(w_pred)[1:]
-                new_class_channel = np.zeros(w_pred.shape, dtype=w_pred.dtype)
                 # Classify each instance counting the most prominent class of all the pixels that compose it
-                for l in labels:
-                    instance_classes, instance_classes_count = np.unique(class_channel[w_pred == l], return_counts=True)
-                    
-                    # Remove background
-                    if instance_classes[0] == 0:
-                        instance_classes = instance_classes[1:]
-                        instance_classes_count = instance_classes_count[1:]
-
-                    if len(instance_classes) > 0:
-                        label_selected = int(instance_classes[np.argmax(instance_classes_count)])
-                    else: # Label by default with class 1 in case there was no class info
-                        label_selected = 1 
-                    new_class_channel = np.where(w_pred == l, label_selected, new_class_channel) 
-
-                class_channel = new_class_channel
+                class_channel = assign_instance_classes(w_pred, class_channel)
                 class_channel = class_channel.squeeze()
-                del new_class_channel
                 save_tif(np.expand_dims(np.concatenate([np.expand_dims(w_pred.squeeze(),-1), np.expand_dims(class_channel,-1)],axis=-1),0), 
                     out_dir, filenames, verbose=self.cfg.TEST.VERBOSE)
             else:
@@ -333,7 +316,9 @@ class Instance_Segmentation_Workflow(Base_Workflow):
             diff_ths_colored_img = abs(len(self.cfg.TEST.MATCHING_STATS_THS_COLORED_IMG) - len(self.cfg.TEST.MATCHING_STATS_THS))
             colored_img_ths = self.cfg.TEST.MATCHING_STATS_THS_COLORED_IMG+[-1]*diff_ths_colored_img
 
-            results = matching(_Y, w_pred, thresh=self.cfg.TEST.MATCHING_STATS_THS, report_matches=True)
+            results = matching(_Y, w_pred, thresh=self.cfg.TEST.MATCHING_STATS_THS, report_matches=True,
+                overlap_engine=self.cfg.TEST.MATCHING_STATS_OVERLAP_ENGINE, overlap_chunk_size=self.cfg.TEST.MATCHING_STATS_OVERLAP_CHUNK_SIZE,
+                mode=self.cfg.TEST.MATCHING_STATS_MODE)
             for i in range(len(results)):
                 # Extract TPs, FPs and FNs from the resulting matching data structure 
                 r_stats = results[i] 
@@ -343,14 +328,16 @@ class Instance_Segmentation_Workflow(Base_Workflow):
                 gt_ids = r_stats['gt_ids'][1:]
                 matched_pairs = r_stats['matched_pairs']
                 gt_match = [x[0] for x in matched_pairs]
-                gt_unmatch = [x for x in gt_ids if x not in gt_match]
+                gt_match_set = set(gt_match)
+                gt_unmatch = [x for x in gt_ids if x not in gt_match_set]
                 matched_scores = list(r_stats['matched_scores'])+[0 for _ in gt_unmatch]
                 pred_match = [x[1] for x in matched_pairs]+[-1 for _ in gt_unmatch]
                 tag = ["TP" if score >= thr else "FN" for score in matched_scores]
 
                 # FPs
                 pred_ids = r_stats['pred_ids'][1:]
-                fp_instances = [x for x in pred_ids if x not in pred_match]
+                pred_match_set = set(pred_match)
+                fp_instances = [x for x in pred_ids if x not in pred_match_set]
                 fp_instances += [pred_id for score, pred_id in zip(matched_scores, pred_match) if score < thr]
 
                 # Save csv files
@@ -451,7 +438,9 @@ class Instance_Segmentation_Workflow(Base_Workflow):
                     w_pred = np.expand_dims(w_pred,0)
 
                 print("Calculating matching stats after post-processing . . .")
-                results_post_proc = matching(_Y, w_pred, thresh=self.cfg.TEST.MATCHING_STATS_THS, report_matches=True)
+                results_post_proc = matching(_Y, w_pred, thresh=self.cfg.TEST.MATCHING_STATS_THS, report_matches=True,
+                    overlap_engine=self.cfg.TEST.MATCHING_STATS_OVERLAP_ENGINE, overlap_chunk_size=self.cfg.TEST.MATCHING_STATS_OVERLAP_CHUNK_SIZE,
+                    mode=self.cfg.TEST.MATCHING_STATS_MODE)
                 
                 for i in range(len(results_post_proc)):
                     # Extract TPs, FPs and FNs from the resulting matching data structure 
@@ -462,14 +451,16 @@ class Instance_Segmentation_Workflow(Base_Workflow):
                     gt_ids = r_stats['gt_ids'][1:]
                     matched_pairs = r_stats['matched_pairs']
                     gt_match = [x[0] for x in matched_pairs]
-                    gt_unmatch = [x for x in gt_ids if x not in gt_match]
+                    gt_match_set = set(gt_match)
+                    gt_unmatch = [x for x in gt_ids if x not in gt_match_set]
                     matched_scores = list(r_stats['matched_scores'])+[0 for _ in gt_unmatch]
                     pred_match = [x[1] for x in matched_pairs]+[-1 for _ in gt_unmatch]
                     tag = ["TP" if score >= thr else "FN" for score in matched_scores]
 
                     # FPs
                     pred_ids = r_stats['pred_ids'][1:]
-                    fp_instances = [x for x in pred_ids if x not in pred_match]
+                    pred_match_set = set(pred_match)
+                    fp_instances = [x for x in pred_ids if x not in pred_match_set]
                     fp_instances += [pred_id for score, pred_id in zip(matched_scores, pred_match) if score < thr]
 
                     # Save csv files
@@ -574,7 +565,36 @@ class Instance_Segmentation_Workflow(Base_Workflow):
         filename : List of str
             Filename of the predicted image H5/Zarr.  
         """
-        pass
+        _filename, file_ext = os.path.splitext(os.path.basename(filename))
+        # The thresholds can not be calculated with the entire image, so the instances are only created block by
+        # block with manual thresholds
+        if self.cfg.PROBLEM.INSTANCE_SEG.DATA_MW_TH_TYPE == "auto":
+            if is_main_process():
+                print("Skipping the creation of instances block by block for image {}, as it needs "
+                    "'PROBLEM.INSTANCE_SEG.DATA_MW_TH_TYPE' to be 'manual'".format(_filename))
+            return
+
+        if is_main_process():
+            print("Creating instances with watershed block by block for image {} . . .".format(_filename))
+        os.makedirs(self.cfg.PATHS.RESULT_DIR.PER_IMAGE_INSTANCES, exist_ok=True)
+
+        if "C" not in self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER:
+            pred_axes_order = self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER + "C"
+        else:
+            pred_axes_order = self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER
+        out_filename = os.path.join(self.cfg.PATHS.RESULT_DIR.PER_IMAGE_INSTANCES, _filename+file_ext)
+        num_instances = watershed_by_chunks(filename, out_filename, self.cfg.PROBLEM.INSTANCE_SEG.DATA_CHANNELS, 
+            block_shape=self.cfg.DATA.PATCH_SIZE[:-1], halo=self.cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.INSTANCE_HALO, 
+            axes_order=pred_axes_order, stitch_th=self.cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.INSTANCE_STITCH_TH, 
+            num_workers=self.cfg.SYSTEM.NUM_CPUS, verbose=self.cfg.TEST.VERBOSE, ths=self.instance_ths, 
+            remove_before=self.cfg.PROBLEM.INSTANCE_SEG.DATA_REMOVE_BEFORE_MW, thres_small_before=self.cfg.PROBLEM.INSTANCE_SEG.DATA_REMOVE_SMALL_OBJ_BEFORE,
+            seed_morph_sequence=self.cfg.PROBLEM.INSTANCE_SEG.SEED_MORPH_SEQUENCE, seed_morph_radius=self.cfg.PROBLEM.INSTANCE_SEG.SEED_MORPH_RADIUS, 
+            erode_and_dilate_foreground=self.cfg.PROBLEM.INSTANCE_SEG.ERODE_AND_DILATE_FOREGROUND, fore_erosion_radius=self.cfg.PROBLEM.INSTANCE_SEG.FORE_EROSION_RADIUS, 
+            fore_dilation_radius=self.cfg.PROBLEM.INSTANCE_SEG.FORE_DILATION_RADIUS, rmv_close_points=self.cfg.TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS, 
+            remove_close_points_radius=self.cfg.TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS_RADIUS[0], resolution=self.cfg.DATA.TEST.RESOLUTION,
+            watershed_by_2d_slices=self.cfg.PROBLEM.INSTANCE_SEG.WATERSHED_BY_2D_SLICES)
+        if is_main_process():
+            print("{} instances created. Saved in {}".format(num_instances, out_filename))
 
     def after_full_image(self, pred):
         """
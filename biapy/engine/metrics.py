@@ -6,8 +6,10 @@ import numpy as np
 import pandas as pd
 from skimage import measure
 from PIL import Image
-from scipy.spatial import distance_matrix
+from scipy.spatial import distance_matrix, cKDTree
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from torchmetrics import JaccardIndex
 from torchmetrics.image import StructuralSimilarityIndexMeasure
 from torchvision.transforms.functional import resize
@@ -515,7 +517,66 @@ class instance_segmentation_loss():
         
         return loss
 
-def detection_metrics(true, pred, tolerance=10, voxel_size=(1,1,1), return_assoc=False, verbose=False):
+def _sparse_points_matching(pred, true, tolerance):
+    """
+    Match predicted and ground truth points that are closer than ``tolerance``. Only those pairs are considered, 
+    found with a KD-tree, and each connected group of them is solved separately maximizing first the number of 
+    matches and then minimizing the sum of their distances.
+
+    Parameters
+    ----------
+    pred : 2D Numpy array
+        Predicted points. E.g. ``(num_of_points, 3)``.
+
+    true : 2D Numpy array
+        Ground truth points. E.g. ``(num_of_points, 3)``.
+
+    tolerance : float
+        Maximum distance between matched points (not included). 
+
+    Returns
+    -------
+    pred_ind : 1D Numpy array
+        Indexes of the matched predicted points.
+
+    true_ind : 1D Numpy array
+        Indexes of the matched ground truth points.
+
+    distances : 1D Numpy array
+        Distance between each pair of matched points.
+    """
+    pairs = cKDTree(pred).sparse_distance_matrix(cKDTree(true), tolerance, output_type='ndarray')
+    pairs = pairs[pairs['v'] < tolerance]
+    pi, ti, d = pairs['i'].astype(np.int64), pairs['j'].astype(np.int64), pairs['v']
+    if len(d) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    # Predicted points are the nodes [0, len(pred)) and ground truth ones [len(pred), len(pred)+len(true))
+    graph = coo_matrix((np.ones(len(d)), (pi, ti+len(pred))), shape=(len(pred)+len(true),)*2)
+    _, node_comp = connected_components(graph, directed=False)
+    comp = node_comp[pi]
+    order = np.argsort(comp, kind='stable')
+    pi, ti, d, comp = pi[order], ti[order], d[order], comp[order]
+    starts = np.flatnonzero(np.r_[True, comp[1:] != comp[:-1]])
+    ends = np.r_[starts[1:], len(comp)]
+
+    # Groups with just one pair are matched directly
+    matched = np.zeros(len(d), dtype=bool)
+    matched[starts[ends-starts == 1]] = True
+    for s, e in zip(starts[ends-starts > 1], ends[ends-starts > 1]):
+        rows, r_ind = np.unique(pi[s:e], return_inverse=True)
+        cols, c_ind = np.unique(ti[s:e], return_inverse=True)
+        # Any missing pair costs more than all the possible matches together
+        cost = np.full((len(rows), len(cols)), tolerance*(min(len(rows), len(cols))+1), dtype=np.float64)
+        cost[r_ind, c_ind] = d[s:e]
+        pair_ind = np.full((len(rows), len(cols)), -1, dtype=np.int64)
+        pair_ind[r_ind, c_ind] = np.arange(s, e)
+        r, c = linear_sum_assignment(cost)
+        sel = pair_ind[r, c]
+        matched[sel[sel != -1]] = True
+    return pi[matched], ti[matched], d[matched]
+
+def detection_metrics(true, pred, tolerance=10, voxel_size=(1,1,1), return_assoc=False, verbose=False, matching="dense"):
     """Calculate detection metrics based on
 
        Parameters
@@ -539,6 +600,13 @@ def detection_metrics(true, pred, tolerance=10, voxel_size=(1,1,1), return_assoc
        verbose : bool, optional
             To print extra information.
 
+       matching : str, optional
+           How to match the points. ``'dense'`` solves the assignment over the distance matrix of all the points, 
+           associating every GT point to a prediction when there are enough, even if they are far. ``'sparse'`` 
+           only considers the pairs closer than ``tolerance``, found with a KD-tree, and maximizes the number of 
+           them matched, so it scales to hundreds of thousands of points. The GT points without a match are 
+           associated to ``-1``.
+
        Returns
        -------
        metrics : List of strings
@@ -549,54 +617,54 @@ def detection_metrics(true, pred, tolerance=10, voxel_size=(1,1,1), return_assoc
     _pred = np.array(pred, dtype=np.float32)
 
     TP, FP, FN = 0, 0, 0
-    tag = ["FN" for x in _true]
-    fp_preds = list(range(1,len(_pred)+1))
+    tag = np.full(len(_true), "FN", dtype=object)
+    fp_preds = np.arange(1,len(_pred)+1)
     dis = [-1 for x in _true]
-    pred_id_assoc = [-1 for x in _true]    
+    pred_id_assoc = np.full(len(_true), -1, dtype=np.int64)
 
     if len(_true) > 0:
+        _pred = _pred.reshape(-1, _true.shape[-1])
         # Multiply each axis for the its real value
         for i in range(len(voxel_size)):
             _true[:,i] *= voxel_size[i]
             _pred[:,i] *= voxel_size[i]
 
-        # Create cost matrix
-        distances = distance_matrix(_pred, _true)
-        n_matched = min(len(_true), len(_pred))
-        costs = -(distances >= tolerance).astype(float) - distances / (2*n_matched)
-        pred_ind, true_ind = linear_sum_assignment(-costs)
+        if matching == "sparse":
+            pred_ind, true_ind, assoc_dis = _sparse_points_matching(_pred, _true, tolerance)
+        else:
+            # Create cost matrix
+            distances = distance_matrix(_pred, _true)
+            n_matched = min(len(_true), len(_pred))
+            costs = -(distances >= tolerance).astype(float) - distances / (2*n_matched)
+            pred_ind, true_ind = linear_sum_assignment(-costs)
+            assoc_dis = distances[pred_ind,true_ind]
 
         # Analyse which associations are below the tolerance to consider them TP
-        for i in range(len(pred_ind)):
-            if distances[pred_ind[i],true_ind[i]] < tolerance:
-                TP += 1
-                tag[true_ind[i]] = "TP"
-                fp_preds.remove(pred_ind[i]+1)
-
-            dis[true_ind[i]] = distances[pred_ind[i],true_ind[i]]
-            pred_id_assoc[true_ind[i]] = pred_ind[i]+1
+        tp = assoc_dis < tolerance
+        TP = int(tp.sum())
+        tag[true_ind[tp]] = "TP"
+        fp_preds = np.delete(fp_preds, pred_ind[tp])
+        for i, d in zip(true_ind.tolist(), assoc_dis.tolist()):
+            dis[i] = d
+        pred_id_assoc[true_ind] = pred_ind+1
 
         FN = len(_true) - TP
     FP = len(_pred) - TP
+    tag, fp_preds, pred_id_assoc = tag.tolist(), fp_preds.tolist(), pred_id_assoc.tolist()
 
     # Create tow dataframes with the GT and prediction points association made and another one with the FPs
     df, df_fp = None, None
     if return_assoc and len(_true) > 0:
         _true = np.array(true, dtype=np.float32)
-        _pred = np.array(pred, dtype=np.float32)
+        _pred = np.array(pred, dtype=np.float32).reshape(-1, _true.shape[-1])
 
         # Capture FP coords
-        fp_coords = np.zeros((len(fp_preds),_pred.shape[-1]))
-        for i in range(len(fp_preds)):
-            fp_coords[i] = _pred[fp_preds[i]-1]
+        fp_coords = _pred[np.array(fp_preds, dtype=np.int64)-1].astype(np.float64)
 
         # Capture prediction coords
         pred_coords = np.zeros( (len(pred_id_assoc), 3), dtype=np.float32)
-        for i in range(len(pred_id_assoc)):
-            if pred_id_assoc[i] != -1:
-                pred_coords[i] = _pred[pred_id_assoc[i]-1]
-            else:
-                pred_coords[i] = [0,0,0]
+        assoc = np.array(pred_id_assoc, dtype=np.int64)
+        pred_coords[assoc != -1] = _pred[assoc[assoc != -1]-1]
 
         df = pd.DataFrame(zip(list(range(1,len(_true)+1)), pred_id_assoc, dis, tag, _true[...,0], 
             _true[...,1], _true[...,2], pred_coords[...,0], pred_coords[...,1], pred_coords[...,2]), 
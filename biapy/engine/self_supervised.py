@@ -8,7 +8,6 @@ import torch.distributed as dist
 
 from biapy.data.data_2D_manipulation import crop_data_with_overlap, merge_data_with_overlap
 from biapy.data.data_3D_manipulation import crop_3D_data_with_overlap, merge_3D_data_with_overlap
-from biapy.data.post_processing.post_processing import ensemble8_2d_predictions, ensemble16_3d_predictions
 from biapy.utils.util import save_tif, pad_and_reflect
 from biapy.utils.misc import to_pytorch_format, to_numpy_format, is_main_process, is_dist_avail_and_initialized
 from biapy.engine.base_workflow import Base_Workflow
@@ -105,11 +104,11 @@ class Self_supervised_Workflow(Base_Workflow):
             pred = output
         with torch.no_grad():
             train_psnr = self.metrics[0](pred, targets)
-            train_psnr = train_psnr.item() if not torch.isnan(train_psnr) else 0
+            train_psnr = torch.nan_to_num(train_psnr, nan=0.)
             if metric_logger is not None:
                 metric_logger.meters[self.metric_names[0]].update(train_psnr)
             else:
-                return train_psnr
+                return train_psnr.item()
 
     def prepare_targets(self, targets, batch):
         """
@@ -166,13 +165,7 @@ class Self_supervised_Workflow(Base_Workflow):
         # Predict each patch
         if self.cfg.TEST.AUGMENTATION:
             for k in tqdm(range(self._X.shape[0]), leave=False, disable=not is_main_process()):
-                if self.cfg.PROBLEM.NDIM == '2D':
-                    p = ensemble8_2d_predictions(self._X[k], axis_order_back=self.axis_order_back,
-                            pred_func=self.model_call_func, axis_order=self.axis_order, device=self.device)
-                else:
-                    p = ensemble16_3d_predictions(self._X[k], batch_size_value=self.cfg.TRAIN.BATCH_SIZE,
-                            axis_order_back=self.axis_order_back, pred_func=self.model_call_func, 
-                            axis_order=self.axis_order, device=self.device)
+                p = self.predict_with_tta(self._X[k])
                 p = self.apply_model_activations(p)
                 p = to_numpy_format(p, self.axis_order_back)
                 if 'pred' not in locals():
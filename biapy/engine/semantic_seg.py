@@ -191,11 +191,11 @@ class Semantic_Segmentation_Workflow(Base_Workflow):
         """
         with torch.no_grad():
             train_iou = self.metrics[0](output, targets)
-            train_iou = train_iou.item() if not torch.isnan(train_iou) else 0
+            train_iou = torch.nan_to_num(train_iou, nan=0.)
             if metric_logger is not None:
                 metric_logger.meters[self.metric_names[0]].update(train_iou)
             else:
-                return train_iou
+                return train_iou.item()
 
     def prepare_targets(self, targets, batch):
         """
@@ -5,10 +5,11 @@ import numpy as np
 from typing import Iterable
 from timm.utils import accuracy
 
-from biapy.utils.misc import MetricLogger, SmoothedValue, all_reduce_mean, to_pytorch_format
+from biapy.utils.misc import (MetricLogger, SmoothedValue, all_reduce_mean, to_pytorch_format, get_autocast_dtype, 
+    synchronized_time)
 
 def train_one_epoch(cfg, model, model_call_func, loss_function, activations, metric_function, prepare_targets, data_loader, optimizer, 
-    device, loss_scaler, epoch, log_writer=None, lr_scheduler=None, start_steps=0, verbose=False):
+    device, loss_scaler, epoch, log_writer=None, lr_scheduler=None, start_steps=0, verbose=False, batch_augmentor=None):
 
     model.train(True)
 
@@ -18,6 +19,9 @@ def train_one_epoch(cfg, model, model_call_func, loss_function, activations, met
 
     header = 'Epoch: [{}]'.format(epoch+1)
     print_freq = 10
+    amp_dtype = get_autocast_dtype(cfg.TRAIN.PRECISION)
+    # Non finite losses are tracked in the device so there is no need to synchronize on each step
+    non_finite_loss = torch.zeros((), dtype=torch.bool, device=device)
 
     optimizer.zero_grad()
                         
@@ -30,39 +34,37 @@ def train_one_epoch(cfg, model, model_call_func, loss_function, activations, met
 
         it = start_steps + step  # global training iteration
 
+        # Apply data augmentation to the whole batch in the device
+        if batch_augmentor is not None:
+            batch, targets = batch_augmentor(batch.to(device, non_blocking=True), targets.to(device, non_blocking=True))
+
         # Gather inputs
         targets = prepare_targets(targets, batch)
 
         # Pass the images through the model
-        # TODO: control autocast and mixed precision
-        with torch.cuda.amp.autocast(enabled=False):
+        if verbose: start = synchronized_time(device)
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
             outputs = activations(model_call_func(batch, is_train=True), training=True)
             loss = loss_function(outputs, targets)
+        if verbose: metric_logger.update(forward_time=synchronized_time(device)-start)
 
-        loss_value = loss.item()
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
+        non_finite_loss |= ~torch.isfinite(loss.detach())
 
         # Calculate the metrics
         metric_function(outputs, targets, metric_logger)
 
-        # Forward pass scaling the loss
-        loss /= cfg.TRAIN.ACCUM_ITER
-        if (step + 1) % cfg.TRAIN.ACCUM_ITER == 0:
-            loss.backward()
-            optimizer.step() #update weight        
+        # Backward pass scaling the loss
+        if verbose: start = synchronized_time(device)
+        update_grad = (step + 1) % cfg.TRAIN.ACCUM_ITER == 0
+        loss_scaler(loss / cfg.TRAIN.ACCUM_ITER, optimizer, parameters=model.parameters(), update_grad=update_grad)
+        if update_grad:
             optimizer.zero_grad()
             if lr_scheduler is not None and cfg.TRAIN.LR_SCHEDULER.NAME == 'onecycle':
                 lr_scheduler.step() 
+        if verbose: metric_logger.update(backward_time=synchronized_time(device)-start)
 
-        if device.type != 'cpu':
-            torch.cuda.synchronize()
-
-        # Update loss in loggers
-        metric_logger.update(loss=loss_value)
-        loss_value_reduce = all_reduce_mean(loss_value)
-        if log_writer is not None: log_writer.update(loss=loss_value_reduce, head="loss")
+        # Update loss in loggers. The value is kept in the device until it is printed
+        metric_logger.meters['loss'].update(loss.detach())
 
         # Update lr in loggers
         max_lr = 0.
@@ -71,7 +73,17 @@ def train_one_epoch(cfg, model, model_call_func, loss_function, activations, met
         if step == 0:
             metric_logger.add_meter('lr', SmoothedValue(window_size=1, fmt='{value:.6f}'))
         metric_logger.update(lr=max_lr)
-        if log_writer is not None: log_writer.update(lr=max_lr, head="opt")
+
+        # Synchronize with the device only when the stats are going to be printed
+        if step % print_freq == 0 or step == len(data_loader) - 1:
+            if non_finite_loss.item():
+                print("Loss is {}, stopping training".format(metric_logger.meters['loss'].value))
+                sys.exit(1)
+            # All the ranks need to take part in the reduction, even if only the main one logs it
+            loss_value_reduce = all_reduce_mean(metric_logger.meters['loss'].value)
+            if log_writer is not None: 
+                log_writer.update(loss=loss_value_reduce, head="loss")
+                log_writer.update(lr=max_lr, head="opt")
 
     # Gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -90,6 +102,8 @@ def evaluate(cfg, model, model_call_func, loss_function, activations, metric_fun
 
     # Switch to evaluation mode
     model.eval()
+    amp_dtype = get_autocast_dtype(cfg.TRAIN.PRECISION)
+    device = next(model.parameters()).device
 
     for batch in metric_logger.log_every(data_loader, 10, header):
         # Gather inputs
@@ -98,15 +112,14 @@ def evaluate(cfg, model, model_call_func, loss_function, activations, metric_fun
         targets = prepare_targets(targets, images)
 
         # Pass the images through the model
-        # TODO: control autocast and mixed precision
-        with torch.cuda.amp.autocast(enabled=False):  
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
             outputs = activations(model_call_func(images, is_train=True), training=True)
             loss = loss_function(outputs, targets)
         
         # Calculate the metrics
         metric_function(outputs, targets, metric_logger)
     
-        metric_logger.update(loss=loss.item())
+        metric_logger.meters['loss'].update(loss.detach())
 
     # Gather the stats from all processes
     metric_logger.synchronize_between_processes()
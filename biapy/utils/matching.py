@@ -36,6 +36,8 @@ import numpy as np
 
 from tqdm import tqdm
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
 from collections import namedtuple
 import pandas as pd
 import networkx as nx
@@ -75,12 +77,44 @@ def _check_label_array(y, name=None, check_sequential=False):
     return True
 
 
-def label_overlap(x, y, check=True):
+overlap_engines = dict()
+
+def label_overlap(x, y, check=True, engine='bincount', chunk_size=None):
+    """Build the contingency table between the labels of ``x`` and ``y``.
+
+    Parameters
+    ----------
+    x : ndarray
+        Label image (integer valued). 
+
+    y : ndarray
+        Label image (integer valued) with the same shape as ``x``. 
+
+    check : bool, optional
+        Whether to check that ``x`` and ``y`` are sequential label images of the same shape.
+
+    engine : str, optional
+        Engine used to count the overlaps. Options: ``'bincount'`` (vectorized) and ``'loop'`` (voxel by voxel). 
+
+    chunk_size : int, optional
+        Number of slices along the first axis that are processed at once by the ``'bincount'`` engine. Set it
+        to bound the memory used by the raveled label pairs in big volumes. ``None`` or a value lower than 1 process 
+        the whole image at once.
+
+    Returns
+    -------
+    overlap : 2D array
+        Overlap table of shape ``(1+x.max(), 1+y.max())``. ``overlap[i,j]`` is the number of voxels 
+        labeled ``i`` in ``x`` and ``j`` in ``y``.
+    """
     if check:
         _check_label_array(x,'x',True)
         _check_label_array(y,'y',True)
         x.shape == y.shape or _raise(ValueError("x and y must have the same shape"))
-    return _label_overlap(x, y)
+    engine in overlap_engines or _raise(ValueError("Overlap engine '%s' not supported." % engine))
+    if engine == 'loop':
+        return _label_overlap(x, y)
+    return overlap_engines[engine](x, y, chunk_size=chunk_size)
 
 def _label_overlap(x, y):
     x = x.ravel()
@@ -90,6 +124,76 @@ def _label_overlap(x, y):
         overlap[x[i],y[i]] += 1
     return overlap
 
+overlap_engines['loop'] = _label_overlap
+
+def _label_overlap_bincount(x, y, chunk_size=None):
+    """Vectorized version of :func:`_label_overlap`. Each label pair ``(i,j)`` is encoded as ``i*(1+y.max())+j``
+    so the whole table is filled with one ``np.bincount`` call per chunk of slices."""
+    n_x, n_y = 1+int(x.max()), 1+int(y.max())
+    n_bins = n_x*n_y
+    overlap = np.zeros(n_bins, dtype=np.uint)
+    if x.ndim == 0 or x.size == 0:
+        return overlap.reshape(n_x, n_y)
+    if chunk_size is None or chunk_size < 1:
+        chunk_size = x.shape[0]
+
+    for i in range(0, x.shape[0], chunk_size):
+        pairs = np.asarray(x[i:i+chunk_size]).ravel().astype(np.int64)*n_y
+        pairs += np.asarray(y[i:i+chunk_size]).ravel()
+        if pairs.size >= n_bins:
+            overlap += np.bincount(pairs, minlength=n_bins).astype(np.uint)
+        else:
+            # Fewer voxels than bins: avoid allocating the whole table for this chunk
+            pairs, counts = np.unique(pairs, return_counts=True)
+            overlap[pairs] += counts.astype(np.uint)
+    return overlap.reshape(n_x, n_y)
+
+overlap_engines['bincount'] = _label_overlap_bincount
+
+def label_overlap_sparse(x, y, chunk_size=None):
+    """Sparse version of :func:`label_overlap`. Only the label pairs that share at least one voxel are stored, so 
+    the memory needed does not grow with ``x.max()*y.max()``.
+
+    Parameters
+    ----------
+    x : ndarray
+        Label image (integer valued). 
+
+    y : ndarray
+        Label image (integer valued) with the same shape as ``x``. 
+
+    chunk_size : int, optional
+        Number of slices along the first axis that are processed at once. ``None`` or a value lower than 1 process 
+        the whole image at once.
+
+    Returns
+    -------
+    rows : 1D array
+        Labels of ``x`` of each pair. 
+
+    cols : 1D array
+        Labels of ``y`` of each pair. 
+
+    counts : 1D array
+        Number of voxels labeled ``rows[k]`` in ``x`` and ``cols[k]`` in ``y``.
+    """
+    n_y = 1+int(y.max()) if y.size > 0 else 1
+    if chunk_size is None or chunk_size < 1:
+        chunk_size = max(1, x.shape[0])
+
+    codes, counts = [], []
+    for i in range(0, max(1, x.shape[0]), chunk_size):
+        pairs = x[i:i+chunk_size].ravel().astype(np.int64)*n_y + y[i:i+chunk_size].ravel()
+        c, n = np.unique(pairs, return_counts=True)
+        codes.append(c)
+        counts.append(n)
+    codes, counts = np.concatenate(codes), np.concatenate(counts)
+    if len(codes) > 0 and chunk_size < x.shape[0]:
+        codes, inv = np.unique(codes, return_inverse=True)
+        counts = np.bincount(inv, weights=counts, minlength=len(codes))
+    counts = counts.astype(np.uint)
+    return codes//n_y, codes%n_y, counts
+
 def _safe_divide(x,y, eps=1e-10):
     """computes a safe divide which returns 0 if y is zero"""
     if np.isscalar(x) and np.isscalar(y):
@@ -131,6 +235,56 @@ def intersection_over_pred(overlap):
 matching_criteria['iop'] = intersection_over_pred
 
 
+def _sparse_scores(rows, cols, counts, criterion, n_x, n_y):
+    """Compute ``criterion`` for the label pairs of :func:`label_overlap_sparse`, as the dense criteria do."""
+    counts = counts.astype(np.float64)
+    n_pixels_true = np.bincount(rows, weights=counts, minlength=n_x)
+    n_pixels_pred = np.bincount(cols, weights=counts, minlength=n_y)
+    if criterion == 'iou':
+        den = n_pixels_true[rows] + n_pixels_pred[cols] - counts
+    elif criterion == 'iot':
+        den = n_pixels_true[rows]
+    else:
+        den = n_pixels_pred[cols]
+    return _safe_divide(counts, den)
+
+
+def _sparse_assignment(true_ind, pred_ind, scores, thr, n_true, n_pred, n_matched):
+    """Find the matching between true and pred instances that the dense mode finds, i.e. the one that maximizes the 
+    number of pairs with a score over ``thr`` using the scores of all the matched pairs as tie-breaker, but only with 
+    the pairs ``(true_ind[k], pred_ind[k])`` that overlap. 
+
+    The pairs over ``thr`` that do not share any instance with other pair over ``thr`` (e.g. all of them for IoU over 0.5)
+    are in any optimal matching, so they are matched directly and only the pairs between the rest of the instances are 
+    solved. There, each true instance has also an extra pred instance to be matched with, as if with a zero score pair, 
+    so a full matching always exists."""
+    over = scores >= thr
+    forced = over & (np.bincount(true_ind[over], minlength=n_true)[true_ind] == 1) \
+        & (np.bincount(pred_ind[over], minlength=n_pred)[pred_ind] == 1)
+    m_true, m_pred, m_scores = [true_ind[forced]], [pred_ind[forced]], [scores[forced]]
+
+    free_true, free_pred = np.ones(n_true, dtype=bool), np.ones(n_pred, dtype=bool)
+    free_true[true_ind[forced]], free_pred[pred_ind[forced]] = False, False
+    rest = free_true[true_ind] & free_pred[pred_ind]
+    if np.any(rest):
+        t_ids, t = np.unique(true_ind[rest], return_inverse=True)
+        p_ids, p = np.unique(pred_ind[rest], return_inverse=True)
+        n_t, n_p = len(t_ids), len(p_ids)
+        weights = over[rest] + scores[rest] / (2*n_matched)
+        costs = coo_matrix((np.concatenate([2-weights, np.full(n_t, 2.0)]), 
+            (np.concatenate([t, np.arange(n_t)]), np.concatenate([p, n_p+np.arange(n_t)]))), shape=(n_t, n_p+n_t)).tocsr()
+        r, c = min_weight_full_bipartite_matching(costs)
+        ok = c < n_p
+        r, c = r[ok], c[ok]
+        m_true.append(t_ids[r])
+        m_pred.append(p_ids[c])
+        m_scores.append(np.asarray(coo_matrix((scores[rest], (t, p)), shape=(n_t, n_p)).tocsr()[r, c]).ravel())
+
+    m_true, m_pred, m_scores = np.concatenate(m_true), np.concatenate(m_pred), np.concatenate(m_scores)
+    order = np.argsort(m_true, kind='stable')
+    return m_true[order], m_pred[order], m_scores[order].astype(scores.dtype)
+
+
 def precision(tp,fp,fn):
     return tp/(tp+fp) if tp > 0 else 0
 def recall(tp,fp,fn):
@@ -144,7 +298,8 @@ def f1(tp,fp,fn):
     return (2*tp)/(2*tp+fp+fn) if tp > 0 else 0
 
 
-def matching(y_true, y_pred, thresh=0.5, criterion='iou', report_matches=False):
+def matching(y_true, y_pred, thresh=0.5, criterion='iou', report_matches=False, overlap_engine='bincount', 
+    overlap_chunk_size=None, mode='dense'):
     """Calculate detection/instance segmentation metrics between ground truth and predicted label images.
 
     Currently, the following metrics are implemented:
@@ -172,6 +327,15 @@ def matching(y_true, y_pred, thresh=0.5, criterion='iou', report_matches=False):
         matching criterion (default IoU)
     report_matches: bool
         if True, additionally calculate matched_pairs and matched_scores (note, that this returns even gt-pred pairs whose scores are below  'thresh')
+    overlap_engine: string
+        engine used to build the label overlap table. Options: 'bincount' (default) and 'loop'. See :func:`label_overlap`
+    overlap_chunk_size: int
+        number of slices along the first axis processed at once by the 'bincount' engine (default None, i.e. all at once)
+    mode: string
+        how the instances are matched. Options: 'dense' (default), with a ``n_true x n_pred`` score matrix, and 'sparse', 
+        where only the overlapping pairs are kept and ``overlap_engine`` is ignored. Both solve the same assignment, so they 
+        only differ when several matchings are equally good, but with 'sparse' the matched pairs without overlap are not 
+        reported in matched_pairs
 
     Returns
     -------
@@ -192,6 +356,8 @@ def matching(y_true, y_pred, thresh=0.5, criterion='iou', report_matches=False):
     _check_label_array(y_pred,'y_pred')
     y_true.shape == y_pred.shape or _raise(ValueError("y_true ({y_true.shape}) and y_pred ({y_pred.shape}) have different shapes".format(y_true=y_true, y_pred=y_pred)))
     criterion in matching_criteria or _raise(ValueError("Matching criterion '%s' not supported." % criterion))
+    overlap_engine in overlap_engines or _raise(ValueError("Overlap engine '%s' not supported." % overlap_engine))
+    mode in ['dense', 'sparse'] or _raise(ValueError("Matching mode '%s' not supported." % mode))
     if thresh is None: thresh = 0
     thresh = float(thresh) if np.isscalar(thresh) else map(float,thresh)
 
@@ -201,33 +367,52 @@ def matching(y_true, y_pred, thresh=0.5, criterion='iou', report_matches=False):
     map_rev_true = np.array(map_rev_true)
     map_rev_pred = np.array(map_rev_pred)
 
-    overlap = label_overlap(y_true, y_pred, check=False)
-    scores = matching_criteria[criterion](overlap)
-    assert 0 <= np.min(scores) <= np.max(scores) <= 1
+    if mode == 'dense':
+        overlap = label_overlap(y_true, y_pred, check=False, engine=overlap_engine, chunk_size=overlap_chunk_size)
+        scores = matching_criteria[criterion](overlap)
+        assert 0 <= np.min(scores) <= np.max(scores) <= 1
 
-    # ignoring background
-    scores = scores[1:,1:]
-    n_true, n_pred = scores.shape
+        # ignoring background
+        scores = scores[1:,1:]
+        n_true, n_pred = scores.shape
+    else:
+        n_true, n_pred = len(map_rev_true)-1, len(map_rev_pred)-1
+        rows, cols, counts = label_overlap_sparse(y_true, y_pred, chunk_size=overlap_chunk_size)
+        sp_scores = _sparse_scores(rows, cols, counts, criterion, n_true+1, n_pred+1)
+        assert len(sp_scores) == 0 or 0 <= np.min(sp_scores) <= np.max(sp_scores) <= 1
+
+        # ignoring background
+        keep = (rows > 0) & (cols > 0) & (sp_scores > 0)
+        rows, cols, sp_scores = rows[keep]-1, cols[keep]-1, sp_scores[keep]
+        del counts, keep
     n_matched = min(n_true, n_pred)
 
     def _single(thr):
-        not_trivial = n_matched > 0 and np.any(scores >= thr)
-        if not_trivial:
-            # compute optimal matching with scores as tie-breaker
-            costs = -(scores >= thr).astype(float) - scores / (2*n_matched)
-            true_ind, pred_ind = linear_sum_assignment(costs)
-            assert n_matched == len(true_ind) == len(pred_ind)
-            match_ok = scores[true_ind,pred_ind] >= thr
-            tp = np.count_nonzero(match_ok)
+        if mode == 'dense':
+            not_trivial = n_matched > 0 and np.any(scores >= thr)
+            if not_trivial:
+                # compute optimal matching with scores as tie-breaker
+                costs = -(scores >= thr).astype(float) - scores / (2*n_matched)
+                true_ind, pred_ind = linear_sum_assignment(costs)
+                assert n_matched == len(true_ind) == len(pred_ind)
+                matched_scores = scores[true_ind,pred_ind]
+                match_ok = matched_scores >= thr
         else:
-            tp = 0
+            # compare in the dtype of the scores, as the dense mode does
+            thr_scores = sp_scores.dtype.type(thr)
+            not_trivial = n_matched > 0 and np.any(sp_scores >= thr_scores)
+            if not_trivial:
+                true_ind, pred_ind, matched_scores = _sparse_assignment(rows, cols, sp_scores, thr_scores, n_true, 
+                    n_pred, n_matched)
+                match_ok = matched_scores >= thr_scores
+        tp = np.count_nonzero(match_ok) if not_trivial else 0
         fp = n_pred - tp
         fn = n_true - tp
         # assert tp+fp == n_pred
         # assert tp+fn == n_true
 
         # the score sum over all matched objects (tp)
-        sum_matched_score = np.sum(scores[true_ind,pred_ind][match_ok]) if not_trivial else 0.0
+        sum_matched_score = np.sum(matched_scores[match_ok]) if not_trivial else 0.0
 
         # the score average over all matched objects (tp)
         mean_matched_score = _safe_divide(sum_matched_score, tp)
@@ -256,7 +441,7 @@ def matching(y_true, y_pred, thresh=0.5, criterion='iou', report_matches=False):
                 stats_dict.update (
                     # int() to be json serializable
                     matched_pairs  = tuple((int(map_rev_true[i]),int(map_rev_pred[j])) for i,j in zip(1+true_ind,1+pred_ind)),
-                    matched_scores = tuple(scores[true_ind,pred_ind]),
+                    matched_scores = tuple(matched_scores),
                     matched_tps    = tuple(map(int,np.flatnonzero(match_ok))),
                     pred_ids       = tuple(map_rev_pred),        
                     gt_ids         = tuple(map_rev_true),
@@ -241,22 +241,34 @@ def time_text(t):
     else:
         return '{:.1f}s'.format(t)
 
+def get_autocast_dtype(precision):
+    """Data type to be used in ``torch.autocast`` for the given precision (``TRAIN.PRECISION``). ``None`` means that 
+    autocast must be disabled."""
+    return {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(precision, None)
+
+def synchronized_time(device):
+    """Current time waiting first for the kernels queued in the device to finish, so it can be used to time each step."""
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return time.perf_counter()
+
 class NativeScalerWithGradNormCount:
     state_dict_key = "amp_scaler"
 
-    def __init__(self):
-        self._scaler = torch.cuda.amp.GradScaler()
+    def __init__(self, enabled=True):
+        # Loss scaling is only needed with float16 precision. If disabled the scaler just runs the backward and step
+        self._scaler = torch.cuda.amp.GradScaler(enabled=enabled and torch.cuda.is_available())
 
     def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True):
         self._scaler.scale(loss).backward(create_graph=create_graph)
         if update_grad:
+            # The gradient norm is only computed when clipping, as it needs to go through all the gradients 
             if clip_grad is not None:
                 assert parameters is not None
                 self._scaler.unscale_(optimizer)  # unscale the gradients of optimizer's assigned params in-place
                 norm = torch.nn.utils.clip_grad_norm_(parameters, clip_grad)
             else:
-                self._scaler.unscale_(optimizer)
-                norm = get_grad_norm_(parameters)
+                norm = None
             self._scaler.step(optimizer)
             self._scaler.update()
         else:
@@ -304,16 +316,33 @@ class SmoothedValue(object):
         self.total = 0.0
         self.count = 0
         self.fmt = fmt
+        self.pending = []
 
     def update(self, value, n=1):
+        # Tensors are kept in their device and only copied to the host when the value is requested, 
+        # so the update does not wait for the device 
+        if isinstance(value, torch.Tensor):
+            self.pending.append((value.detach(), n))
+            return
         self.deque.append(value)
         self.count += n
         self.total += value * n
 
+    def sync(self):
+        """Copy the pending tensor values to the host in a single transfer."""
+        if len(self.pending) == 0:
+            return
+        values = torch.stack([v.float().reshape(()) for v, _ in self.pending]).tolist()
+        ns = [n for _, n in self.pending]
+        self.pending = []
+        for v, n in zip(values, ns):
+            self.update(v, n)
+
     def synchronize_between_processes(self):
         """
         Warning: does not synchronize the deque!
         """
+        self.sync()
         if not is_dist_avail_and_initialized():
             return
         t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
@@ -325,24 +354,29 @@ class SmoothedValue(object):
 
     @property
     def median(self):
+        self.sync()
         d = torch.tensor(list(self.deque))
         return d.median().item()
 
     @property
     def avg(self):
+        self.sync()
         d = torch.tensor(list(self.deque), dtype=torch.float32)
         return d.mean().item()
 
     @property
     def global_avg(self):
+        self.sync()
         return self.total / self.count
 
     @property
     def max(self):
+        self.sync()
         return max(self.deque)
 
     @property
     def value(self):
+        self.sync()
         return self.deque[-1]
 
     def __str__(self):
@@ -364,9 +398,7 @@ class MetricLogger(object):
         for k, v in kwargs.items():
             if v is None:
                 continue
-            if isinstance(v, torch.Tensor):
-                v = v.item()
-            assert isinstance(v, (float, int))
+            assert isinstance(v, (float, int, torch.Tensor))
             self.meters[k].update(v)
 
     def __getattr__(self, attr):
@@ -399,19 +431,22 @@ class MetricLogger(object):
         start_time = time.time()
         end = time.time()
         iter_time = SmoothedValue(fmt='{avg:.4f}')
+        data_time = SmoothedValue(fmt='{avg:.4f}')
         space_fmt = ':' + str(len(str(len(iterable)))) + 'd'
         log_msg = [
             header,
             '[{0' + space_fmt + '}/{1}]',
             'eta: {eta}',
             '{meters}',
-            'iter-time: {time}'
+            'iter-time: {time}',
+            'data-time: {data}'
         ]
         if torch.cuda.is_available() and self.verbose:
             log_msg.append('max mem: {memory:.0f}MB')
         log_msg = self.delimiter.join(log_msg)
         MB = 1024.0 * 1024.0
         for obj in iterable:
+            data_time.update(time.time() - end)
             yield obj
             iter_time.update(time.time() - end)
             if i % print_freq == 0 or i == len(iterable) - 1:
@@ -421,13 +456,13 @@ class MetricLogger(object):
                     print(log_msg.format(
                         i, len(iterable), eta=eta_string,
                         meters=str(self),
-                        time=str(iter_time),
+                        time=str(iter_time), data=str(data_time),
                         memory=torch.cuda.max_memory_allocated() / MB))
                 else:
                     print(log_msg.format(
                         i, len(iterable), eta=eta_string,
                         meters=str(self),
-                        time=str(iter_time)))
+                        time=str(iter_time), data=str(data_time)))
             i += 1
             end = time.time()
         total_time = time.time() - start_time
@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+parser = argparse.ArgumentParser(description="Compare the samples per second of the data augmentation applied sample by sample "
+                                 "with imgaug vs. applied to the whole batch with torch ('AUGMENTOR.BACKEND')",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-code_dir", "--code_dir", default=os.path.join(os.path.dirname(__file__), "..", "..", ".."),
+                    help="BiaPy code dir")
+parser.add_argument("-shape_2d", "--shape_2d", type=int, nargs=2, default=[256, 256], help="Shape of the 2D samples (y,x)")
+parser.add_argument("-shape_3d", "--shape_3d", type=int, nargs=3, default=[32, 128, 128], help="Shape of the 3D samples (z,y,x)")
+parser.add_argument("-batch_size", "--batch_size", type=int, default=16, help="Batch size")
+parser.add_argument("-batches", "--batches", type=int, default=10, help="Number of batches to measure")
+parser.add_argument("-device", "--device", default="cuda" if torch.cuda.is_available() else "cpu",
+                    help="Device where the torch batch augmentation is run")
+args = vars(parser.parse_args())
+
+sys.path.insert(0, args['code_dir'])
+from biapy.data.generators.pair_data_2D_generator import Pair2DImageDataGenerator
+from biapy.data.generators.pair_data_3D_generator import Pair3DImageDataGenerator
+from biapy.data.generators.torch_augmentors import TorchBatchAugmentor, BATCH_DA_OPTIONS
+
+# Transformations available in both backends. Gamma contrast and gaussian noise are left out as imgaug fails with the
+# negative values that the spline interpolation of the random rotations creates in the random images used and with the
+# float64 images returned by the noise
+da_options = dict(da_prob=0.5, rotation90=True, rand_rot=True, rnd_rot_range=(-180,180), zoom=True, zoom_range=(0.8,1.2),
+    shift=True, shift_range=(0.1,0.2), vflip=True, hflip=True, elastic=True, e_alpha=(12,16), e_sigma=4, g_blur=True,
+    g_sigma=(1.0,2.0), brightness=True, brightness_factor=(-0.1,0.1),
+    brightness_mode='3D', contrast=True, contrast_factor=(-0.1,0.1), contrast_mode='3D', dropout=True, drop_range=(0,0.2))
+
+def create_generator(ndim, shape, da):
+    rng = np.random.default_rng(0)
+    n = args['batch_size']*args['batches']
+    X = rng.integers(0, 255, (n,)+shape+(1,), dtype=np.uint8)
+    Y = (rng.random((n,)+shape+(1,)) > 0.5).astype(np.uint8)
+    f_name = Pair2DImageDataGenerator if ndim == 2 else Pair3DImageDataGenerator
+    dic = dict(ndim=ndim, X=X, Y=Y, data_mode="in_memory", da=da, shape=shape+(1,), resolution=(1,)*ndim,
+        norm_dict={'type': 'div', 'mask_norm': 'as_mask', 'enable': True, 'application_mode': 'image'}, **da_options)
+    if ndim == 3:
+        dic['zflip'] = True
+    return f_name(**dic)
+
+def collate(generator, batch_ids):
+    imgs, masks = zip(*[generator[i] for i in batch_ids])
+    return torch.stack(imgs), torch.stack(masks)
+
+def synchronize():
+    if args['device'].startswith('cuda'):
+        torch.cuda.synchronize()
+
+device = torch.device(args['device'])
+print("Batch size: {}, batches: {}, device of the torch backend: {}".format(args['batch_size'], args['batches'], device))
+print("Transformations: {}".format([k for k in BATCH_DA_OPTIONS if da_options.get(k, False)]))
+for ndim, shape in [(2, tuple(args['shape_2d'])), (3, tuple(args['shape_3d']))]:
+    batches = [list(range(i*args['batch_size'], (i+1)*args['batch_size'])) for i in range(args['batches'])]
+    n = args['batch_size']*args['batches']
+
+    # Sample by sample with imgaug
+    generator = create_generator(ndim, shape, da=True)
+    t = time.perf_counter()
+    for b in batches:
+        img, mask = collate(generator, b)
+        img, mask = img.to(device), mask.to(device)
+    synchronize()
+    t_imgaug = time.perf_counter()-t
+
+    # Whole batch with torch
+    generator = create_generator(ndim, shape, da=False)
+    augmentor = TorchBatchAugmentor(ndim, zflip=ndim == 3, mask_type='as_mask', channel_info=generator.channel_info,
+        **da_options)
+    augmentor(*collate(generator, batches[0])) # Warm up
+    t = time.perf_counter()
+    for b in batches:
+        img, mask = collate(generator, b)
+        img, mask = augmentor(img.to(device), mask.to(device))
+    synchronize()
+    t_torch = time.perf_counter()-t
+
+    print("{}D {:>16}  imgaug: {:>8.1f} samples/s  torch: {:>8.1f} samples/s  speed-up: {:>5.1f}x".format(
+        ndim, str(shape), n/t_imgaug, n/t_torch, t_imgaug/t_torch))
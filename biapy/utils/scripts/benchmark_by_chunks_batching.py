@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+parser = argparse.ArgumentParser(description="Measure the throughput (patches/s) of the TEST.BY_CHUNKS inference with different "
+                                 "batch sizes using a 3D U-Net on CPU",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-code_dir", "--code_dir", default=os.path.join(os.path.dirname(__file__), "..", "..", ".."),
+                    help="BiaPy code dir")
+parser.add_argument("-patch", "--patch_size", type=int, nargs=4, default=[16, 64, 64, 1], help="Patch shape (z,y,x,c)")
+parser.add_argument("-fmaps", "--feature_maps", type=int, nargs='+', default=[16, 32, 64, 128], help="U-Net feature maps")
+parser.add_argument("-max_bs", "--max_batch_size", type=int, default=8, help="Batch sizes from 1 to this value are measured")
+parser.add_argument("-n", "--num_patches", type=int, default=32, help="Number of patches processed in each run")
+parser.add_argument("-threads", "--threads", type=int, default=-1, help="Torch CPU threads. -1 to leave torch default")
+args = vars(parser.parse_args())
+
+sys.path.insert(0, args['code_dir'])
+from biapy.models.unet import U_Net
+from biapy.utils.misc import to_pytorch_format, to_numpy_format
+
+if args['threads'] > 0:
+    torch.set_num_threads(args['threads'])
+
+device = torch.device("cpu")
+axis_order = (0, 4, 1, 2, 3)
+axis_order_back = (0, 2, 3, 4, 1)
+patch_shape = tuple(args['patch_size'])
+model = U_Net(image_shape=patch_shape, activation="elu", feature_maps=args['feature_maps'], drop_values=[0]*len(args['feature_maps']),
+    z_down=[1]*(len(args['feature_maps'])-1))
+model.eval()
+
+patches = [np.random.rand(1, *patch_shape).astype(np.float32) for _ in range(args['num_patches'])]
+
+def run(batch_size):
+    """Same gather -> predict -> scatter scheme used in ``process_sample_by_chunks``."""
+    out = []
+    with torch.no_grad():
+        for i in range(0, len(patches), batch_size):
+            p = model(to_pytorch_format(np.concatenate(patches[i:i+batch_size]), axis_order, device))
+            out += list(to_numpy_format(p, axis_order_back))
+    return out
+
+# Warm up
+run(1)
+
+print("Patch: {}, patches: {}, torch threads: {}".format(patch_shape, len(patches), torch.get_num_threads()))
+ref = None
+for bs in range(1, args['max_batch_size']+1):
+    t = time.perf_counter()
+    run(bs)
+    t = time.perf_counter()-t
+    if ref is None:
+        ref = t
+    print("batch_size {:>3}: {:>8.2f} patches/s  speed-up: {:>5.2f}x".format(bs, len(patches)/t, ref/t))
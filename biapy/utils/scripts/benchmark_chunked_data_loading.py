@@ -0,0 +1,87 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import h5py
+import zarr
+import torch
+
+parser = argparse.ArgumentParser(description="Measure the samples/s of reading training patches from Zarr/H5 files opening "
+                                 "the files on each sample vs. keeping them opened in a pool",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-code_dir", "--code_dir", default=os.path.join(os.path.dirname(__file__), "..", "..", ".."),
+                    help="BiaPy code dir")
+parser.add_argument("-format", "--format", default="h5", choices=["h5", "zarr"], help="Format of the synthetic files")
+parser.add_argument("-files", "--num_files", type=int, default=4, help="Number of synthetic files")
+parser.add_argument("-shape", "--shape", type=int, nargs=3, default=[64, 256, 256], help="Shape of each file (z,y,x)")
+parser.add_argument("-patch", "--patch_size", type=int, nargs=3, default=[16, 64, 64], help="Patch shape (z,y,x)")
+parser.add_argument("-chunks", "--chunks", type=int, nargs=3, default=[16, 128, 128], help="Chunk shape of the files (z,y,x)")
+parser.add_argument("-cache_mb", "--cache_mb", type=int, default=64, help="Chunk cache size used in the last run")
+parser.add_argument("-workers", "--workers", type=int, default=2, help="DataLoader workers")
+parser.add_argument("-epochs", "--epochs", type=int, default=2, help="Epochs measured")
+parser.add_argument("-out_dir", "--out_dir", default=None, help="Where to create the synthetic files. A temporal dir by default")
+args = vars(parser.parse_args())
+
+sys.path.insert(0, args['code_dir'])
+from biapy.utils.util import read_chunked_data, ChunkedDataPool
+from biapy.data.data_3D_manipulation import load_3D_efficient_files
+from biapy.data.generators import chunked_data_worker_init_fn
+
+class PatchDataset(torch.utils.data.Dataset):
+    """Reads patches as in the 'chunked_data' mode of the generators."""
+    def __init__(self, info, pool=None):
+        self.info = info
+        self.chunked_data_pool = pool
+
+    def __len__(self):
+        return len(self.info)
+
+    def __getitem__(self, idx):
+        slices = tuple(slice(start, end) for start, end in self.info[idx]['patch_coords'])
+        if self.chunked_data_pool is None:
+            fid, data = read_chunked_data(self.info[idx]['filepath'])
+            img = np.array(data[slices])
+            if isinstance(fid, h5py.File):
+                fid.close()
+        else:
+            img = np.array(self.chunked_data_pool.get(self.info[idx]['filepath'])[slices])
+        return img
+
+out_dir = tempfile.mkdtemp() if args['out_dir'] is None else args['out_dir']
+os.makedirs(out_dir, exist_ok=True)
+files = []
+for i in range(args['num_files']):
+    data = np.random.randint(0, 255, args['shape']+[1], dtype=np.uint8)
+    if args['format'] == "h5":
+        f = os.path.join(out_dir, f"sample{i}.h5")
+        with h5py.File(f, 'w') as fid:
+            fid.create_dataset("data", data=data, chunks=tuple(args['chunks'])+(1,), compression="gzip")
+    else:
+        f = os.path.join(out_dir, f"sample{i}.zarr")
+        fid = zarr.open_group(f, mode='w')
+        fid.create_dataset("data", data=data, chunks=tuple(args['chunks'])+(1,))
+    files.append(f)
+
+info, _ = load_3D_efficient_files(files, "ZYXC", tuple(args['patch_size'])+(1,), (0,0,0), (0,0,0))
+print("Files: {}, patches per epoch: {}, workers: {}".format(len(files), len(info), args['workers']))
+
+runs = [("open per sample", None), ("pool", ChunkedDataPool()),
+    ("pool + {}MB chunk cache".format(args['cache_mb']), ChunkedDataPool(chunk_cache_mb=args['cache_mb']))]
+ref = None
+for name, pool in runs:
+    loader = torch.utils.data.DataLoader(PatchDataset(info, pool), batch_size=1, shuffle=True, num_workers=args['workers'],
+        worker_init_fn=chunked_data_worker_init_fn if args['workers'] > 0 else None, persistent_workers=args['workers'] > 0)
+    t = time.perf_counter()
+    for _ in range(args['epochs']):
+        for _ in loader:
+            pass
+    t = time.perf_counter()-t
+    if ref is None:
+        ref = t
+    print("{:<28} {:>10.1f} samples/s  speed-up: {:>5.2f}x".format(name, len(info)*args['epochs']/t, ref/t))
+
+if args['out_dir'] is None:
+    shutil.rmtree(out_dir)
@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+parser = argparse.ArgumentParser(description="Measure the time needed to get the first batch of each epoch (epoch startup latency) "
+                                 "with the DataLoader modes available for training",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-code_dir", "--code_dir", default=os.path.join(os.path.dirname(__file__), "..", "..", ".."),
+                    help="BiaPy code dir")
+parser.add_argument("-samples", "--num_samples", type=int, default=512, help="Number of in-memory samples")
+parser.add_argument("-shape", "--shape", type=int, nargs=3, default=[256, 256, 1], help="Shape of each sample (y,x,c)")
+parser.add_argument("-bs", "--batch_size", type=int, default=8, help="Batch size")
+parser.add_argument("-workers", "--workers", type=int, default=4, help="DataLoader workers")
+parser.add_argument("-prefetch", "--prefetch_factor", type=int, default=2, help="Batches loaded in advance by each worker")
+parser.add_argument("-epochs", "--epochs", type=int, default=4, help="Epochs measured")
+parser.add_argument("-start_method", "--start_method", default="fork", choices=["fork", "spawn", "forkserver"],
+                    help="Multiprocessing start method of the workers. With 'spawn' the dataset is pickled to each worker")
+args = vars(parser.parse_args())
+
+sys.path.insert(0, args['code_dir'])
+from biapy.data.generators import build_dataloader, MultiEpochsDataLoader
+
+class InMemoryDataset(torch.utils.data.Dataset):
+    """In-memory samples normalized on each access, as in the 'in_memory' mode of the generators."""
+    def __init__(self, X):
+        self.X = X
+
+    def __len__(self):
+        return len(self.X)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy((self.X[idx]/255).astype(np.float32))
+
+def run(X, name, loader_type, persistent_workers):
+    dataset = InMemoryDataset(X)
+    sampler = torch.utils.data.DistributedSampler(dataset, num_replicas=1, rank=0, shuffle=True)
+    loader = build_dataloader(dataset, sampler, args['batch_size'], args['workers'], pin_memory=False,
+        loader_type=loader_type, persistent_workers=persistent_workers, prefetch_factor=args['prefetch_factor'])
+    if args['workers'] > 0:
+        loader.multiprocessing_context = args['start_method']
+    startups, totals = [], []
+    for epoch in range(args['epochs']):
+        if isinstance(loader, MultiEpochsDataLoader):
+            loader.set_epoch(epoch)
+        else:
+            sampler.set_epoch(epoch)
+        t = time.perf_counter()
+        for i, _ in enumerate(loader):
+            if i == 0:
+                startups.append(time.perf_counter()-t)
+            # Simulate the training step
+            time.sleep(0.002)
+        totals.append(time.perf_counter()-t)
+    del loader
+    print("{:<22} first epoch startup: {:>7.3f}s  next epochs startup: {:>7.3f}s  mean epoch time: {:>7.3f}s".format(
+        name, startups[0], np.mean(startups[1:]) if len(startups) > 1 else float('nan'), np.mean(totals)))
+
+if __name__ == '__main__':
+    X = np.random.randint(0, 255, (args['num_samples'],)+tuple(args['shape']), dtype=np.uint8)
+    print("Data: {} ({:.1f} MB), batch size: {}, workers: {}, start method: {}".format(X.shape, X.nbytes/1024**2,
+        args['batch_size'], args['workers'], args['start_method']))
+
+    run(X, "default", "default", False)
+    run(X, "persistent workers", "default", True)
+    run(X, "multi_epochs", "multi_epochs", False)
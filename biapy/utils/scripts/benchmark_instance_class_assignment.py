@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from skimage.segmentation import watershed
+
+parser = argparse.ArgumentParser(description="Compare the time needed to classify each instance with the majority class of its "
+                                 "pixels looping over the instances vs. the vectorized histogram",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-code_dir", "--code_dir", default=os.path.join(os.path.dirname(__file__), "..", "..", ".."),
+                    help="BiaPy code dir")
+parser.add_argument("-shape", "--shape", type=int, nargs=3, default=[64, 256, 256], help="Shape of the volume (z,y,x)")
+parser.add_argument("-instances", "--instances", type=int, nargs='+', default=[100, 1000, 10000],
+                    help="Number of instances of each run")
+parser.add_argument("-classes", "--classes", type=int, default=4, help="Number of classes (background included)")
+parser.add_argument("-max_loop_instances", "--max_loop_instances", type=int, default=2000,
+                    help="Skip the loop when there are more instances than this, as it gets too slow")
+args = vars(parser.parse_args())
+
+sys.path.insert(0, args['code_dir'])
+from biapy.data.post_processing.post_processing import assign_instance_classes
+
+def loop_assign_instance_classes(w_pred, class_channel):
+    """Previous implementation of instance_seg_process."""
+    labels = np.unique(w_pred)[1:]
+    new_class_channel = np.zeros(w_pred.shape, dtype=w_pred.dtype)
+    for l in labels:
+        instance_classes, instance_classes_count = np.unique(class_channel[w_pred == l], return_counts=True)
+        if instance_classes[0] == 0:
+            instance_classes = instance_classes[1:]
+            instance_classes_count = instance_classes_count[1:]
+        if len(instance_classes) > 0:
+            label_selected = int(instance_classes[np.argmax(instance_classes_count)])
+        else:
+            label_selected = 1
+        new_class_channel = np.where(w_pred == l, label_selected, new_class_channel)
+    return new_class_channel
+
+rng = np.random.default_rng(0)
+shape = tuple(args['shape'])
+print("Volume shape: {}, classes: {}".format(shape, args['classes']))
+for n in args['instances']:
+    # Instances grown from random seeds over 80% of the volume, the rest is background
+    markers = np.zeros(shape, dtype=np.int32)
+    coords = tuple(rng.integers(0, s, n) for s in shape)
+    markers[coords] = np.arange(1, n+1)
+    w_pred = watershed(np.zeros(shape, dtype=np.uint8), markers, mask=rng.random(shape) > 0.2)
+    class_channel = np.expand_dims(rng.integers(0, args['classes'], shape), -1).astype(np.float32)
+    n = len(np.unique(w_pred))-1
+
+    t = time.perf_counter()
+    out = assign_instance_classes(w_pred, class_channel)
+    t_vec = time.perf_counter()-t
+    if n <= args['max_loop_instances']:
+        t = time.perf_counter()
+        ref = loop_assign_instance_classes(w_pred, class_channel)
+        t_loop = time.perf_counter()-t
+        print("{:>8} instances  loop: {:>9.3f}s  vectorized: {:>7.3f}s  speed-up: {:>8.1f}x  same output: {}".format(
+            n, t_loop, t_vec, t_loop/t_vec, np.array_equal(ref, out)))
+    else:
+        print("{:>8} instances  loop: {:>9}   vectorized: {:>7.3f}s".format(n, "skipped", t_vec))
@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+parser = argparse.ArgumentParser(description="Compare the label overlap engines used by the instance matching on synthetic label volumes",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-code_dir", "--code_dir", default=os.path.join(os.path.dirname(__file__), "..", "..", ".."),
+                    help="BiaPy code dir")
+parser.add_argument("-shape", "--shape", type=int, nargs=3, default=[32, 256, 256], help="Shape of the synthetic volume (z,y,x)")
+parser.add_argument("-cell", "--cell_size", type=int, default=16, help="Size of each synthetic instance (in voxels per axis)")
+parser.add_argument("-chunk", "--chunk_size", type=int, default=8, help="Slices processed at once in the chunked run")
+parser.add_argument("-reps", "--repetitions", type=int, default=3, help="Times each engine is run. The best time is reported")
+parser.add_argument("--skip_loop", help="do not run the voxel by voxel engine (it is very slow on big volumes)", action="store_true")
+args = vars(parser.parse_args())
+
+sys.path.insert(0, args['code_dir'])
+from biapy.utils.matching import label_overlap
+
+def synthetic_labels(shape, cell_size, shift):
+    """Grid of box shaped instances. ``shift`` displaces the grid to emulate a prediction."""
+    grid = np.indices(shape, dtype=np.int64)
+    n_cells = [int(np.ceil((s+shift)/cell_size)) for s in shape]
+    labels = np.zeros(shape, dtype=np.int64)
+    for i in range(len(shape)):
+        labels = labels*n_cells[i] + (grid[i]+shift)//cell_size
+    labels += 1
+    # Leave some background
+    labels[(grid[-1]+shift)%cell_size == 0] = 0
+    _, labels = np.unique(labels, return_inverse=True)
+    return labels.reshape(shape).astype(np.uint32)
+
+def bench(f, reps):
+    best, out = None, None
+    for _ in range(reps):
+        t = time.perf_counter()
+        out = f()
+        t = time.perf_counter()-t
+        best = t if best is None else min(best, t)
+    return best, out
+
+shape = tuple(args['shape'])
+y_true = synthetic_labels(shape, args['cell_size'], 0)
+y_pred = synthetic_labels(shape, args['cell_size'], args['cell_size']//3)
+print("Volume: {} ({} voxels), GT instances: {}, predicted instances: {}".format(shape, y_true.size, y_true.max(), y_pred.max()))
+
+runs = [("bincount", None), ("bincount", args['chunk_size'])]
+if not args['skip_loop']:
+    runs = [("loop", None)] + runs
+
+ref = None
+for engine, chunk_size in runs:
+    t, overlap = bench(lambda: label_overlap(y_true, y_pred, check=False, engine=engine, chunk_size=chunk_size),
+        1 if engine == "loop" else args['repetitions'])
+    if ref is None:
+        ref = (t, overlap)
+    name = engine if chunk_size is None else "{} (chunk_size={})".format(engine, chunk_size)
+    print("{:<28} {:>10.4f} s  {:>10.2f} Mvoxel/s  speed-up: {:>8.1f}x  equal: {}".format(name, t, y_true.size/t/1e6,
+        ref[0]/t, np.array_equal(ref[1], overlap)))
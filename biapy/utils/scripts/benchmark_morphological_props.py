@@ -0,0 +1,118 @@
+import os
+import sys
+import math
+import time
+import argparse
+import numpy as np
+from skimage.measure import regionprops_table
+
+parser = argparse.ArgumentParser(description="Compare the time needed to measure and filter instances by their morphological "
+                                 "properties looping over the instances vs. the columnar implementation",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-code_dir", "--code_dir", default=os.path.join(os.path.dirname(__file__), "..", "..", ".."),
+                    help="BiaPy code dir")
+parser.add_argument("-shape", "--shape", type=int, nargs=2, default=[4096, 4096], help="Shape of the 2D label image (y,x)")
+parser.add_argument("-instances", "--instances", type=int, nargs='+', default=[1000, 10000, 100000],
+                    help="Number of instances of each run")
+parser.add_argument("-max_loop_instances", "--max_loop_instances", type=int, default=20000,
+                    help="Skip the loop when there are more instances than this, as it gets too slow")
+args = vars(parser.parse_args())
+
+sys.path.insert(0, args['code_dir'])
+from biapy.data.post_processing.post_processing import measure_morphological_props_and_filter
+
+properties = [['npixels'], ['circularity', 'diameter']]
+prop_values = [[20], [0.6, 5]]
+comp_signs = [['lt'], ['lt', 'ge']]
+
+def loop_measure_and_filter(img, resolution):
+    """Previous implementation of measure_morphological_props_and_filter (2D only)."""
+    label_list, npixels = np.unique(img, return_counts=True)
+    label_list, npixels = label_list[1:], npixels[1:]
+    total_labels = len(label_list)
+    comment = ['none' for i in range(total_labels)]
+    areas = np.zeros(total_labels, dtype=np.uint32)
+    diameters = np.zeros(total_labels, dtype=np.uint32)
+    centers = np.zeros((total_labels, 2), dtype=np.uint16)
+    circularities = np.zeros(total_labels, dtype=np.float32)
+    perimeters = np.zeros(total_labels, dtype=np.uint32)
+    elongations = np.zeros(total_labels, dtype=np.float32)
+
+    props = regionprops_table(img, properties=(['label', 'bbox', 'perimeter']))
+    for k, l in enumerate(props['label']):
+        label_index = np.where(label_list == l)[0]
+        pixels = npixels[label_index]
+        vol = pixels*(resolution[0]+resolution[1])
+        diam = max(props['bbox-2'][k]-props['bbox-0'][k],props['bbox-3'][k]-props['bbox-1'][k])
+        center = [(props['bbox-2'][k]-props['bbox-0'][k])//2, (props['bbox-3'][k]-props['bbox-1'][k])//2]
+        perimeter = props['perimeter'][k]
+        elongations[label_index] = (perimeter*perimeter)/(4 * math.pi * pixels) if pixels > 0 else 0
+        circularities[label_index] = (4 * math.pi * pixels) / (perimeter*perimeter) if perimeter > 0 else 0
+        perimeters[label_index] = perimeter
+        areas[label_index] = vol
+        diameters[label_index] = diam
+        centers[label_index] = center
+
+    conditions = []
+    values = {'circularity': circularities, 'npixels': npixels, 'area': areas, 'diameter': diameters,
+        'perimeter': perimeters, 'elongation': elongations}
+    for i in range(total_labels):
+        conditions.append([])
+        for k, list_of_conditions in enumerate(properties):
+            comps = []
+            for j, prop in enumerate(list_of_conditions):
+                value_to_compare = values[prop][i]
+                if comp_signs[k][j] == "gt":
+                    comps.append(value_to_compare > prop_values[k][j])
+                elif comp_signs[k][j] == "ge":
+                    comps.append(value_to_compare >= prop_values[k][j])
+                elif comp_signs[k][j] == "lt":
+                    comps.append(value_to_compare < prop_values[k][j])
+                elif comp_signs[k][j] == "le":
+                    comps.append(value_to_compare <= prop_values[k][j])
+            conditions[-1].append(all(comps))
+        if any(conditions[-1]):
+            comment[i] = "Removed"
+            img[img==label_list[i]] = 0
+        else:
+            comment[i] = "Correct"
+
+    d_result = {'labels': label_list, 'centers': centers, 'npixels': npixels, 'areas': areas, 'circularities': circularities,
+        'diameters': diameters, 'perimeters': perimeters, 'comment': comment, 'conditions': conditions,
+        'elongations': elongations}
+    return img, d_result
+
+def same_output(ref, out):
+    if not np.array_equal(ref[0], out[0]):
+        return False
+    for k in ref[1]:
+        if isinstance(ref[1][k], list):
+            if ref[1][k] != out[1][k]:
+                return False
+        elif not np.allclose(ref[1][k], out[1][k], rtol=1e-6):
+            return False
+    return True
+
+rng = np.random.default_rng(0)
+shape = tuple(args['shape'])
+print("Image shape: {}, conditions: {} {} {}".format(shape, properties, prop_values, comp_signs))
+for n in args['instances']:
+    # Random rectangles of different sizes, painted in order so some of them overlap
+    img = np.zeros(shape, dtype=np.uint32)
+    y0, x0 = rng.integers(0, shape[0]-1, n), rng.integers(0, shape[1]-1, n)
+    h, w = rng.integers(1, 40, n), rng.integers(1, 40, n)
+    for l in range(n):
+        img[y0[l]:y0[l]+h[l], x0[l]:x0[l]+w[l]] = l+1
+    n = len(np.unique(img))-1
+
+    t = time.perf_counter()
+    out = measure_morphological_props_and_filter(img.copy(), (1,1), True, properties, prop_values, comp_signs)
+    t_vec = time.perf_counter()-t
+    if n <= args['max_loop_instances']:
+        t = time.perf_counter()
+        ref = loop_measure_and_filter(img.copy(), (1,1))
+        t_loop = time.perf_counter()-t
+        print("{:>8} instances  loop: {:>9.3f}s  columnar: {:>7.3f}s  speed-up: {:>8.1f}x  same output: {}".format(
+            n, t_loop, t_vec, t_loop/t_vec, same_output(ref, out)))
+    else:
+        print("{:>8} instances  loop: {:>9}   columnar: {:>7.3f}s".format(n, "skipped", t_vec))
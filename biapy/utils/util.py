@@ -1,5 +1,9 @@
 import os
 import math
+import time
+import atexit
+import threading
+import torch
 import numpy as np
 import random
 import h5py
@@ -12,7 +16,8 @@ from PIL import Image
 from tqdm import tqdm
 from skimage.io import imsave, imread
 from skimage import measure
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from biapy.engine.metrics import jaccard_index_numpy, voc_calculation
 from biapy.utils.misc import is_main_process
@@ -824,9 +829,223 @@ def onehot_encoding_to_img(encoded_image):
     return img
 
 
+def _read_image(path, is_chunked=False):
+    """Read the image stored in ``path`` removing its dimensions of size ``1``."""
+    if path.endswith('.npy'):
+        img = np.load(path)
+    elif path.endswith('.hdf5') or path.endswith('.h5'):
+        with h5py.File(path,'r') as fid:
+            img = np.array(fid[list(fid)[0]])
+    elif is_chunked:
+        _, img = read_chunked_data(path)
+        img = np.array(img)
+    else:
+        img = imread(path)
+    return np.squeeze(img)
+
+def _read_image_header(path, is_chunked=False):
+    """Shape and data type of the image stored in ``path`` read without decoding it. ``None`` if they can not be read."""
+    try:
+        if path.endswith('.npy'):
+            img = np.load(path, mmap_mode='r')
+            return img.shape, img.dtype
+        elif path.endswith('.hdf5') or path.endswith('.h5'):
+            with h5py.File(path,'r') as fid:
+                img = fid[list(fid)[0]]
+                return img.shape, img.dtype
+        elif is_chunked:
+            fid, img = read_chunked_data(path)
+            shape, dtype = img.shape, img.dtype
+            if isinstance(fid, h5py.File):
+                fid.close()
+            return shape, dtype
+        elif path.lower().endswith('.tif') or path.lower().endswith('.tiff'):
+            import tifffile
+            with tifffile.TiffFile(path) as tif:
+                return tif.series[0].shape, tif.series[0].dtype
+    except Exception:
+        pass
+    return None
+
+def _num_crops(shape, crop_shape, overlap, padding):
+    """Number of patches that the crop functions extract from an image of ``shape``."""
+    # 2D crop function takes y overlap from the second position
+    if len(shape) == 3:
+        overlap = (overlap[1], overlap[0])
+    n = 1
+    for i in range(len(shape)-1):
+        ov = 1 if overlap[i] == 0 else 1-overlap[i]
+        n *= math.ceil(shape[i]/int((crop_shape[i]-padding[i]*2)*ov))
+    return n
+
+def _load_images_from_dir(data_dir, ndim, crop, crop_shape, overlap, padding, median_padding, reflect_to_complete_shape, 
+    check_channel, convert_to_rgb, check_drange, preprocess_cfg, is_mask, preprocess_f, num_workers, verbose):
+    """
+    Load the images of a directory for :func:`load_data_from_dir` (``ndim=2``) and :func:`load_3d_images_from_dir` 
+    (``ndim=3``). The images are decoded and cropped in parallel. When possible, their shapes are read first so they are 
+    written directly into the final array, instead of concatenating them at the end, which needs twice the memory. 
+    """
+    if preprocess_f != None and preprocess_cfg == None:
+        raise ValueError("The preprocessing configuration ('preprocess_cfg') is missing.")
+
+    if crop:
+        from biapy.data.data_2D_manipulation import crop_data_with_overlap
+        from biapy.data.data_3D_manipulation import crop_3D_data_with_overlap
+
+    print("Loading data from {}".format(data_dir))
+    ids = sorted(next(os.walk(data_dir))[2])
+    fids = sorted(next(os.walk(data_dir))[1])
+
+    if len(ids) == 0:
+        if len(fids) == 0: # Trying Zarr
+            raise ValueError("No images found in dir {}".format(data_dir))
+        _ids = fids
+    else:
+        _ids = ids
+    is_chunked = len(ids) == 0
+    filenames = list(_ids)
+    paths = [os.path.join(data_dir, id_) for id_ in _ids]
+    if num_workers is None:
+        num_workers = torch.get_num_threads()
+    start_time = time.time()
+
+    def _prepare(img, path):
+        if ndim == 2:
+            if img.ndim > 3:
+                raise ValueError("Read image seems to be 3D: {}. Path: {}".format(img.shape, path))
+            if img.ndim == 2:
+                img = np.expand_dims(img, -1)
+            else:
+                if img.shape[0] <= 3: img = img.transpose((1,2,0))
+        else:
+            if img.ndim < 3:
+                raise ValueError("Read image seems to be 2D: {}. Path: {}".format(img.shape, path))
+            if img.ndim == 3: 
+                img = np.expand_dims(img, -1)
+            else:
+                min_val = min(img.shape)
+                channel_pos = img.shape.index(min_val)
+                if channel_pos != 3 and img.shape[channel_pos] <= 4:
+                    new_pos = [x for x in range(4) if x != channel_pos]+[channel_pos,]
+                    img = img.transpose(new_pos)
+
+        if reflect_to_complete_shape: img = pad_and_reflect(img, crop_shape, verbose=verbose)
+
+        if crop_shape is not None and check_channel:
+            if crop_shape[-1] != img.shape[-1]:
+                if crop_shape[-1] == 3 and convert_to_rgb:
+                    img = np.repeat(img, 3, axis=-1)
+                else:
+                    raise ValueError("Channel of the patch size given {} does not correspond with the loaded image {}. "
+                        "Please, check the channels of the images!".format(crop_shape[-1], img.shape[-1]))
+        return img
+
+    def _crop(img):
+        if crop and img.shape != tuple(crop_shape[:ndim])+(img.shape[-1],):
+            patch_shape = tuple(crop_shape[:ndim])+(img.shape[-1],)
+            if ndim == 2:
+                return crop_data_with_overlap(np.expand_dims(img, 0), patch_shape, overlap=overlap, padding=padding, 
+                    verbose=False)
+            else:
+                return crop_3D_data_with_overlap(img, patch_shape, overlap=overlap, padding=padding, 
+                    median_padding=median_padding, verbose=verbose)
+        return np.expand_dims(img, 0)
+
+    # Probe the shape each image will have to allocate the final array 
+    out, out_shapes, offsets = None, None, None
+    if preprocess_f == None:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            headers = list(executor.map(lambda p: _read_image_header(p, is_chunked), paths))
+        if all(h is not None for h in headers):
+            out_shapes = []
+            for path, (shape, dtype) in zip(paths, headers):
+                # Zero-strided array, so the shape is calculated as with the real image without allocating memory
+                shape = _prepare(np.squeeze(np.broadcast_to(np.zeros((), dtype=dtype), shape)), path).shape
+                if crop and shape != tuple(crop_shape[:ndim])+(shape[-1],):
+                    out_shapes.append((_num_crops(shape, crop_shape, overlap, padding),)+tuple(crop_shape[:ndim])+(shape[-1],))
+                else:
+                    out_shapes.append((1,)+shape)
+            if all(s[1:] == out_shapes[0][1:] for s in out_shapes):
+                offsets = np.cumsum([0]+[s[0] for s in out_shapes])
+                out = np.empty((offsets[-1],)+out_shapes[0][1:], dtype=np.result_type(*[h[1] for h in headers]))
+
+    out_lock = threading.Lock()
+    in_out, moved = set(), {}
+    def _release_out():
+        """Copy the images already written into ``out`` and release it, as the images will need to be concatenated
+        at the end and keeping it would double the memory."""
+        nonlocal out
+        for j in in_out:
+            moved[j] = out[offsets[j]:offsets[j+1]].astype(headers[j][1])
+        in_out.clear()
+        out = None
+
+    def _load(i):
+        img = _prepare(_read_image(paths[i], is_chunked), paths[i])
+        if preprocess_f != None:
+            return img, None, None
+        shape = img.shape
+        img = _crop(img)
+        drange = data_range(img) if check_drange else None
+        with out_lock:
+            if out is not None:
+                if img.shape == out_shapes[i] and img.dtype == headers[i][1]:
+                    out[offsets[i]:offsets[i+1]] = img
+                    in_out.add(i)
+                    img = None
+                else:
+                    _release_out()
+        return img, shape, drange
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        results = list(tqdm(executor.map(_load, range(len(paths))), total=len(paths), disable=not is_main_process()))
+        data = [r[0] if r[0] is not None else (moved[i] if i in moved else out[offsets[i]:offsets[i+1]]) 
+            for i, r in enumerate(results)]
+        del moved
+        data_shape = [r[1] for r in results]
+        dranges = [r[2] for r in results]
+        del results
+            
+        if preprocess_f != None:
+            if is_mask:
+                # data contains masks
+                data = preprocess_f(preprocess_cfg, y_data = data, is_2d = (ndim == 2), is_y_mask = is_mask)
+            else:
+                data = preprocess_f(preprocess_cfg, x_data = data, is_2d = (ndim == 2))
+            data_shape = [img.shape for img in data]
+            data = list(executor.map(_crop, data))
+            dranges = [data_range(img) if check_drange else None for img in data]
+    c_shape = [img.shape for img in data]
+
+    same_shape = True
+    for i in range(1,len(data)):
+        if check_drange and dranges[0] != dranges[i]:
+            raise ValueError("Input images ({} vs {}) seem to have different data ranges ({} and {} found) Please check it "
+                "and ensure all images have same data type"
+                .format(filenames[0], filenames[i], dranges[0], dranges[i]))
+        if data[0].shape != data[i].shape:
+            same_shape = False
+
+    if out is not None and all(img.base is out for img in data):
+        data = out
+    elif crop or same_shape:
+        data = np.concatenate(data)
+    if isinstance(data, np.ndarray):
+        print("*** Loaded data shape is {}".format(data.shape))
+        nbytes = data.nbytes
+    else:
+        print("Not all samples seem to have the same shape. Number of samples: {}".format(len(data)))
+        print("*** First sample shape is {}".format(data[0].shape[1:] if ndim == 2 else data[0].shape))
+        nbytes = sum(img.nbytes for img in data)
+    load_time = time.time()-start_time
+    print("*** Loaded {:.1f} MB in {:.1f}s ({:.1f} MB/s)".format(nbytes/1024**2, load_time, 
+        nbytes/1024**2/max(load_time, 1e-6)))
+
+    return data, data_shape, c_shape, filenames
+
 def load_data_from_dir(data_dir, crop=False, crop_shape=None, overlap=(0,0), padding=(0,0), return_filenames=False,
                        reflect_to_complete_shape=False, check_channel=True, convert_to_rgb=False, check_drange=True,
-                       preprocess_cfg=None, is_mask=False, preprocess_f=None):
+                       preprocess_cfg=None, is_mask=False, preprocess_f=None, num_workers=None):
     """Load data from a directory. If ``crop=False`` all the data is suposed to have the same shape.
 
     Parameters
@@ -874,6 +1093,9 @@ def load_data_from_dir(data_dir, crop=False, crop_shape=None, overlap=(0,0), pad
     preprocess_f : function, optional
         The preprocessing function, is necessary in case you want to apply any preprocessing.
 
+    num_workers : int, optional
+        Number of threads used to read the images. By default, the number of threads set in torch, i.e. ``SYSTEM.NUM_CPUS``.
+
     Returns
     -------
     data : 4D Numpy array or list of 3D Numpy arrays
@@ -915,108 +1137,9 @@ def load_data_from_dir(data_dir, crop=False, crop_shape=None, overlap=(0,0), pad
         #     *** Loaded data shape is (1980, 256, 256, 1)
     """
 
-    if preprocess_f != None and preprocess_cfg == None:
-        raise ValueError("The preprocessing configuration ('preprocess_cfg') is missing.")
-
-    if crop:
-        from biapy.data.data_2D_manipulation import crop_data_with_overlap
-
-    print("Loading data from {}".format(data_dir))
-    ids = sorted(next(os.walk(data_dir))[2])
-    fids = sorted(next(os.walk(data_dir))[1])
-    data = []
-    data_shape = []
-    c_shape = []
-    filenames = []
-
-    if len(ids) == 0:
-        if len(fids) == 0: # Trying Zarr
-            raise ValueError("No images found in dir {}".format(data_dir))
-        _ids = fids
-    else:
-        _ids = ids
-
-    for n, id_ in tqdm(enumerate(_ids), total=len(_ids), disable=not is_main_process()):
-        if id_.endswith('.npy'):
-            img = np.load(os.path.join(data_dir, id_))
-        elif id_.endswith('.hdf5') or id_.endswith('.h5'):
-            img = h5py.File(os.path.join(data_dir, id_),'r')
-            img = np.array(img[list(img)[0]])
-        else:
-            if len(ids) > 0:
-                img = imread(os.path.join(data_dir, id_))
-            else: # Working with Zarr 
-                _, img = read_chunked_data(os.path.join(data_dir, fids[n]))
-                img = np.array(img)
-        img = np.squeeze(img)
-
-        if img.ndim > 3:
-            raise ValueError("Read image seems to be 3D: {}. Path: {}".format(img.shape, os.path.join(data_dir, id_)))
-
-        filenames.append(id_)
-
-        if img.ndim == 2:
-            img = np.expand_dims(img, -1)
-        else:
-            if img.shape[0] <= 3: img = img.transpose((1,2,0))  
-
-        if reflect_to_complete_shape: img = pad_and_reflect(img, crop_shape, verbose=False)
-
-        if crop_shape is not None and check_channel:
-            if crop_shape[-1] != img.shape[-1]:
-                if crop_shape[-1] == 3 and convert_to_rgb:
-                    img = np.repeat(img, 3, axis=-1)
-                else:
-                    raise ValueError("Channel of the patch size given {} does not correspond with the loaded image {}. "
-                        "Please, check the channels of the images!".format(crop_shape[-1], img.shape[-1]))
-
-        if preprocess_f == None:
-            data_shape.append(img.shape)
-            img = np.expand_dims(img, axis=0)
-            if crop and img[0].shape != crop_shape[:2]+(img.shape[-1],):
-                img = crop_data_with_overlap(img, crop_shape[:2]+(img.shape[-1],), overlap=overlap, padding=padding,
-                                            verbose=False)
-            c_shape.append(img.shape)
-        data.append(img)
-        
-    if preprocess_f != None:
-        if is_mask:
-            # data contains masks
-            data = preprocess_f(preprocess_cfg, y_data = data, is_2d = True, is_y_mask = is_mask)
-        else:
-            data = preprocess_f(preprocess_cfg, x_data = data, is_2d = True)
-    
-        _data = []
-        for img_num in range(len(data)):
-            img = data[img_num]
-            data_shape.append(img.shape)
-            img = np.expand_dims(img, axis=0)
-            if crop and img[0].shape != crop_shape[:2]+(img.shape[-1],):
-                img = crop_data_with_overlap(img, crop_shape[:2]+(img.shape[-1],), overlap=overlap, padding=padding,
-                                            verbose=False)
-            c_shape.append(img.shape)
-            _data.append(img)
-        del data
-        data = _data
-
-    same_shape = True
-    s = data[0].shape
-    dtype = data[0].dtype
-    drange = data_range(data[0])
-    for i in range(1,len(data)):
-        if check_drange and drange != data_range(data[i]):
-            raise ValueError("Input images ({} vs {}) seem to have different data ranges ({} and {} found) Please check it "
-                "and ensure all images have same data type"
-                .format(filenames[0], filenames[i], drange, data_range(data[i])))
-        if s != data[i].shape:
-            same_shape = False
-
-    if crop or same_shape:
-        data = np.concatenate(data)
-        print("*** Loaded data shape is {}".format(data.shape))
-    else:
-        print("Not all samples seem to have the same shape. Number of samples: {}".format(len(data)))
-        print("*** First sample shape is {}".format(data[0].shape[1:]))
+    data, data_shape, c_shape, filenames = _load_images_from_dir(data_dir, 2, crop, crop_shape, overlap, padding, False,
+        reflect_to_complete_shape, check_channel, convert_to_rgb, check_drange, preprocess_cfg, is_mask, preprocess_f, 
+        num_workers, False)
 
     if return_filenames:
         return data, data_shape, c_shape, filenames
@@ -1091,7 +1214,7 @@ def load_ct_data_from_dir(data_dir, shape=None):
 
 def load_3d_images_from_dir(data_dir, crop=False, crop_shape=None, verbose=False, overlap=(0,0,0), padding=(0,0,0),
         median_padding=False, reflect_to_complete_shape=False, check_channel=True, convert_to_rgb=False, check_drange=True,
-        return_filenames=False, preprocess_cfg=None, is_mask=False, preprocess_f=None):
+        return_filenames=False, preprocess_cfg=None, is_mask=False, preprocess_f=None, num_workers=None):
     """Load data from a directory.
 
     Parameters
@@ -1141,6 +1264,9 @@ def load_3d_images_from_dir(data_dir, crop=False, crop_shape=None, verbose=False
     preprocess_f : function, optional
         The preprocessing function, is necessary in case you want to apply any preprocessing.
 
+    num_workers : int, optional
+        Number of threads used to read the images. By default, the number of threads set in torch, i.e. ``SYSTEM.NUM_CPUS``.
+
     return_filenames : bool, optional
         Return a list with the loaded filenames. Useful when you need to save them afterwards with the same names as
         the original ones.
@@ -1191,117 +1317,10 @@ def load_3d_images_from_dir(data_dir, crop=False, crop_shape=None, verbose=False
     """
     if crop and crop_shape is None:
         raise ValueError("'crop_shape' must be provided when 'crop' is True")
-    
-    if preprocess_f != None and preprocess_cfg == None:
-        raise ValueError("The preprocessing configuration ('preprocess_cfg') is missing.")
-
-    print("Loading data from {}".format(data_dir))
-    ids = sorted(next(os.walk(data_dir))[2])
-    fids = sorted(next(os.walk(data_dir))[1])
-
-    if len(ids) == 0:
-        if len(fids) == 0: # Trying Zarr
-            raise ValueError("No images found in dir {}".format(data_dir))
-        _ids = fids
-    else:
-        _ids = ids
-
-    if crop:
-        from biapy.data.data_3D_manipulation import crop_3D_data_with_overlap
 
-    data = []
-    data_shape = []
-    c_shape = []
-    filenames = []
-    ax = None
-
-    # Read images
-    for n, id_ in tqdm(enumerate(_ids), total=len(_ids), disable=not is_main_process()):
-        if id_.endswith('.npy'):
-            img = np.load(os.path.join(data_dir, id_))
-        elif id_.endswith('.hdf5') or id_.endswith('.h5'):
-            img = h5py.File(os.path.join(data_dir, id_),'r')
-            img = np.array(img[list(img)[0]])
-        else:
-            if len(ids) > 0:
-                img = imread(os.path.join(data_dir, id_))
-            else: # Working with Zarr 
-                _, img = read_chunked_data(os.path.join(data_dir, fids[n]))
-                img = np.array(img)
-        img = np.squeeze(img)
-
-        if img.ndim < 3:
-            raise ValueError("Read image seems to be 2D: {}. Path: {}".format(img.shape, os.path.join(data_dir, id_)))
-
-        if img.ndim == 3: 
-            img = np.expand_dims(img, -1)
-        else:
-            min_val = min(img.shape)
-            channel_pos = img.shape.index(min_val)
-            if channel_pos != 3 and img.shape[channel_pos] <= 4:
-                new_pos = [x for x in range(4) if x != channel_pos]+[channel_pos,]
-                img = img.transpose(new_pos)
-
-        filenames.append(id_)
-        if reflect_to_complete_shape: img = pad_and_reflect(img, crop_shape, verbose=verbose)
-        
-        if crop_shape is not None and check_channel:
-            if crop_shape[-1] != img.shape[-1]:
-                if crop_shape[-1] == 3 and convert_to_rgb:
-                    img = np.repeat(img, 3, axis=-1)
-                else:
-                    raise ValueError("Channel of the patch size given {} does not correspond with the loaded image {}. "
-                        "Please, check the channels of the images!".format(crop_shape[-1], img.shape[-1]))
-
-        if preprocess_f == None:
-            data_shape.append(img.shape)
-            if crop and img.shape != crop_shape[:3]+(img.shape[-1],):
-                img = crop_3D_data_with_overlap(img, crop_shape[:3]+(img.shape[-1],), overlap=overlap, padding=padding,
-                                                median_padding=median_padding, verbose=verbose)
-            else:
-                img = np.expand_dims(img, axis=0)
-            c_shape.append(img.shape)
-        data.append(img)
-    
-    if preprocess_f != None:
-        if is_mask:
-            # data contains masks
-            data = preprocess_f(preprocess_cfg, y_data = data, is_2d = False, is_y_mask = is_mask)
-        else:
-            data = preprocess_f(preprocess_cfg, x_data = data, is_2d = False)
-    
-        _data = []
-        for img_num in range(len(data)):
-            img = data[img_num]
-            data_shape.append(img.shape)
-            if crop and img.shape != crop_shape[:3]+(img.shape[-1],):
-                img = crop_3D_data_with_overlap(img, crop_shape[:3]+(img.shape[-1],), overlap=overlap, padding=padding,
-                                                median_padding=median_padding, verbose=verbose)
-            else:
-                img = np.expand_dims(img, axis=0)
-            c_shape.append(img.shape)
-            _data.append(img)
-        del data
-        data = _data
-
-    same_shape = True
-    s = data[0].shape
-    dtype = data[0].dtype
-    drange = data_range(data[0])
-    for i in range(1,len(data)):
-        if check_drange and drange != data_range(data[i]):
-            raise ValueError("Input images ({} vs {}) seem to have different data ranges ({} and {} found) Please check it "
-                "and ensure all images have same data type"
-                .format(filenames[0], filenames[i], drange, data_range(data[i])))
-        if s != data[i].shape:
-            same_shape = False
-
-    if crop or same_shape:
-        data = np.concatenate(data)
-        print("*** Loaded data shape is {}".format(data.shape))
-    else:
-        print("Not all samples seem to have the same shape. Number of samples: {}".format(len(data)))
-        print("*** First sample shape is {}".format(data[0].shape))
+    data, data_shape, c_shape, filenames = _load_images_from_dir(data_dir, 3, crop, crop_shape, overlap, padding, median_padding,
+        reflect_to_complete_shape, check_channel, convert_to_rgb, check_drange, preprocess_cfg, is_mask, preprocess_f, 
+        num_workers, verbose)
 
     if return_filenames:
         return data, data_shape, c_shape, filenames
@@ -1467,13 +1486,40 @@ def data_range(x):
     else:
         return "none_range"
 
-def read_chunked_data(filename):
+def read_chunked_data(filename, chunk_cache_mb=0):
+    """
+    Open a Zarr/H5 file and return its first dataset.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the Zarr/H5 file.
+
+    chunk_cache_mb : int, optional
+        Size, in MB, of the chunk cache to use. For H5 files is the decoded chunk cache of each dataset 
+        (``rdcc_nbytes``) and for Zarr a ``zarr.LRUStoreCache`` over the chunks read from disk. ``0`` to use 
+        the libraries' default.
+
+    Returns
+    -------
+    fid : H5 file or Zarr group
+        Opened file. H5 files need to be closed by the caller. 
+
+    data : H5 dataset or Zarr array
+        First dataset found in the file.
+    """
     if isinstance(filename, str):
         if filename.endswith('.hdf5') or filename.endswith('.h5'):
-            fid = h5py.File(filename,'r')
+            if chunk_cache_mb > 0:
+                fid = h5py.File(filename,'r', rdcc_nbytes=chunk_cache_mb*1024*1024)
+            else:
+                fid = h5py.File(filename,'r')
             data = fid[list(fid)[0]]
         elif filename.endswith('.zarr'):
-            fid = zarr.open(filename,'r')
+            if chunk_cache_mb > 0:
+                fid = zarr.open(zarr.LRUStoreCache(zarr.DirectoryStore(filename), max_size=chunk_cache_mb*1024*1024), mode='r')
+            else:
+                fid = zarr.open(filename,'r')
             if len(list((fid.group_keys()))) != 0: # if the zarr has groups
                 fid = fid[list(fid.group_keys())[0]]
             if len(list((fid.array_keys()))) != 0: # if the zarr has arrays
@@ -1485,6 +1531,221 @@ def read_chunked_data(filename):
 
         return fid, data
 
+def chunked_data_compression(file_type, compression="default"):
+    """
+    Arguments to pass to ``create_dataset`` of a H5 file or a Zarr group to compress the data with ``compression``.
+
+    Parameters
+    ----------
+    file_type : str
+        Type of the file. Options: ``'h5'`` and ``'zarr'``.
+
+    compression : str, optional
+        Compressor to use. Options: ``'default'`` (``gzip`` in H5 files and the default of Zarr, ``blosc``, in Zarr 
+        files), ``'gzip'``, ``'blosc'`` (with ``lz4``), ``'lz4'`` and ``'zstd'``. In H5 files ``'blosc'``, ``'lz4'`` 
+        and ``'zstd'`` need ``hdf5plugin`` to be installed.
+
+    Returns
+    -------
+    kwargs : dict
+        Compression arguments of ``create_dataset``.
+    """
+    if file_type == "h5":
+        if compression in ["default", "gzip"]:
+            return {"compression": "gzip"}
+        import hdf5plugin
+        if compression == "blosc":
+            return dict(hdf5plugin.Blosc(cname='lz4'))
+        elif compression == "lz4":
+            return dict(hdf5plugin.LZ4())
+        else:
+            return dict(hdf5plugin.Zstd())
+    else:
+        from numcodecs import Blosc, GZip, LZ4, Zstd
+        if compression == "default":
+            return {}
+        elif compression == "gzip":
+            return {"compressor": GZip()}
+        elif compression == "blosc":
+            return {"compressor": Blosc(cname='lz4')}
+        elif compression == "lz4":
+            return {"compressor": LZ4()}
+        else:
+            return {"compressor": Zstd()}
+
+class ChunkedDataPool:
+    """
+    Least recently used pool of opened Zarr/H5 files. Used to avoid opening and closing the same files again and
+    again when reading patches from them, e.g. in ``chunked_data`` mode of the generators. 
+
+    The handles are never shared between processes: if the pool is used from a process different from the one that 
+    opened them (e.g. a forked ``DataLoader`` worker) they are discarded and the files are opened again. Call 
+    :meth:`reset` to do it explicitly, e.g. in a ``worker_init_fn``.
+
+    Parameters
+    ----------
+    max_open_files : int, optional
+        Maximum number of files opened at the same time. The least recently used file is closed when exceeded.
+
+    chunk_cache_mb : int, optional
+        Size, in MB, of the chunk cache of each opened file. See :func:`read_chunked_data`.
+    """
+    def __init__(self, max_open_files=16, chunk_cache_mb=0):
+        assert max_open_files > 0, "'max_open_files' must be greater than 0"
+        self.max_open_files = max_open_files
+        self.chunk_cache_mb = chunk_cache_mb
+        self.reset()
+
+    def reset(self):
+        """Forget all opened files. They are not closed as they could belong to other process."""
+        self.handles = OrderedDict()
+        self.pid = os.getpid()
+
+    def get(self, filename):
+        """
+        Return the first dataset of ``filename``, opening the file only if it is not already in the pool.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the Zarr/H5 file.
+
+        Returns
+        -------
+        data : H5 dataset or Zarr array
+            First dataset found in the file.
+        """
+        if self.pid != os.getpid():
+            self.reset()
+
+        if filename in self.handles:
+            self.handles.move_to_end(filename)
+            return self.handles[filename][1]
+
+        self.handles[filename] = read_chunked_data(filename, chunk_cache_mb=self.chunk_cache_mb)
+        while len(self.handles) > self.max_open_files:
+            _, (fid, _) = self.handles.popitem(last=False)
+            if isinstance(fid, h5py.File):
+                fid.close()
+        return self.handles[filename][1]
+
+    def close(self):
+        """Close all opened files."""
+        if self.pid == os.getpid():
+            for fid, _ in self.handles.values():
+                if isinstance(fid, h5py.File):
+                    fid.close()
+        self.reset()
+
+    def __getstate__(self):
+        # Opened files can not be pickled (e.g. when DataLoader workers are spawned)
+        state = self.__dict__.copy()
+        state['handles'] = OrderedDict()
+        return state
+
+SharedArrayReference = namedtuple('SharedArrayReference', ['backend', 'name', 'shape', 'dtype'])
+
+# Arrays created by share_array() in this process: id -> (array, reference, owner pid, shared memory block)
+_shared_arrays = {}
+
+def share_array(data, backend="shared_memory", npy_file=None, create=True):
+    """
+    Place an array in memory that can be shared between processes, so all the ``DataLoader`` workers read the same 
+    physical copy instead of duplicating its pages.
+
+    Parameters
+    ----------
+    data : Numpy array
+        Data to share. Not used if ``create`` is ``False``.
+
+    backend : str, optional
+        Where to place the data. Options: ``'shared_memory'`` (a ``multiprocessing.shared_memory`` block, shared 
+        between the process and its workers) and ``'memmap'`` (a ``.npy`` file opened as a read only memory map, which 
+        can also be shared by different processes of the same node, e.g. DDP ranks).
+
+    npy_file : str, optional
+        File to use with the ``'memmap'`` backend.
+
+    create : bool, optional
+        Whether to write ``npy_file``. Set it to ``False`` to open a file already written by other process. Only used 
+        with the ``'memmap'`` backend.
+
+    Returns
+    -------
+    shared_data : Numpy array
+        Data placed in the shared memory. It is read only when ``backend`` is ``'memmap'``.
+    """
+    assert backend in ['shared_memory', 'memmap'], "'backend' must be one between ['shared_memory', 'memmap']"
+    shm = None
+    if backend == "shared_memory":
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+        shared_data = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+        shared_data[...] = data
+        ref = SharedArrayReference(backend, shm.name, data.shape, data.dtype.str)
+    else:
+        assert npy_file is not None, "'npy_file' must be provided with 'memmap' backend"
+        if create:
+            os.makedirs(os.path.dirname(npy_file), exist_ok=True)
+            tmp_file = npy_file+".{}.tmp.npy".format(os.getpid())
+            np.save(tmp_file, data)
+            os.replace(tmp_file, npy_file)
+        shared_data = np.load(npy_file, mmap_mode='r')
+        ref = SharedArrayReference(backend, npy_file, shared_data.shape, shared_data.dtype.str)
+    _shared_arrays[id(shared_data)] = (shared_data, ref, os.getpid() if create else None, shm)
+    return shared_data
+
+def shared_array_reference(data):
+    """
+    Reference to attach ``data`` from other process with :func:`attach_shared_array`. ``None`` if ``data`` was not 
+    created by :func:`share_array`.
+    """
+    entry = _shared_arrays.get(id(data))
+    if entry is None or entry[0] is not data:
+        return None
+    return entry[1]
+
+def attach_shared_array(ref):
+    """
+    Access, without copying it, an array shared by other process with :func:`share_array`.
+
+    Parameters
+    ----------
+    ref : SharedArrayReference
+        Reference of the shared array. See :func:`shared_array_reference`.
+
+    Returns
+    -------
+    shared_data : Numpy array
+        Shared data.
+    """
+    if ref.backend == "shared_memory":
+        from multiprocessing import shared_memory
+        # Workers share the resource tracker of the process that created the block, so it is released only once
+        shm = shared_memory.SharedMemory(name=ref.name)
+        shared_data = np.ndarray(ref.shape, dtype=np.dtype(ref.dtype), buffer=shm.buf)
+    else:
+        shared_data = np.load(ref.name, mmap_mode='r')
+        shm = None
+    _shared_arrays[id(shared_data)] = (shared_data, ref, None, shm)
+    return shared_data
+
+@atexit.register
+def _release_shared_arrays():
+    entries = [(ref, owner, shm) for _, ref, owner, shm in _shared_arrays.values()]
+    _shared_arrays.clear()
+    for ref, owner, shm in entries:
+        if owner != os.getpid():
+            continue
+        if ref.backend == "shared_memory":
+            try:
+                shm.close()
+            except BufferError: # The array is still referenced. The memory is released anyway when the process ends
+                pass
+            shm.unlink()
+        elif os.path.exists(ref.name):
+            os.remove(ref.name)
+
 def write_chunked_data(data, data_dir, filename, dtype_str="float32", verbose=True):
     """
     Save images in the given directory.